@@ -6,10 +6,144 @@ db_config = {
     "password": "postgres",
     "host": "127.0.0.1",
     "port": 5432,
-    "db_name": "otbp"
+    "db_name": "otbp",
+    # Connection pool used by with_pg_connection, see main/model/__init__.py
+    "pool_min_size": 1,
+    "pool_max_size": 10,
+    "pool_idle_timeout_seconds": 300,
+    "pool_acquire_timeout_seconds": 30,
+    # Idle connections are checked with a "SELECT 1" before being handed out if they've been idle this long
+    "pool_health_check_seconds": 30
 }
 
 
 graph_factory_config = {
-    "number_of_processors": 6
-}
\ No newline at end of file
+    "number_of_processors": 6,
+    # Rows fetched per round trip when streaming the road and intersection tables
+    "fetch_size": 10000,
+    # How far (in degrees) an intersection can be from a road and still be on it
+    "snap_tolerance_degrees": 1e-9,
+    # Edge geometries are computed by the worker processes in chunks of roads with about this many edges
+    "chunk_edges": 2000,
+    # Where manage.py create_graph --incremental keeps the per state graph shards
+    "shard_dir": "graph_shards"
+}
+
+
+census_config = {
+    # Where manage.py download gets the TIGER files from
+    "host": "ftp2.census.gov",
+    "port": 21,
+    # A local directory laid out like the FTP server (e.g. <mirror_dir>/geo/tiger/TIGER2014/PLACE/), used instead of
+    # the server when set
+    "mirror_dir": None,
+    # Files downloaded at once, each over its own connection
+    "connections": 4,
+    # Threads extracting the downloaded zip files
+    "extract_threads": 2
+}
+
+
+import_config = {
+    # Shape files imported at once by manage.py import, each one in its own process with its own connection
+    "number_of_processes": 4,
+    # The indexes on gis.places and gis.roads are only dropped (and built again after) when at least this many files
+    # are imported, rebuilding them costs more than updating them for a state or two
+    "drop_indexes_min_files": 20
+}
+
+
+graph_config = {
+    "graph_file": "graph.bin",
+    # How often (in seconds) the web app stats the graph file to see if a new one has been written
+    "reload_check_interval_seconds": 30,
+    # One of "dijkstra", "bidirectional_dijkstra", "astar" or "ch" (needs a contraction hierarchy built by
+    # manage.py create_graph --contraction_hierarchy), see main/model/search.py
+    "search_engine": "astar",
+    # Serve queries from a frozen, array backed copy of the graph (see main/model/compact_graph.py)
+    "compact_graph": True,
+    # Number of parsed edge geometries to keep in memory, 0 parses them every time (see GeometryStore)
+    "geometry_cache_size": 50000,
+    # Size of the grid cells used to find the node nearest to a point (see main/model/spatial_index.py)
+    "spatial_index_cell_degrees": 0.05
+}
+
+
+route_cache_config = {
+    # Number of calculated routes to remember (0 turns the cache off), see main/model/route_cache.py
+    "max_size": 1000,
+    # Routes older than this are calculated (and written to gis.user_routes) again
+    "ttl_seconds": 3600
+}
+
+
+route_writer_config = {
+    # Routes are written to gis.user_routes in the background, in batches of up to batch_size routes
+    # (see main/model/route_writer.py)
+    "batch_size": 50,
+    # How long the oldest queued route waits for a batch to fill up
+    "max_delay_seconds": 0.5,
+    # How long /graph/route/<route_id>/flush waits for a route to be written
+    "flush_timeout_seconds": 10
+}
+
+
+place_catalog_config = {
+    # Most places returned by /graph/places/<name>, see main/model/place_catalog.py
+    "max_results": 20,
+    # How often (in seconds) gis.places is checked for a reimport
+    "reload_check_interval_seconds": 300
+}
+
+
+
+trip_config = {
+    # Most stops /graph/calc_trip takes, every stop costs a search over the graph
+    "max_stops": 25
+}
+
+
+batch_config = {
+    # Worker processes calculating the routes of /graph/calc_routes and manage.py batch_routes, the web app starts
+    # them once and they map the graph file themselves (see BatchPool in main/model/batch_routes.py)
+    "processes": 4,
+    # Pairs handed to a worker at a time
+    "chunk_size": 16,
+    # Most pairs /graph/calc_routes takes in one request
+    "max_pairs": 10000
+}
+
+
+alternatives_config = {
+    # Most routes /graph/calc_route/.../alternatives returns, the shortest one included (see
+    # main/model/alternatives.py)
+    "count": 3,
+    # How much longer than the shortest route an alternative may be, 1.25 is 25% longer
+    "max_stretch": 1.25,
+    # The largest part of an alternative (by weight) it may share with any route chosen before it
+    "max_overlap": 0.6
+}
+
+
+distance_table_config = {
+    # Routes between places further apart than this (in meters of route) aren't kept by manage.py distance_table,
+    # None keeps every pair of places (n x n entries, see main/model/distance_table.py)
+    "radius_meters": None,
+    # Also keep the next place on every route, so the places on the way can be listed
+    "next_hop": False,
+    # Worker processes running the sweeps, one per place
+    "processes": 4,
+    # Sweeps handed to a worker at a time
+    "chunk_size": 16
+}
+
+
+route_resource_config = {
+    # How long browsers and proxies may keep a /graph/route/<route_id> response, a route never changes once it's
+    # calculated (see main/util/cacheable.py)
+    "max_age_seconds": 31536000,
+    # Bodies smaller than this (in bytes) are sent uncompressed
+    "min_compress_bytes": 512,
+    # Compressed bodies kept in memory, so a popular route is only compressed once per encoding
+    "compressed_bodies": 128
+}
@@ -1,4 +1,8 @@
+import os
+import threading
+import time
 import pg8000
+from collections import deque
 from main import DEFAULT_LOGGER
 from main.config.config import db_config
 from shapely.geometry import Point
@@ -12,14 +16,214 @@ def get_connection():
                       password=db_config["password"])
 
 
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    """
+    A connection handed out by the ConnectionPool.  Everything is passed through to the pg8000 connection, on top
+    of that it keeps the statements prepared on this connection so hot queries are only parsed and planned once.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        self.statements = {}
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def prepare(self, sql):
+        """
+        :param sql: a query using named parameters, e.g. "SELECT name FROM gis.places WHERE gid = :gid"
+        :return: a pg8000 prepared statement, call run(**params) on it to execute it
+        """
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.connection.prepare(sql)
+            self.statements[sql] = statement
+        return statement
+
+
+class ConnectionPool:
+    """
+    A bounded, thread safe pool of database connections.
+
+    acquire() hands out the most recently used idle connection (checking it with a "SELECT 1" first if it sat idle
+    for longer than health_check_seconds), opens a new one if the pool isn't full, or waits for one to be released.
+    Connections idle for longer than idle_timeout_seconds are closed, down to min_size.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout_seconds=300, acquire_timeout_seconds=30,
+                 health_check_seconds=30):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self.health_check_seconds = health_check_seconds
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._pid = os.getpid()
+
+        self.acquired = 0
+        self.created = 0
+        self.closed = 0
+        self.health_check_failures = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def __check_fork(self):
+        # Connections opened by a parent process can't be shared with a forked child, just forget about them
+        # (closing them would close the parent's sockets too).
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._size = 0
+
+    def __evict_idle(self):
+        now = time.time()
+        while len(self._idle) > 0 and self._size > self.min_size \
+                and now - self._idle[0].last_used > self.idle_timeout_seconds:
+            self.__close(self._idle.popleft())
+
+    def __close(self, pooled):
+        self._size -= 1
+        self.closed += 1
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def __healthy(self, pooled):
+        try:
+            c = pooled.connection.cursor()
+            c.execute("SELECT 1")
+            c.fetchall()
+            c.close()
+            pooled.connection.rollback()
+            return True
+        except Exception as e:
+            DEFAULT_LOGGER.warning("Discarding database connection that failed its health check: " + str(e))
+            return False
+
+    def acquire(self):
+        start = time.time()
+        deadline = start + self.acquire_timeout_seconds
+        while True:
+            pooled = None
+            with self._cond:
+                self.__check_fork()
+                self.__evict_idle()
+                while len(self._idle) == 0 and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout("Timed out waiting for a database connection")
+                    self._cond.wait(remaining)
+
+                if len(self._idle) > 0:
+                    pooled = self._idle.pop()
+                else:
+                    # Reserve the slot now, the connection itself is opened outside the lock
+                    self._size += 1
+
+            if pooled is None:
+                try:
+                    pooled = PooledConnection(self.connect())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self.created += 1
+            elif time.time() - pooled.last_used > self.health_check_seconds and not self.__healthy(pooled):
+                with self._cond:
+                    self.health_check_failures += 1
+                    self.__close(pooled)
+                    self._cond.notify()
+                continue
+
+            waited = time.time() - start
+            with self._cond:
+                self.acquired += 1
+                self.total_wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            return pooled
+
+    def release(self, pooled):
+        # Don't leave connections sitting in a transaction (or an aborted one) while they're idle
+        broken = False
+        try:
+            if getattr(pooled.connection, '_in_transaction', True):
+                pooled.connection.rollback()
+        except Exception:
+            broken = True
+
+        with self._cond:
+            if broken or self._pid != os.getpid():
+                self.__close(pooled)
+            else:
+                pooled.last_used = time.time()
+                self._idle.append(pooled)
+                self.__evict_idle()
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+                "acquired": self.acquired,
+                "created": self.created,
+                "closed": self.closed,
+                "health_check_failures": self.health_check_failures,
+                "timeouts": self.timeouts,
+                "average_wait_seconds": self.total_wait_seconds / self.acquired if self.acquired > 0 else 0.0,
+                "max_wait_seconds": self.max_wait_seconds
+            }
+
+
+connection_pool = ConnectionPool(get_connection,
+                                 min_size=db_config["pool_min_size"],
+                                 max_size=db_config["pool_max_size"],
+                                 idle_timeout_seconds=db_config["pool_idle_timeout_seconds"],
+                                 acquire_timeout_seconds=db_config["pool_acquire_timeout_seconds"],
+                                 health_check_seconds=db_config["pool_health_check_seconds"])
+
+
 def with_pg_connection(function):
+    """
+    Hands the function a pooled connection and a cursor (as the connection and cursor keyword arguments), unless the
+    caller passes its own.  Errors are logged and the function returns None.
+    """
+    return _connection_wrapper(function, raise_errors=False)
+
+
+def with_pg_connection_raising(function):
+    """
+    Like with_pg_connection, but errors are logged and raised, for callers that have to tell a failed query (or a
+    database that's down) from one that found nothing
+    """
+    return _connection_wrapper(function, raise_errors=True)
+
+
+def _connection_wrapper(function, raise_errors):
     def wrapper(*args, **kwargs):
         conn = None
         c = None
         try:
             # The calling function might want to supply the connections themselves and close them later.
             if 'connection' not in kwargs:
-                conn = get_connection()
+                conn = connection_pool.acquire()
                 kwargs['connection'] = conn
 
             if 'cursor' not in kwargs:
@@ -29,12 +233,14 @@ def with_pg_connection(function):
             return function(*args, **kwargs)
         except Exception as e:
             DEFAULT_LOGGER.error("Error running DB query: " + str(e))
+            if raise_errors:
+                raise
         finally:
             if c is not None:
                 c.close()
 
             if conn is not None:
-                conn.close()
+                connection_pool.release(conn)
 
     return wrapper
 
@@ -0,0 +1,80 @@
+"""
+Alternative routes with the via node method.
+
+After a search for the shortest distance, one search tree is grown from the source and one from the target (the graph is
+undirected, so the backward tree is just a forward tree from the target), both out to max_stretch times the shortest
+distance.  Every node v both trees reach gives a candidate route: the source's tree to v, then the target's tree from v.
+Candidates are tried from the cheapest up, and a candidate is kept if it's a simple path, no more than max_stretch times
+the shortest route, and shares at most max_overlap of its weight with each route kept so far.  All of the nodes on a
+candidate's path give (nearly) the same route, so they aren't tried again.
+
+Three searches answer the whole query, however many candidates are looked at, instead of a search per alternative
+with edges removed.
+"""
+from main.model.search import dijkstra_to_many, INFINITY
+
+
+def path_edges(path, weight):
+    """
+    :param weight: function (u, v) -> the weight of the edge between u and v
+    :return: {frozenset((u, v)): weight} for the edges of the path
+    """
+    return {frozenset((u, v)): weight(u, v) for u, v in zip(path, path[1:])}
+
+
+def via_node_alternatives(view, source, target, count=3, max_stretch=1.25, max_overlap=0.6):
+    """
+    :param view: the graph to search, see NetworkXView
+    :param source:
+    :param target:
+    :param count: the most routes to return, the shortest one included
+    :param max_stretch: how much longer than the shortest route an alternative may be (1.25 is 25% longer)
+    :param max_overlap: the largest part of an alternative's weight it may share with any route already chosen
+    :return: (list of paths, shortest first, number of nodes the two searches settled), no paths if the target can't
+             be reached
+    """
+    # Finds the shortest distance, which bounds the two trees
+    first = dijkstra_to_many(view, source, [target])
+    shortest = first.distance_to(target)
+    if shortest == INFINITY:
+        return [], first.settled
+
+    limit = shortest * max_stretch
+    forward = dijkstra_to_many(view, source, None, limit)
+    backward = dijkstra_to_many(view, target, None, limit)
+
+    def weight(u, v):
+        # Every edge of a candidate is in one of the two trees
+        if forward.pred.get(v) == u:
+            return forward.dist[v] - forward.dist[u]
+        if forward.pred.get(u) == v:
+            return forward.dist[u] - forward.dist[v]
+        if backward.pred.get(u) == v:
+            return backward.dist[u] - backward.dist[v]
+        return backward.dist[v] - backward.dist[u]
+
+    best = forward.path_to(target)
+    chosen = [(best, path_edges(best, weight), shortest)]
+    covered = set(best)
+
+    candidates = sorted((forward.dist[v] + backward.dist[v], v) for v in forward.dist
+                        if v in backward.dist and forward.dist[v] + backward.dist[v] <= limit)
+    for cost, v in candidates:
+        if len(chosen) >= count:
+            break
+        if v in covered:
+            continue
+
+        to_target = backward.path_to(v)
+        to_target.reverse()
+        path = forward.path_to(v) + to_target[1:]
+        covered.update(path)
+        if len(set(path)) != len(path):
+            # The two halves cross, the route would go around a loop
+            continue
+
+        edges = path_edges(path, weight)
+        if all(sum(w for e, w in edges.items() if e in other) <= max_overlap * cost for _, other, _ in chosen):
+            chosen.append((path, edges, cost))
+
+    return [path for path, _, _ in chosen], first.settled + forward.settled + backward.settled
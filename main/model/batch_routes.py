@@ -0,0 +1,189 @@
+"""
+Calculates routes for many (from, to) pairs at once, for offline jobs scoring thousands of pairs.
+
+The searches are spread over a pool of forked worker processes.  The graph is handed to them through a module global
+set just before the pool forks, so every worker shares the parent's copy of it (copy-on-write, and the compact graph's
+arrays are memory mapped anyway) instead of each one loading or unpickling its own.  Results come back in the order
+the pairs were given, as soon as they're ready.
+
+Forking is only safe in a process that isn't running other threads, the web app (request threads, the route writer)
+uses a BatchPool instead, whose workers are never forked from it.
+"""
+import csv
+import functools
+import json
+import multiprocessing
+import threading
+import networkx as nx
+from main.model.graph import RoadGraph
+
+# Set while the pool forks, see iter_batch_routes
+_graph = None
+_fork_lock = threading.Lock()
+
+
+def route_pair(pair, keep_route=False, graph=None):
+    """
+    Calculates one route, outside of iter_batch_routes so it can be run in a worker process
+    :param pair: (from node id, to node id)
+    :param keep_route: also return the decorated Route (to persist it), otherwise only its summary is sent back
+    :param graph: the RoadGraph, the one inherited from the parent process by default
+    :return: (pair, summary dict or None, Route or None, error message or None)
+    """
+    source_id, target_id = pair
+    graph = graph if graph is not None else _graph
+    try:
+        route = graph.shortest_route(source_id, target_id)
+        route.decorate()
+    except nx.NetworkXException as e:
+        return pair, None, None, str(e)
+
+    summary = {
+        "name": route.name,
+        "distance_meters": route.distance_meters,
+        "steps": len(route.steps),
+        "settled_nodes": route.settled_nodes
+    }
+    return pair, summary, route if keep_route else None, None
+
+
+def iter_batch_routes(graph, pairs, processes=4, chunk_size=16, keep_routes=False):
+    """
+    :param graph: a RoadGraph
+    :param pairs: an iterable of (from node id, to node id)
+    :param processes: worker processes, 1 (or a platform without fork) calculates the routes in this process
+    :param chunk_size: pairs sent to a worker at a time
+    :param keep_routes: see route_pair
+    :return: a generator of route_pair results, in the order of pairs
+    """
+    global _graph
+    if processes <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for pair in pairs:
+            yield route_pair(pair, keep_routes, graph)
+        return
+
+    # Two batches starting at once (e.g. around a graph swap) mustn't fork each other's graph
+    with _fork_lock:
+        _graph = graph
+        pool = multiprocessing.get_context("fork").Pool(processes)
+        _graph = None
+
+    try:
+        for result in pool.imap(functools.partial(route_pair, keep_route=keep_routes), pairs, chunk_size):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_worker_graph(graph_file, compact):
+    """Initializer of the BatchPool workers, every worker maps the graph file itself"""
+    global _graph
+    _graph = RoadGraph.load_graph(graph_file)
+    if compact:
+        _graph.freeze()
+
+
+class BatchPool:
+    """
+    A long lived pool of worker processes for the batches of a multi-threaded process, see /graph/calc_routes.
+
+    A child forked from a process running other threads can inherit locks those threads were holding, so unlike
+    iter_batch_routes this pool never forks its parent: the workers are started by a fork server (spawned where
+    there is none) and each one memory maps the graph file itself, which shares the graph's pages between all of them.
+    The pool is started once, before the first request, and reused by every batch.  It's only replaced when a new
+    graph is swapped in, see restart.
+    """
+
+    def __init__(self, processes=4, chunk_size=16, compact=False):
+        """
+        :param processes: worker processes, with 1 the routes are calculated by the thread asking for them
+        :param chunk_size: pairs sent to a worker at a time
+        :param compact: freeze the graphs the workers load, see RoadGraph.freeze
+        """
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.compact = compact
+        self._graph_file = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self, graph_file):
+        """
+        Starts the workers on a graph file, meant to be called once at startup (see init_graph)
+        :param graph_file:
+        """
+        with self._lock:
+            self._graph_file = graph_file
+            self.__replace_pool()
+
+    def restart(self, *args):
+        """
+        Starts new workers on the graph file as it is now, batches already running on the old ones are finished
+        first.  Takes (and ignores) the arguments of a GraphHolder swap listener.
+        """
+        with self._lock:
+            if self._graph_file is not None:
+                self.__replace_pool()
+
+    def __replace_pool(self):
+        old_pool = self._pool
+        self._pool = None
+        if self.processes > 1:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._pool = multiprocessing.get_context(start_method) \
+                .Pool(self.processes, load_worker_graph, (self._graph_file, self.compact))
+        if old_pool is not None:
+            old_pool.close()
+            threading.Thread(target=old_pool.join, daemon=True).start()
+
+    def iter_routes(self, graph, pairs, keep_routes=False):
+        """
+        :param graph: the RoadGraph the routes are calculated on when there are no workers (processes is 1 or the
+                      pool wasn't started), the workers use the graph file they loaded
+        :param pairs: an iterable of (from node id, to node id)
+        :param keep_routes: see route_pair
+        :return: a generator of route_pair results, in the order of pairs
+        """
+        with self._lock:
+            # Tasks handed to a pool before it's closed by restart are still run
+            pool = self._pool
+            results = pool.imap(functools.partial(route_pair, keep_route=keep_routes), pairs, self.chunk_size) \
+                if pool is not None else None
+
+        if results is None:
+            for pair in pairs:
+                yield route_pair(pair, keep_routes, graph)
+            return
+        for result in results:
+            yield result
+
+    def close(self):
+        """Stops the workers"""
+        with self._lock:
+            pool, self._pool, self._graph_file = self._pool, None, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def result_json(pair, summary, route_id=None, error=None):
+    """
+    :return: one NDJSON line for a route_pair result
+    """
+    line = {"from": pair[0], "to": pair[1]}
+    if error is not None:
+        line["error"] = error
+    else:
+        line.update(summary)
+        line["route_id"] = route_id
+    return json.dumps(line) + "\n"
+
+
+def parse_pair(line):
+    """
+    :param line: "from,to", node ids are place gids (integers) or "lat,lon" intersection names in quotes
+    :return: (from node id, to node id)
+    """
+    a, b = next(csv.reader([line]))
+    return tuple(int(x) if x.strip().lstrip("-").isdigit() else x.strip() for x in (a, b))
@@ -0,0 +1,366 @@
+import hashlib
+import networkx as nx
+import numpy as np
+
+
+class StringTable:
+    """A read only list of strings, packed into one utf-8 blob and an array of offsets into it"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @staticmethod
+    def from_strings(strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return StringTable(offsets, blob)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.blob.nbytes
+
+
+def graph_digest(lat, lon, place_gid, edge_u, edge_v, edge_weight):
+    """
+    A hash of what a graph is: its nodes (position and place gid) and its edges (end points and weight).  Nodes are
+    hashed by what they are rather than by their number, so a networkx graph, the CompactGraph frozen from it and the
+    same graph built again all hash the same, while changing any weight or node changes the hash.
+    :param lat: node latitudes
+    :param lon: node longitudes
+    :param place_gid: node place gids, -1 for road intersections
+    :param edge_u: edge end points, indexes into the node arrays
+    :param edge_v:
+    :param edge_weight:
+    :return: the hex digest
+    """
+    nodes = np.column_stack((np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64),
+                             np.asarray(place_gid, dtype=np.float64))).reshape(-1, 3)
+    order = np.lexsort((nodes[:, 2], nodes[:, 1], nodes[:, 0]))
+    rank = np.empty(len(nodes), dtype=np.int64)
+    rank[order] = np.arange(0, len(nodes))
+
+    # Every edge from its lower ranked end point, nodes with the same rank are identical so the order doesn't matter
+    edge_u, edge_v = np.asarray(edge_u, dtype=np.int64), np.asarray(edge_v, dtype=np.int64)
+    swap = rank[edge_u] > rank[edge_v]
+    first, second = np.where(swap, edge_v, edge_u), np.where(swap, edge_u, edge_v)
+    edges = np.column_stack((nodes[first], nodes[second], np.asarray(edge_weight, dtype=np.float64))).reshape(-1, 7)
+    edges = edges[np.lexsort(edges.T[::-1])]
+
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(nodes[order]).tobytes())
+    digest.update(np.ascontiguousarray(edges).tobytes())
+    return digest.hexdigest()
+
+
+def coordinate_key(lat, lon):
+    """The node name GraphFactory gives road intersections, see get_node_name_from_location"""
+    return str(float(lat)) + "," + str(float(lon))
+
+
+class CompactGraph:
+    """
+    Frozen, array backed version of the road graph, meant for answering queries.
+
+    Nodes are numbered 0..n-1, the adjacency is stored in CSR form: the half edges leaving node i are
+    targets[offsets[i]:offsets[i+1]] (with matching weights and edge_index), every undirected edge appears twice.
+    edge_index points into the edge table (edge_u, edge_v, edge_weight, edge_db_id, edge_name, edge_geoms).
+
+    The networkx node names are not stored, city nodes are named by their place gid (place_gid) and road
+    intersections by their coordinates (see coordinate_key), index_of() and key() translate between the two.
+
+    This implements the same interface as NetworkXView, so the search engines can run on it directly.
+    """
+
+    def __init__(self, lat, lon, place_gid, city_name, offsets, targets, weights, edge_index,
+                 edge_u, edge_v, edge_weight, edge_db_id, edge_name, names, edge_geoms, custom_keys=None, digest=None):
+        self.lat = lat
+        self.lon = lon
+        # gid of the place for city nodes, -1 for road intersections
+        self.place_gid = place_gid
+        # index into names, -1 if the node isn't a city
+        self.city_name = city_name
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.edge_index = edge_index
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.edge_weight = edge_weight
+        self.edge_db_id = edge_db_id
+        # index into names, -1 if the road has no name
+        self.edge_name = edge_name
+        self.names = names
+        self.edge_geoms = edge_geoms
+        # node index -> name, for the (unusual) nodes whose name isn't a gid or their coordinates
+        self.custom_keys = custom_keys if custom_keys is not None else {}
+
+        for a in (lat, lon, place_gid, city_name, offsets, targets, weights, edge_index,
+                  edge_u, edge_v, edge_weight, edge_db_id, edge_name):
+            if a.flags.writeable:
+                a.flags.writeable = False
+
+        self.__init_lookups()
+        if digest is not None:
+            # Already known (stored in the graph file), see signature()
+            self._signature = (self.number_of_nodes(), self.number_of_edges(), digest)
+
+    def __init_lookups(self):
+        places = np.nonzero(self.place_gid >= 0)[0]
+        order = np.argsort(self.place_gid[places], kind='stable')
+        self._place_gids_sorted = self.place_gid[places][order]
+        self._place_nodes_sorted = places[order]
+        self._key_index = None
+        self._signature = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # These are rebuilt (or lazily built) after unpickling
+        for k in ('_place_gids_sorted', '_place_nodes_sorted', '_key_index', '_signature'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__init_lookups()
+
+    @staticmethod
+    def from_networkx(graph):
+        builder = CompactGraphBuilder()
+        for n, data in graph.nodes(data=True):
+            builder.add_node(n, **data)
+        for u, v, data in graph.edges(data=True):
+            builder.add_edge(u, v, **data)
+        return builder.build()
+
+    def to_networkx(self):
+        """
+        :return: the networkx graph this was built from (minus the uuid "id" edge attribute, which isn't kept)
+        """
+        graph = nx.Graph()
+        for i in range(0, self.number_of_nodes()):
+            graph.add_node(self.key(i), **self.node_data(i))
+        for e in range(0, self.number_of_edges()):
+            u, v = int(self.edge_u[e]), int(self.edge_v[e])
+            graph.add_edge(self.key(u), self.key(v), **self.edge_data(u, v))
+        return graph
+
+    # Node naming
+
+    def index_of(self, key):
+        """
+        :param key: a node name as used in the networkx graph (a place gid or "lat,lon")
+        :return: the node index
+        """
+        if isinstance(key, (int, np.integer)) and not isinstance(key, bool):
+            i = np.searchsorted(self._place_gids_sorted, key)
+            if i < len(self._place_gids_sorted) and self._place_gids_sorted[i] == key:
+                return int(self._place_nodes_sorted[i])
+            return None
+
+        if self._key_index is None:
+            # Only needed when someone asks for an intersection by name, which is rare, so build it lazily
+            self._key_index = {coordinate_key(self.lat[i], self.lon[i]): i
+                               for i in np.nonzero(self.place_gid < 0)[0].tolist()}
+            self._key_index.update({k: i for i, k in self.custom_keys.items()})
+        return self._key_index.get(key)
+
+    def key(self, node):
+        gid = self.place_gid[node]
+        if gid >= 0:
+            return int(gid)
+        if node in self.custom_keys:
+            return self.custom_keys[node]
+        return coordinate_key(self.lat[node], self.lon[node])
+
+    def signature(self):
+        """
+        :return: (number of nodes, number of edges, graph_digest), what the files built for a graph (its contraction
+                 hierarchy, distance table and geometries) are checked against
+        """
+        if self._signature is None:
+            self._signature = (self.number_of_nodes(), self.number_of_edges(),
+                               graph_digest(self.lat, self.lon, self.place_gid, self.edge_u, self.edge_v,
+                                            self.edge_weight))
+        return self._signature
+
+    # The search engine interface (see NetworkXView)
+
+    def __contains__(self, node):
+        return isinstance(node, (int, np.integer)) and 0 <= node < len(self.lat)
+
+    def nodes(self):
+        return iter(range(0, len(self.lat)))
+
+    def number_of_nodes(self):
+        return len(self.lat)
+
+    def number_of_edges(self):
+        return len(self.edge_u)
+
+    def neighbors(self, node):
+        a, b = self.offsets[node], self.offsets[node + 1]
+        return zip(self.targets[a:b].tolist(), self.weights[a:b].tolist())
+
+    def position(self, node):
+        return float(self.lat[node]), float(self.lon[node])
+
+    # Attribute lookups, these return dicts shaped like the networkx node/edge attributes
+
+    def node_data(self, node):
+        data = {"lat": float(self.lat[node]), "lon": float(self.lon[node])}
+        if self.city_name[node] >= 0:
+            data["city_name"] = self.names[self.city_name[node]]
+        return data
+
+    def find_edge(self, u, v):
+        a, b = self.offsets[u], self.offsets[u + 1]
+        hits = np.nonzero(self.targets[a:b] == v)[0]
+        return int(self.edge_index[a + hits[0]]) if len(hits) > 0 else None
+
+    def edge_data(self, u, v):
+        e = self.find_edge(u, v)
+        if e is None:
+            return None
+        return {
+            "db_id": int(self.edge_db_id[e]),
+            "name": self.names[self.edge_name[e]] if self.edge_name[e] >= 0 else None,
+            "weight": float(self.edge_weight[e]),
+            "geom": self.edge_geoms[e]
+        }
+
+    @property
+    def nbytes(self):
+        """Size of the arrays backing the graph, edge geometries aren't included"""
+        return sum(a.nbytes for a in (self.lat, self.lon, self.place_gid, self.city_name, self.offsets,
+                                      self.targets, self.weights, self.edge_index, self.edge_u, self.edge_v,
+                                      self.edge_weight, self.edge_db_id, self.edge_name)) + self.names.nbytes
+
+
+class CompactGraphBuilder:
+    """
+    Collects nodes and edges and freezes them into a CompactGraph.  add_node/add_edge take the same arguments as
+    the networkx calls in GraphFactory.construct_graph, so the factory can fill either one.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._lat = []
+        self._lon = []
+        self._place_gid = []
+        self._city_name = []
+        self._custom_keys = {}
+        # (lower node index, higher node index) -> edge attributes, adding an edge twice overwrites it like networkx
+        self._edges = {}
+        self._names = {}
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._lat)
+
+    def __name_index(self, name):
+        if name is None:
+            return -1
+        if name not in self._names:
+            self._names[name] = len(self._names)
+        return self._names[name]
+
+    def add_node(self, key, lat=None, lon=None, city_name=None, **kwargs):
+        if key in self._index:
+            return self._index[key]
+
+        i = len(self._lat)
+        self._index[key] = i
+        self._lat.append(lat)
+        self._lon.append(lon)
+        self._city_name.append(self.__name_index(city_name))
+
+        if isinstance(key, (int, np.integer)) and not isinstance(key, bool):
+            self._place_gid.append(key)
+        else:
+            self._place_gid.append(-1)
+            if key != coordinate_key(lat, lon):
+                self._custom_keys[i] = key
+        return i
+
+    def add_edge(self, u, v, weight=None, db_id=None, name=None, geom=None, **kwargs):
+        iu, iv = self._index[u], self._index[v]
+        key = (iu, iv) if iu <= iv else (iv, iu)
+        self._edges[key] = (weight if weight is not None else 0.0,
+                            int(db_id) if db_id is not None else -1,
+                            self.__name_index(name),
+                            geom)
+
+    def add_graph(self, compact):
+        """
+        Adds every node and edge of a CompactGraph.  Nodes are matched by name (see CompactGraph.key), so graphs
+        that share nodes are joined at them, and an edge both graphs have is only kept once.
+        """
+        keys = [compact.key(i) for i in range(0, compact.number_of_nodes())]
+        for i, key in enumerate(keys):
+            self.add_node(key, **compact.node_data(i))
+        for e in range(0, compact.number_of_edges()):
+            name = compact.edge_name[e]
+            self.add_edge(keys[compact.edge_u[e]], keys[compact.edge_v[e]],
+                          weight=float(compact.edge_weight[e]),
+                          db_id=int(compact.edge_db_id[e]),
+                          name=compact.names[name] if name >= 0 else None,
+                          geom=compact.edge_geoms[e])
+
+    def build(self):
+        n = len(self._lat)
+        m = len(self._edges)
+
+        edge_u = np.empty(m, dtype=np.int32)
+        edge_v = np.empty(m, dtype=np.int32)
+        edge_weight = np.empty(m, dtype=np.float64)
+        edge_db_id = np.empty(m, dtype=np.int64)
+        edge_name = np.empty(m, dtype=np.int32)
+        edge_geoms = []
+        for e, ((iu, iv), (weight, db_id, name, geom)) in enumerate(self._edges.items()):
+            edge_u[e] = iu
+            edge_v[e] = iv
+            edge_weight[e] = weight
+            edge_db_id[e] = db_id
+            edge_name[e] = name
+            edge_geoms.append(geom)
+
+        # Every edge becomes two half edges, sorted by the node they leave from
+        sources = np.concatenate((edge_u, edge_v))
+        order = np.argsort(sources, kind='stable')
+        targets = np.concatenate((edge_v, edge_u))[order]
+        edge_index = np.concatenate((np.arange(m, dtype=np.int32), np.arange(m, dtype=np.int32)))[order]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(sources, minlength=n))
+
+        names = [None] * len(self._names)
+        for name, i in self._names.items():
+            names[i] = name
+
+        return CompactGraph(
+            lat=np.array(self._lat, dtype=np.float64),
+            lon=np.array(self._lon, dtype=np.float64),
+            place_gid=np.array(self._place_gid, dtype=np.int64),
+            city_name=np.array(self._city_name, dtype=np.int32),
+            offsets=offsets,
+            targets=targets.astype(np.int32),
+            weights=edge_weight[edge_index],
+            edge_index=edge_index,
+            edge_u=edge_u,
+            edge_v=edge_v,
+            edge_weight=edge_weight,
+            edge_db_id=edge_db_id,
+            edge_name=edge_name,
+            names=StringTable.from_strings(names),
+            edge_geoms=edge_geoms,
+            custom_keys=self._custom_keys)
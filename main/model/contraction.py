@@ -0,0 +1,260 @@
+import heapq
+import itertools
+import os
+import pickle
+import time
+import networkx as nx
+from main import DEFAULT_LOGGER
+from main.model.search import NetworkXView, SearchEngine, SearchResult, INFINITY
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over the road graph.
+
+    Nodes are contracted one at a time, least important first.  Whenever removing a node would lengthen the shortest
+    path between two of its neighbors a shortcut edge is added between them that remembers the node it skips (via).
+    A query then only ever has to move "up" the hierarchy from both ends, which settles a few hundred nodes no matter
+    how far apart the end points are.  Shortcuts are unpacked back into the original edges so the resulting path can
+    be turned into Steps like any other.
+
+    This is stored next to the graph file (graph_file + FILE_SUFFIX), see RoadGraph.load_graph.
+    """
+
+    FILE_SUFFIX = ".ch"
+
+    def __init__(self):
+        # node -> position in the contraction order (higher is more important)
+        self.rank = {}
+        # node -> list of (higher ranked neighbor, weight), original edges and shortcuts alike
+        self.up = {}
+        # (lower ranked node, higher ranked node) -> the contracted node the shortcut skips
+        self.via = {}
+        self.shortcut_count = 0
+        # Used to detect a hierarchy that doesn't belong to the graph it sits next to
+        self.graph_signature = None
+        # True if nodes are CompactGraph indexes rather than networkx node names
+        self.indexed = False
+
+    @staticmethod
+    def graph_signature_of(view):
+        """
+        :return: the view's signature (see CompactGraph.signature), it covers the weights and not only the counts, so
+                 a rebuilt graph that happens to have as many nodes and edges doesn't pick up a stale hierarchy
+        """
+        return view.signature()
+
+    @staticmethod
+    def build(view, witness_settle_limit=60):
+        """
+        Builds the hierarchy for a graph
+        :param view: the graph, see NetworkXView
+        :param witness_settle_limit: how many nodes a witness search may settle before giving up and adding the
+                                     shortcut anyway.  Lower is faster to build, but adds more (unnecessary) shortcuts.
+        :return: a ContractionHierarchy
+        """
+        start = time.time()
+        ch = ContractionHierarchy()
+        ch.graph_signature = ContractionHierarchy.graph_signature_of(view)
+        ch.indexed = not isinstance(view, NetworkXView)
+
+        # node -> {neighbor: (weight, via)} of the not yet contracted part of the graph
+        adj = {n: {} for n in view.nodes()}
+        for u in adj:
+            for v, w in view.neighbors(u):
+                if u != v and w < adj[u].get(v, (INFINITY, None))[0]:
+                    adj[u][v] = (w, None)
+
+        contracted_neighbors = {n: 0 for n in adj}
+
+        def witness_distances(source, excluded, max_distance, targets):
+            counter = itertools.count()
+            dist = {source: 0.0}
+            heap = [(0.0, next(counter), source)]
+            remaining = set(targets)
+            settled = 0
+            while heap and remaining and settled < witness_settle_limit:
+                du, _, u = heapq.heappop(heap)
+                if du > dist[u]:
+                    continue
+                if du > max_distance:
+                    break
+                settled += 1
+                remaining.discard(u)
+                for v, (w, _) in adj[u].items():
+                    if v == excluded:
+                        continue
+                    nd = du + w
+                    if nd < dist.get(v, INFINITY):
+                        dist[v] = nd
+                        heapq.heappush(heap, (nd, next(counter), v))
+            return dist
+
+        def shortcuts_for(node):
+            shortcuts = []
+            neighbors = list(adj[node].items())
+            for i in range(0, len(neighbors) - 1):
+                u, (wu, _) = neighbors[i]
+                targets = neighbors[i + 1:]
+                max_distance = wu + max(wv for _, (wv, _) in targets)
+                dist = witness_distances(u, node, max_distance, [v for v, _ in targets])
+                for v, (wv, _) in targets:
+                    if dist.get(v, INFINITY) > wu + wv:
+                        shortcuts.append((u, v, wu + wv))
+            return shortcuts
+
+        def priority(node, shortcuts):
+            # The usual "edge difference" plus a term that spreads contraction evenly over the graph
+            return len(shortcuts) - len(adj[node]) + contracted_neighbors[node]
+
+        counter = itertools.count()
+        heap = [(priority(n, shortcuts_for(n)), next(counter), n) for n in adj]
+        heapq.heapify(heap)
+
+        node_count = len(adj)
+        order = 0
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            # Lazy update, if the node got less attractive since it was queued put it back
+            shortcuts = shortcuts_for(node)
+            p = priority(node, shortcuts)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, next(counter), node))
+                continue
+
+            for u, v, w in shortcuts:
+                if w < adj[u].get(v, (INFINITY, None))[0]:
+                    adj[u][v] = (w, node)
+                    adj[v][u] = (w, node)
+                    ch.shortcut_count += 1
+
+            ch.rank[node] = order
+            order += 1
+            ch.up[node] = []
+            for v, (w, via) in adj[node].items():
+                ch.up[node].append((v, w))
+                if via is not None:
+                    ch.via[(node, v)] = via
+                del adj[v][node]
+                contracted_neighbors[v] += 1
+            del adj[node]
+
+            if order % 10000 == 0:
+                print('\rContracting Graph: {0:.2f}%'.format(order / node_count * 100), end="")
+
+        print("")
+        DEFAULT_LOGGER.info("Contracted {0} nodes in {1:.2f} seconds, added {2} shortcuts"
+                            .format(len(ch.rank), time.time() - start, ch.shortcut_count))
+        return ch
+
+    def save(self, file_name):
+        tmp_file_name = file_name + ".tmp"
+        with open(tmp_file_name, 'wb') as pfile:
+            pickle.dump(self, pfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_name, file_name)
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name, 'rb') as pfile:
+            return pickle.load(pfile)
+
+    def remap(self, mapping):
+        """
+        :param mapping: a function from the current node ids to new ones (e.g. CompactGraph.index_of)
+        :return: a copy of this hierarchy using the new node ids
+        """
+        ch = ContractionHierarchy()
+        ch.graph_signature = self.graph_signature
+        ch.shortcut_count = self.shortcut_count
+        ch.indexed = True
+        ids = {n: mapping(n) for n in self.rank}
+        ch.rank = {ids[n]: r for n, r in self.rank.items()}
+        ch.up = {ids[n]: [(ids[v], w) for v, w in edges] for n, edges in self.up.items()}
+        ch.via = {(ids[u], ids[v]): ids[via] for (u, v), via in self.via.items()}
+        return ch
+
+    def unpack(self, path):
+        """
+        Replaces every shortcut in a path with the original edges it stands for
+        :param path: a list of nodes from a query over the hierarchy
+        :return: a list of nodes where each consecutive pair is an edge in the original graph
+        """
+        if len(path) < 2:
+            return list(path)
+
+        unpacked = [path[0]]
+        for i in range(0, len(path) - 1):
+            stack = [(path[i], path[i + 1])]
+            while stack:
+                a, b = stack.pop()
+                key = (a, b) if self.rank[a] < self.rank[b] else (b, a)
+                via = self.via.get(key)
+                if via is None:
+                    unpacked.append(b)
+                else:
+                    # Push in reverse so (a, via) is expanded first
+                    stack.append((via, b))
+                    stack.append((a, via))
+        return unpacked
+
+
+class ContractionHierarchyEngine(SearchEngine):
+    """
+    Bidirectional search that only relaxes edges going up the hierarchy.  Each side keeps going until its smallest
+    tentative distance can't beat the best meeting point, the unpacked path is identical in weight to Dijkstra's.
+    """
+    name = "ch"
+
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+
+    def search(self, view, source, target):
+        self._check_nodes(self.hierarchy.rank, source, target)
+        if source == target:
+            return SearchResult([source], 0.0, 1)
+
+        up = self.hierarchy.up
+        counter = itertools.count()
+        dist = ({source: 0.0}, {target: 0.0})
+        pred = ({source: None}, {target: None})
+        heaps = ([(0.0, next(counter), source)], [(0.0, next(counter), target)])
+        settled = 0
+        best = INFINITY
+        meeting_node = None
+
+        while heaps[0] or heaps[1]:
+            for d in (0, 1):
+                heap = heaps[d]
+                if not heap:
+                    continue
+                if heap[0][0] >= best:
+                    # Nothing left on this side can improve the route
+                    heap.clear()
+                    continue
+
+                du, _, u = heapq.heappop(heap)
+                if du > dist[d][u]:
+                    continue
+                settled += 1
+
+                if u in dist[1 - d] and du + dist[1 - d][u] < best:
+                    best = du + dist[1 - d][u]
+                    meeting_node = u
+
+                for v, w in up[u]:
+                    nd = du + w
+                    if nd < dist[d].get(v, INFINITY):
+                        dist[d][v] = nd
+                        pred[d][v] = u
+                        heapq.heappush(heap, (nd, next(counter), v))
+
+        if meeting_node is None:
+            raise nx.NetworkXNoPath("No path between {0} and {1}".format(source, target))
+
+        path = self._walk_back(pred[0], meeting_node)
+        node = pred[1][meeting_node]
+        while node is not None:
+            path.append(node)
+            node = pred[1][node]
+
+        return SearchResult(self.hierarchy.unpack(path), best, settled)
@@ -1,5 +1,8 @@
+import itertools
 from main.model import get_connection
 
+_cursor_names = itertools.count()
+
 
 def vacuum_full():
     conn = get_connection()
@@ -7,23 +10,114 @@ def vacuum_full():
         conn.autocommit = True
         conn.cursor().execute("VACUUM FULL gis.places")
         conn.cursor().execute("VACUUM FULL gis.roads")
+        conn.cursor().execute("VACUUM FULL gis.road_states")
     finally:
         conn.close()
 
 
-def execute_import_statements(sql_lines):
-        conn = get_connection()
+# Indexes on the imported tables (see sql/table_setup.sql), dropped while data is imported and created again after,
+# building an index once is much cheaper than updating it for every row
+IMPORT_INDEXES = {
+    "places_geom_index": "gis.places USING GIST (geom)",
+    "roads_geom_index": "gis.roads USING GIST (geom)",
+    "roads_linearid_index": "gis.roads(linearid)"
+}
+
+
+def drop_import_indexes():
+    conn = get_connection()
+    try:
         c = conn.cursor()
-        try:
-            i = 0
-            for sql_line in sql_lines:
-                if not sql_line.startswith("INSERT"):
-                    continue
-
-                c.execute(sql_line)
-                if i % 50 == 0:
-                    conn.commit()
-
-            conn.commit()
-        finally:
-            conn.close()
+        for name in IMPORT_INDEXES:
+            c.execute("DROP INDEX IF EXISTS gis.{0}".format(name))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_import_indexes():
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        for name, definition in IMPORT_INDEXES.items():
+            c.execute("CREATE INDEX IF NOT EXISTS {0} ON {1}".format(name, definition))
+        conn.commit()
+        conn.autocommit = True
+        c.execute("ANALYZE gis.places")
+        c.execute("ANALYZE gis.roads")
+    finally:
+        conn.close()
+
+
+def copy_state_rows(table, statefp, columns, rows):
+    """
+    Replaces a state's rows in gis.places or gis.roads with rows streamed through COPY, in a single transaction so
+    importing a state again never leaves it half imported or imported twice.  Places get their GEOID as gid.  Roads
+    are copied into a temporary table first, the gids they get there are the ones recorded in gis.road_states
+    (gis.roads has no state column).
+    Roads of the state that were imported without a gis.road_states row are replaced too.
+    :param table: "places" or "roads"
+    :param statefp: the state's fips code, two digits
+    :param columns: the COPY column list, e.g. '("linearid","fullname","rttyp","mtfcc",geom)'
+    :param rows: an iterable of chunks of COPY text format lines
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        if table == "roads":
+            c.execute("CREATE TEMP TABLE import_roads (LIKE gis.roads INCLUDING DEFAULTS) ON COMMIT DROP")
+            c.execute("COPY import_roads {0} FROM STDIN".format(columns), stream=rows)
+            c.execute("DELETE FROM gis.roads WHERE gid IN (SELECT gid FROM gis.road_states WHERE statefp = %s)",
+                      (statefp,))
+            c.execute("DELETE FROM gis.road_states WHERE statefp = %s", (statefp,))
+            # Roads imported before gis.road_states existed aren't in it, the state's earlier copies of them are
+            # recognized by their (permanent) TIGER linearid instead
+            c.execute("DELETE FROM gis.roads r WHERE r.linearid IN (SELECT linearid FROM import_roads) "
+                      "AND NOT EXISTS (SELECT 1 FROM gis.road_states s WHERE s.gid = r.gid)")
+            c.execute("INSERT INTO gis.roads SELECT * FROM import_roads")
+            c.execute("INSERT INTO gis.road_states (gid, statefp) SELECT gid, %s FROM import_roads", (statefp,))
+        else:
+            c.execute("CREATE TEMP TABLE import_places (LIKE gis.places INCLUDING DEFAULTS) ON COMMIT DROP")
+            c.execute("COPY import_places {0} FROM STDIN".format(columns), stream=rows)
+            # A place's gid is its GEOID, so it's the same however (and in whatever order) the states are imported,
+            # and a graph built straight from the shape files (see tiger_files.read_places) has the same ids
+            c.execute("UPDATE import_places SET gid = geoid::integer")
+            # A place of another state imported before that (numbered by the gid serial) may hold one of them, it
+            # comes back with its GEOID once its state is imported again
+            c.execute("DELETE FROM gis.places WHERE statefp = %s OR gid IN (SELECT gid FROM import_places)",
+                      (statefp,))
+            c.execute("INSERT INTO gis.places SELECT * FROM import_places")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def stream_query(sql, params=(), fetch_size=10000):
+    """
+    Runs a query through a server side cursor and yields its rows a batch at a time, so only fetch_size rows are in
+    memory however big the result is.  The query gets its own connection, which is closed once the rows run out
+    (or the generator is closed).
+    :param sql: the query, params use the same %s placeholders as cursor.execute
+    :param params:
+    :param fetch_size: rows fetched per round trip
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        name = "stream_{0}".format(next(_cursor_names))
+        # Cursors only live inside a transaction, which pg8000 opens implicitly
+        c.execute("DECLARE {0} NO SCROLL CURSOR FOR {1}".format(name, sql), params)
+        while True:
+            c.execute("FETCH FORWARD {0} FROM {1}".format(int(fetch_size), name))
+            rows = c.fetchall()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+        c.execute("CLOSE {0}".format(name))
+        conn.rollback()
+    finally:
+        conn.close()
@@ -0,0 +1,308 @@
+"""
+Precomputed route weights and lengths between places, so the distance between two cities (or a trip's travel
+matrix) is a lookup instead of a search.
+
+The table is built offline (manage.py distance_table) with one Dijkstra sweep per city node, spread over forked
+worker processes like the batch routes.  It's either dense, an n x n matrix over every pair of places, or limited to a
+radius, in which case every place only has a row of the places within radius_meters of route length, stored in CSR
+form like the CompactGraph adjacency (the columns of row i are columns[row_offsets[i]:row_offsets[i+1]], sorted).
+Optionally the table also keeps the next hop of every route: the first place the route passes through (the target
+itself if it passes through none), which is enough to list every place on the way.
+
+The file is laid out like a graph file (see main/model/graph_file.py) and memory mapped when it's loaded, so a
+table bigger than memory only costs the pages that are actually looked at.
+"""
+import heapq
+import json
+import multiprocessing
+import os
+import threading
+import numpy as np
+from main.model.graph_file import allocate_sections, map_sections
+from main.model.search import INFINITY
+
+MAGIC = b"OTBPDIST"
+FORMAT_VERSION = 1
+READABLE_VERSIONS = (1,)
+
+# Set while the pool forks, see DistanceTable.build
+_sweep = None
+_fork_lock = threading.Lock()
+
+
+class PlaceSweep:
+    """What a worker needs to run the sweep from any place, see sweep_row"""
+
+    def __init__(self, compact, place_nodes, edge_meters, radius_meters):
+        self.compact = compact
+        self.place_nodes = place_nodes
+        self.edge_meters = edge_meters
+        self.radius_meters = radius_meters
+        # node index -> column of its place, -1 for the other nodes
+        self.column_of = np.full(compact.number_of_nodes(), -1, dtype=np.int64)
+        self.column_of[place_nodes] = np.arange(0, len(place_nodes))
+
+    def row(self, i):
+        """
+        A Dijkstra sweep from the node of place i, by weight, which stops once every place is settled (or, with a
+        radius, once nothing within the radius is left).  Route lengths only grow along a route, so a node whose
+        shortest route is longer than the radius is still expanded (a node behind it mustn't be reached another,
+        longer way) but never ends up in the row.
+        :param i: the place's column
+        :return: (columns, weights, meters, next hops) arrays of the places reached, sorted by column
+        """
+        compact = self.compact
+        offsets, targets, weights, edge_index = compact.offsets, compact.targets, compact.weights, compact.edge_index
+        radius = self.radius_meters if self.radius_meters is not None else INFINITY
+        source = int(self.place_nodes[i])
+
+        dist = {source: 0.0}
+        meters = {source: 0.0}
+        hop = {source: -1}
+        done = set()
+        found = []
+        remaining = len(self.place_nodes)
+        # Heap entries within the radius, once there are none left nothing else can end up in the row
+        inside = 1
+        heap = [(0.0, source, 0.0)]
+        while heap and remaining > 0 and inside > 0:
+            du, u, mu = heapq.heappop(heap)
+            if mu <= radius:
+                inside -= 1
+            if u in done:
+                continue
+            done.add(u)
+            column = self.column_of[u]
+            if column >= 0:
+                remaining -= 1
+                if mu <= radius:
+                    found.append((column, du, mu, hop[u]))
+
+            a, b = offsets[u], offsets[u + 1]
+            for v, w, e in zip(targets[a:b].tolist(), weights[a:b].tolist(), edge_index[a:b].tolist()):
+                nd = du + w
+                if nd < dist.get(v, INFINITY):
+                    dist[v] = nd
+                    meters[v] = mu + self.edge_meters[e]
+                    # The first place after the source, passed on to everything behind it
+                    hop[v] = hop[u] if hop[u] >= 0 else int(self.column_of[v])
+                    if meters[v] <= radius:
+                        inside += 1
+                    heapq.heappush(heap, (nd, v, meters[v]))
+
+        found.sort()
+        return (np.array([f[0] for f in found], dtype=np.int32),
+                np.array([f[1] for f in found], dtype=np.float32),
+                np.array([f[2] for f in found], dtype=np.float32),
+                np.array([f[3] for f in found], dtype=np.int32))
+
+
+def sweep_row(i):
+    """Runs PlaceSweep.row in a worker process, on the sweep inherited from the parent"""
+    return i, _sweep.row(i)
+
+
+class DistanceTable:
+    """
+    Route weights (what the searches minimize), lengths in meters and, optionally, next hops between places, looked
+    up by place gid
+    """
+
+    FILE_SUFFIX = ".distances"
+
+    def __init__(self, gids, weights, meters, next_hop=None, row_offsets=None, columns=None, radius_meters=None,
+                 graph_signature=None):
+        """
+        :param gids: the places, sorted
+        :param weights: n x n (flattened) for a dense table, one per entry of columns for a table with a radius
+        :param meters: like weights
+        :param next_hop: like weights, the column of the next place on the route, -1 where there is no route
+        :param row_offsets: where each place's entries start in columns, None for a dense table
+        :param columns: see row_offsets
+        :param radius_meters: the longest route in the table, None if every pair is
+        :param graph_signature: of the graph the table was built for, see ContractionHierarchy.graph_signature_of
+        """
+        self.gids = gids
+        self.weights = weights
+        self.meters = meters
+        self.next_hop = next_hop
+        self.row_offsets = row_offsets
+        self.columns = columns
+        self.radius_meters = radius_meters
+        self.graph_signature = tuple(graph_signature) if graph_signature is not None else None
+
+    def __len__(self):
+        return len(self.gids)
+
+    @property
+    def sparse(self):
+        return self.row_offsets is not None
+
+    def column_of(self, gid):
+        """
+        :return: the place's row and column in the table, None if it isn't in it
+        """
+        if not isinstance(gid, (int, np.integer)) or isinstance(gid, bool):
+            # Road intersections are named by their coordinates, only places are in the table
+            return None
+        i = int(np.searchsorted(self.gids, gid))
+        return i if i < len(self.gids) and self.gids[i] == gid else None
+
+    def __entry(self, i, j):
+        """
+        :return: where the route from column i to column j is in weights, meters and next_hop, None if the table
+                 doesn't have it
+        """
+        if not self.sparse:
+            return i * len(self.gids) + j
+        a, b = int(self.row_offsets[i]), int(self.row_offsets[i + 1])
+        k = a + int(np.searchsorted(self.columns[a:b], j))
+        return k if k < b and self.columns[k] == j else None
+
+    def lookup(self, source_gid, target_gid):
+        """
+        :return: (route weight, route length in meters), both infinite if there's no route (or, for a table with a
+                 radius, no route within the radius), None if either place isn't in the table
+        """
+        i, j = self.column_of(source_gid), self.column_of(target_gid)
+        if i is None or j is None:
+            return None
+        k = self.__entry(i, j)
+        if k is None:
+            return INFINITY, INFINITY
+        return float(self.weights[k]), float(self.meters[k])
+
+    def matrix(self, gids):
+        """
+        :param gids: places
+        :return: n x n array of route weights between them, like RoadGraph.travel_matrix, None if the table can't
+                 tell (a place isn't in it or, for a table with a radius, a pair is further apart than the radius)
+        """
+        columns = [self.column_of(gid) for gid in gids]
+        if any(c is None for c in columns):
+            return None
+
+        columns = np.array(columns, dtype=np.int64)
+        if not self.sparse:
+            return self.weights[(columns[:, None] * len(self.gids) + columns[None, :]).ravel()] \
+                .reshape(len(columns), len(columns)).astype(np.float64)
+
+        matrix = np.zeros((len(columns), len(columns)))
+        for a, i in enumerate(columns):
+            for b, j in enumerate(columns):
+                k = self.__entry(i, j)
+                if k is None:
+                    return None
+                matrix[a, b] = self.weights[k]
+        return matrix
+
+    def via(self, source_gid, target_gid):
+        """
+        :return: the gids of the places the route passes through, in order, between the two places (not including
+                 them), None if the table has no next hops or no route between them
+        :raises ValueError: if following the next hops never gets to the target
+        """
+        i, j = self.column_of(source_gid), self.column_of(target_gid)
+        if self.next_hop is None or i is None or j is None:
+            return None
+
+        places = []
+        if i == j:
+            return places
+        # A route passes through every place at most once, more hops than that means the next hops are broken
+        for _ in range(0, len(self.gids)):
+            k = self.__entry(i, j)
+            if k is None or self.next_hop[k] < 0:
+                return None
+            i = int(self.next_hop[k])
+            if i == j:
+                return places
+            places.append(int(self.gids[i]))
+        raise ValueError("The next hops from {0} to {1} go round in a loop".format(source_gid, target_gid))
+
+    @staticmethod
+    def build(compact, edge_meters, file_name, radius_meters=None, next_hop=False, processes=1, chunk_size=16):
+        """
+        Builds the table for every place in a graph and writes it, through a temporary file so a reader never sees
+        a partial table.  A dense table is written row by row as the sweeps finish.
+        :param compact: the graph, a CompactGraph
+        :param edge_meters: the length in meters of every edge of the graph
+        :param file_name:
+        :param radius_meters: only keep the routes up to this long, None keeps every pair
+        :param next_hop: also keep the next hops
+        :param processes: worker processes, 1 (or a platform without fork) runs the sweeps in this process
+        :param chunk_size: sweeps handed to a worker at a time
+        :return: the DistanceTable, read back from the file
+        """
+        global _sweep
+        place_nodes = np.nonzero(np.asarray(compact.place_gid) >= 0)[0]
+        gids = np.unique(np.asarray(compact.place_gid)[place_nodes])
+        # A place with several nodes is routed from (and to) the one index_of gives it
+        place_nodes = np.array([compact.index_of(int(gid)) for gid in gids], dtype=np.int64)
+        sweep = PlaceSweep(compact, place_nodes, np.asarray(edge_meters, dtype=np.float64), radius_meters)
+        n = len(gids)
+
+        if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with _fork_lock:
+                _sweep = sweep
+                pool = multiprocessing.get_context("fork").Pool(processes)
+                _sweep = None
+            rows = pool.imap_unordered(sweep_row, range(0, n), chunk_size)
+        else:
+            pool = None
+            rows = ((i, sweep.row(i)) for i in range(0, n))
+
+        meta = json.dumps({"radius_meters": radius_meters,
+                           "graph_signature": list(compact.signature())})
+        meta = np.frombuffer(meta.encode('utf-8'), dtype=np.uint8)
+        tmp_file_name = file_name + ".tmp"
+        try:
+            if radius_meters is None:
+                sections = [("gids", np.int64, n), ("meta", np.uint8, len(meta)),
+                            ("weights", np.float32, n * n), ("meters", np.float32, n * n)]
+                sections += [("next_hop", np.int32, n * n)] if next_hop else []
+                mm, arrays = allocate_sections(tmp_file_name, MAGIC, FORMAT_VERSION, sections)
+                arrays["gids"][:] = gids
+                arrays["meta"][:] = meta
+                for i, (columns, weights, meters, hops) in rows:
+                    row = slice(i * n, (i + 1) * n)
+                    arrays["weights"][row] = INFINITY
+                    arrays["weights"][row][columns] = weights
+                    arrays["meters"][row] = INFINITY
+                    arrays["meters"][row][columns] = meters
+                    if next_hop:
+                        arrays["next_hop"][row] = -1
+                        arrays["next_hop"][row][columns] = hops
+            else:
+                by_row = [None] * n
+                for i, result in rows:
+                    by_row[i] = result
+                counts = np.array([len(r[0]) for r in by_row], dtype=np.int64)
+                entries = int(counts.sum())
+                names = ["columns", "weights", "meters"] + (["next_hop"] if next_hop else [])
+                sections = [("gids", np.int64, n), ("meta", np.uint8, len(meta)), ("row_offsets", np.int64, n + 1)]
+                sections += [(name, by_row[0][k].dtype if n > 0 else np.float32, entries)
+                             for k, name in enumerate(names)]
+                mm, arrays = allocate_sections(tmp_file_name, MAGIC, FORMAT_VERSION, sections)
+                arrays["gids"][:] = gids
+                arrays["meta"][:] = meta
+                arrays["row_offsets"][:] = np.concatenate(([0], np.cumsum(counts)))
+                for k, name in enumerate(names):
+                    if n > 0:
+                        arrays[name][:] = np.concatenate([r[k] for r in by_row])
+            mm.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        os.replace(tmp_file_name, file_name)
+        return DistanceTable.load(file_name)
+
+    @staticmethod
+    def load(file_name):
+        _, arrays = map_sections(file_name, MAGIC, READABLE_VERSIONS, "distance table")
+        meta = json.loads(bytes(arrays["meta"]).decode('utf-8'))
+        return DistanceTable(arrays["gids"], arrays["weights"], arrays["meters"], arrays.get("next_hop"),
+                             arrays.get("row_offsets"), arrays.get("columns"), meta["radius_meters"],
+                             meta["graph_signature"])
@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+import numpy as np
+import shapely.wkb
+from main import DEFAULT_LOGGER
+
+
+class GeometryStore:
+    """
+    Edge geometries, kept out of the graph in their own file (graph_file + FILE_SUFFIX).
+
+    A search only needs edge weights, the geometry of an edge is only needed once it ends up on a route and gets
+    turned into a Step.  The file is memory mapped and each geometry is parsed from its WKB the first time it's asked
+    for, optionally keeping the most recently used ones around.
+
+    File layout: magic (8 bytes), version (uint32), geometry count (uint32), the graph_digest of the graph the
+    geometries belong to (40 bytes, hex), count + 1 offsets (int64) into the WKB blob that follows them.  A zero
+    length entry is an edge without a geometry.  Version 1 files have no digest.
+    """
+
+    FILE_SUFFIX = ".geom"
+    MAGIC = b"OTBPGEOM"
+    FORMAT_VERSION = 2
+    HEADER = struct.Struct("<8sII")
+    DIGEST = struct.Struct("<40s")
+
+    def __init__(self, file_name, cache_size=0, graph_digest=None):
+        """
+        :param file_name:
+        :param cache_size: how many parsed geometries to keep around
+        :param graph_digest: the digest of the graph the geometries have to belong to (see CompactGraph.signature),
+                             None doesn't check
+        """
+        self.file_name = file_name
+        self.graph_digest = graph_digest
+        with open(file_name, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = GeometryStore.HEADER.unpack_from(self._map, 0)
+        if magic != GeometryStore.MAGIC or version not in (1, GeometryStore.FORMAT_VERSION):
+            raise ValueError("{0} is not a version {1} geometry file".format(file_name, GeometryStore.FORMAT_VERSION))
+
+        offsets_start = GeometryStore.HEADER.size
+        if version == 1:
+            if graph_digest is not None:
+                DEFAULT_LOGGER.warning("{0} is a version 1 geometry file, it can't be checked against its graph"
+                                       .format(file_name))
+        else:
+            digest = GeometryStore.DIGEST.unpack_from(self._map, offsets_start)[0].decode('ascii')
+            offsets_start += GeometryStore.DIGEST.size
+            if graph_digest is not None and digest != graph_digest:
+                raise ValueError("{0} holds the geometries of another graph".format(file_name))
+
+        self.offsets = np.frombuffer(self._map, dtype='<i8', count=count + 1, offset=offsets_start)
+        self._blob_start = offsets_start + self.offsets.nbytes
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def write(geoms, file_name, graph_digest):
+        """
+        Writes the geometries in order, so geometry i of the file is geoms[i]
+        :param geoms: a sequence of shapely geometries (or None)
+        :param file_name:
+        :param graph_digest: of the graph the geometries belong to, see CompactGraph.signature
+        """
+        count = len(geoms)
+        offsets = np.zeros(count + 1, dtype='<i8')
+        tmp_file_name = file_name + ".tmp"
+        with open(tmp_file_name, 'wb') as f:
+            f.write(GeometryStore.HEADER.pack(GeometryStore.MAGIC, GeometryStore.FORMAT_VERSION, count))
+            f.write(GeometryStore.DIGEST.pack(graph_digest.encode('ascii')))
+            offsets_start = f.tell()
+            # Leave room for the offsets, they're filled in once the blob is written
+            f.write(offsets.tobytes())
+            for i in range(0, count):
+                g = geoms[i]
+                wkb = shapely.wkb.dumps(g) if g is not None else b""
+                f.write(wkb)
+                offsets[i + 1] = offsets[i] + len(wkb)
+            f.seek(offsets_start)
+            f.write(offsets.tobytes())
+        os.replace(tmp_file_name, file_name)
+
+    def __getstate__(self):
+        # The map can't be pickled, the file is mapped again on the other side
+        return {"file_name": self.file_name, "cache_size": self.cache_size, "graph_digest": self.graph_digest}
+
+    def __setstate__(self, state):
+        self.__init__(state["file_name"], state["cache_size"], state.get("graph_digest"))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.cache_size > 0:
+            with self._lock:
+                if i in self._cache:
+                    self.hits += 1
+                    self._cache.move_to_end(i)
+                    return self._cache[i]
+
+        self.misses += 1
+        a, b = self._blob_start + self.offsets[i], self._blob_start + self.offsets[i + 1]
+        geom = shapely.wkb.loads(self._map[a:b]) if b > a else None
+
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[i] = geom
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return geom
+
+    def stats(self):
+        return {
+            "geometries": len(self),
+            "cache_size": self.cache_size,
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses
+        }
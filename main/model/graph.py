@@ -1,9 +1,22 @@
 import networkx as nx
+import os
 import pickle
 import abc
 import uuid
+import numpy as np
+import shapely.ops
 from geopy import distance
-from main.model.places_dao import PlacesDAO
+from main import DEFAULT_LOGGER
+from main.config.config import graph_config, alternatives_config
+from main.model.place_catalog import place_catalog, PlaceCatalogError
+from main.model.search import NetworkXView, get_search_engine, dijkstra_to_many, INFINITY
+from main.model.contraction import ContractionHierarchy, ContractionHierarchyEngine
+from main.model.compact_graph import CompactGraph
+from main.model.spatial_index import NodeIndex
+from main.model.graph_file import is_graph_file, read_graph, write_graph
+from main.model.trip import order_stops
+from main.model.alternatives import via_node_alternatives
+from main.model.distance_table import DistanceTable
 
 
 class RoadGraph:
@@ -11,32 +24,232 @@ class RoadGraph:
     This class builds and encapuslates the road graph, and has methods
     to calculate routes within the graph."""
 
+    # Optional, loaded from the file next to the graph (see ContractionHierarchy), never pickled with the graph itself
+    contraction = None
+    # Set by freeze(), once frozen all queries go to the CompactGraph and the networkx graph is dropped
+    compact = None
+    # Built the first time nearest_node() is called, never pickled
+    node_index = None
+    # Optional, loaded from the file next to the graph (see DistanceTable), never pickled
+    distance_table = None
+
+    @staticmethod
+    def save_graph(self, graph_file_name):
+        """
+        Writes the graph in the binary graph file format (see main/model/graph_file.py), the networkx graph is
+        frozen into a CompactGraph on the way out.  The file is written to a temporary file and renamed into place,
+        a running web app watching this file (see GraphHolder) should never see a half written graph.
+        """
+        compact = self.compact if self.compact is not None else CompactGraph.from_networkx(self.graph)
+        write_graph(compact, graph_file_name)
+
     @staticmethod
-    def save_graph(self, pickle_file_name):
-        with open(pickle_file_name, 'wb') as pfile:
-            pickle.dump(self, pfile, protocol=pickle.HIGHEST_PROTOCOL)
+    def load_graph(graph_file_name):
+        """
+        Loads a graph written by save_graph, the file is memory mapped so this is nearly instant, and edge
+        geometries are only read for the edges that end up on a route.  Files written by older versions (pickled
+        RoadGraphs) are still read, see convert_graph for migrating them.
+        """
+        if is_graph_file(graph_file_name):
+            graph = RoadGraph()
+            graph.graph = None
+            graph.compact = read_graph(graph_file_name, graph_config["geometry_cache_size"])
+        else:
+            with open(graph_file_name, 'rb') as pfile:
+                graph = pickle.load(pfile)
+
+        ch_file_name = graph_file_name + ContractionHierarchy.FILE_SUFFIX
+        if isinstance(graph, RoadGraph) and os.path.exists(ch_file_name):
+            graph.set_contraction_hierarchy(ContractionHierarchy.load(ch_file_name))
+
+        table_file_name = graph_file_name + DistanceTable.FILE_SUFFIX
+        if isinstance(graph, RoadGraph) and os.path.exists(table_file_name):
+            graph.set_distance_table(DistanceTable.load(table_file_name))
+
+        return graph
 
     @staticmethod
-    def load_graph(pickle_file_name):
-        with open(pickle_file_name, 'rb') as pfile:
-            return pickle.load(pfile)
+    def convert_graph(pickle_file_name, graph_file_name):
+        """
+        Converts a pickled graph (and its contraction hierarchy, if there is one) to the binary graph file format
+        :param pickle_file_name:
+        :param graph_file_name:
+        :return: the converted RoadGraph
+        """
+        graph = RoadGraph.load_graph(pickle_file_name)
+        graph.freeze()
+        if graph.contraction is not None:
+            graph.contraction.save(graph_file_name + ContractionHierarchy.FILE_SUFFIX)
+        RoadGraph.save_graph(graph, graph_file_name)
+        return RoadGraph.load_graph(graph_file_name)
 
     def __init__(self, graph_file=None):
         if graph_file is None:
             self.graph = nx.Graph()
         else:
-            self.graph = RoadGraph.load_graph(graph_file).graph
+            loaded = RoadGraph.load_graph(graph_file)
+            self.graph = loaded.graph
+            self.compact = loaded.compact
+            self.contraction = loaded.contraction
+            self.distance_table = loaded.distance_table
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('contraction', None)
+        state.pop('node_index', None)
+        state.pop('distance_table', None)
+        return state
+
+    def view(self):
+        """
+        :return: the graph queries should run against, the CompactGraph if frozen, otherwise the networkx graph
+        """
+        return self.compact if self.compact is not None else NetworkXView(self.graph)
+
+    def freeze(self):
+        """
+        Converts the networkx graph into a (much smaller, read only) CompactGraph and drops the networkx graph.
+        :return: the CompactGraph
+        """
+        if self.compact is not None:
+            return self.compact
+
+        compact = CompactGraph.from_networkx(self.graph)
+        self.node_index = None
+        if self.contraction is not None and not self.contraction.indexed:
+            self.contraction = self.contraction.remap(compact.index_of)
+        self.compact = compact
+        self.graph = None
+        return compact
+
+    def build_contraction_hierarchy(self):
+        self.contraction = ContractionHierarchy.build(self.view())
+        return self.contraction
+
+    def set_contraction_hierarchy(self, hierarchy):
+        if hierarchy.graph_signature != ContractionHierarchy.graph_signature_of(self.view()):
+            DEFAULT_LOGGER.warning("Ignoring contraction hierarchy, it was built for a different graph")
+            return
+
+        if self.compact is None and hierarchy.indexed:
+            DEFAULT_LOGGER.warning("Ignoring contraction hierarchy, it was built for a frozen graph")
+            return
 
-    def shortest_route(self, source_id, target_id):
-        path = nx.shortest_path(self.graph, source_id, target_id)
+        if self.compact is not None and not hierarchy.indexed:
+            hierarchy = hierarchy.remap(self.compact.index_of)
+        self.contraction = hierarchy
+
+    def build_distance_table(self, file_name, radius_meters=None, next_hop=False, processes=1, chunk_size=16):
+        """
+        Precomputes the routes between every pair of places (see main/model/distance_table.py) and writes them to
+        file_name, the table is loaded with the graph when file_name is the graph's file name plus
+        DistanceTable.FILE_SUFFIX
+        :param file_name:
+        :param radius_meters: only keep the routes up to this long, None keeps every pair
+        :param next_hop: also keep the next place on every route
+        :param processes: worker processes running the sweeps
+        :param chunk_size: sweeps handed to a worker at a time
+        :return: the DistanceTable
+        """
+        compact = self.compact if self.compact is not None else CompactGraph.from_networkx(self.graph)
+        edge_meters = np.array([geodesic_length_meters(compact.edge_geoms[e])
+                                for e in range(0, compact.number_of_edges())], dtype=np.float64)
+        self.distance_table = DistanceTable.build(compact, edge_meters, file_name, radius_meters, next_hop,
+                                                  processes, chunk_size)
+        return self.distance_table
+
+    def set_distance_table(self, table):
+        if table.graph_signature != ContractionHierarchy.graph_signature_of(self.view()):
+            DEFAULT_LOGGER.warning("Ignoring distance table, it was built for a different graph")
+            return
+        self.distance_table = table
+
+    def search_engine(self, name=None):
+        """
+        :param name: the engine name, defaults to graph_config["search_engine"]
+        :return: a SearchEngine, "ch" falls back to A* if this graph has no contraction hierarchy
+        """
+        name = name if name is not None else graph_config["search_engine"]
+        if name == ContractionHierarchyEngine.name:
+            if self.contraction is not None:
+                return ContractionHierarchyEngine(self.contraction)
+            DEFAULT_LOGGER.warning("No contraction hierarchy loaded, falling back to A*")
+            name = "astar"
+        return get_search_engine(name)
+
+    def nearest_node(self, lat, lon):
+        """
+        Snaps a point to the graph
+        :param lat:
+        :param lon:
+        :return: (node id, distance to it in meters) of the node nearest to the point
+        """
+        if self.node_index is None:
+            self.node_index = NodeIndex.from_view(self.view(), graph_config["spatial_index_cell_degrees"])
+        node, distance_meters = self.node_index.nearest(lat, lon)
+        if node is None:
+            raise nx.NodeNotFound("The graph is empty")
+        return self.view().key(node), distance_meters
+
+    @staticmethod
+    def node_name(node_id, node_data):
+        """
+        :return: the name of the place for a city node (its id if the place can't be found), its coordinates for a
+                 road intersection
+        """
+        if isinstance(node_id, int):
+            try:
+                name = place_catalog.get_place_name_by_id(node_id)
+            except PlaceCatalogError as e:
+                DEFAULT_LOGGER.warning("Could not name place {0}: {1}".format(node_id, str(e)))
+                name = None
+            return name if name is not None else str(node_id)
+        return "{0:.5f}, {1:.5f}".format(node_data['lat'], node_data['lon'])
+
+    def shortest_route(self, source_id, target_id, engine=None):
+        """
+        Calculates the shortest weighted route between two nodes
+        :param source_id:
+        :param target_id:
+        :param engine: a SearchEngine, defaults to search_engine()
+        :return: a Route, its settled_nodes attribute is the number of nodes the search had to settle
+        """
+        if engine is None:
+            engine = self.search_engine()
+
+        view = self.view()
+        source, target = view.index_of(source_id), view.index_of(target_id)
+        for node_id, node in ((source_id, source), (target_id, target)):
+            if node is None:
+                raise nx.NodeNotFound("Node {0} is not in the graph".format(node_id))
+
+        result = engine.search(view, source, target)
+        DEFAULT_LOGGER.debug("{0} search from {1} to {2} settled {3} nodes"
+                             .format(engine.name, source_id, target_id, result.settled))
+
+        route = RoadGraph.__build_route(view, result.path,
+                                        RoadGraph.node_name(source_id, view.node_data(result.path[0])) + " to " +
+                                        RoadGraph.node_name(target_id, view.node_data(result.path[-1])))
+        route.settled_nodes = result.settled
+        return route
+
+    @staticmethod
+    def __build_route(view, path, name):
+        """
+        :param view: the view the path was found in
+        :param path: the nodes of the route (as the view numbers them)
+        :param name: the route's name
+        :return: a Route with a Step per node of the path
+        """
         route_id = str(uuid.uuid4())
+        first = view.node_data(path[0])
         route = Route(route_id,
-                      self.graph.node[path[0]]['lat'],
-                      self.graph.node[path[0]]['lon'],
-                      PlacesDAO.get_place_name_by_id(source_id) + " to " + PlacesDAO.get_place_name_by_id(target_id))
+                      first['lat'],
+                      first['lon'],
+                      name)
 
         for i in range(0, len(path)):
-            n = self.graph.node[path[i]]
+            n = view.node_data(path[i])
             if i+1 == len(path):
                 # this is the final step in the path, so there is no next edge
                 route.steps.append(Step(
@@ -49,7 +262,7 @@ class RoadGraph:
                     n['city_name'] if 'city_name' in n else None,
                 ))
             else:
-                next_road = self.graph.get_edge_data(path[i], path[i+1])
+                next_road = view.edge_data(path[i], path[i+1])
                 route.steps.append(Step(
                     route_id,
                     i,
@@ -62,6 +275,179 @@ class RoadGraph:
 
         return route
 
+    def alternative_routes(self, source_id, target_id, count=None, max_stretch=None, max_overlap=None):
+        """
+        Calculates the shortest route and up to count - 1 reasonably different alternatives to it (see
+        main/model/alternatives.py), the limits default to alternatives_config
+        :param source_id:
+        :param target_id:
+        :param count: the most routes to return
+        :param max_stretch: how much longer than the shortest route an alternative may be
+        :param max_overlap: the largest part of an alternative it may share with a route already chosen
+        :return: a list of Routes, the shortest first
+        """
+        count = count if count is not None else alternatives_config["count"]
+        max_stretch = max_stretch if max_stretch is not None else alternatives_config["max_stretch"]
+        max_overlap = max_overlap if max_overlap is not None else alternatives_config["max_overlap"]
+
+        view = self.view()
+        source, target = view.index_of(source_id), view.index_of(target_id)
+        for node_id, node in ((source_id, source), (target_id, target)):
+            if node is None:
+                raise nx.NodeNotFound("Node {0} is not in the graph".format(node_id))
+
+        paths, settled = via_node_alternatives(view, source, target, count, max_stretch, max_overlap)
+        if len(paths) == 0:
+            raise nx.NetworkXNoPath("No path between {0} and {1}".format(source_id, target_id))
+
+        name = RoadGraph.node_name(source_id, view.node_data(source)) + " to " + \
+            RoadGraph.node_name(target_id, view.node_data(target))
+        routes = []
+        for i, path in enumerate(paths):
+            route = RoadGraph.__build_route(view, path, name if i == 0 else name + " (alternative {0})".format(i))
+            route.settled_nodes = settled
+            routes.append(route)
+        return routes
+
+    def place_distance(self, source_id, target_id):
+        """
+        The route between two nodes without building the Route, looked up in the distance table when it has the
+        pair, otherwise searched for
+        :param source_id:
+        :param target_id:
+        :return: (route weight, route length in meters, the place gids the route passes through in between or None
+                 if the distance table doesn't keep them)
+        """
+        table = self.distance_table
+        found = table.lookup(source_id, target_id) if table is not None else None
+        if found is not None and (found[0] < INFINITY or not table.sparse):
+            if found[0] == INFINITY:
+                raise nx.NetworkXNoPath("No path between {0} and {1}".format(source_id, target_id))
+            return found[0], found[1], table.via(source_id, target_id)
+
+        view = self.view()
+        source, target = view.index_of(source_id), view.index_of(target_id)
+        for node_id, node in ((source_id, source), (target_id, target)):
+            if node is None:
+                raise nx.NodeNotFound("Node {0} is not in the graph".format(node_id))
+
+        result = self.search_engine().search(view, source, target)
+        meters = sum(geodesic_length_meters(view.edge_data(u, v)['geom'])
+                     for u, v in zip(result.path, result.path[1:]))
+        places = [view.key(n) for n in result.path[1:-1] if isinstance(view.key(n), int)]
+        return result.distance, meters, places
+
+    def travel_matrix(self, node_ids):
+        """
+        Calculates the route weights between every pair of nodes with one Dijkstra sweep per node (see
+        dijkstra_to_many), rather than a search per pair
+        :param node_ids:
+        :return: (n x n array of route weights, infinite where there's no route, a ShortestPathTree per node)
+        """
+        view = self.view()
+        nodes = []
+        for node_id in node_ids:
+            node = view.index_of(node_id)
+            if node is None:
+                raise nx.NodeNotFound("Node {0} is not in the graph".format(node_id))
+            nodes.append(node)
+
+        matrix = np.full((len(nodes), len(nodes)), INFINITY)
+        trees = []
+        for i, source in enumerate(nodes):
+            tree = dijkstra_to_many(view, source, nodes)
+            trees.append(tree)
+            for j, target in enumerate(nodes):
+                matrix[i, j] = tree.distance_to(target)
+        return matrix, trees
+
+    def trip_route(self, node_ids, optimize=False):
+        """
+        Calculates a trip through several nodes as one Route, its legs stitched end to end
+        :param node_ids: the stops, in the order they're given
+        :param optimize: visit the stops in between the first and the last in the order making the trip shortest
+                         (see main/model/trip.py)
+        :return: a Route, its stops attribute is the node ids in the order they're visited and settled_nodes the
+                 number of nodes the searches settled
+        """
+        if len(node_ids) < 2:
+            raise nx.NetworkXException("A trip needs at least two stops")
+
+        view = self.view()
+        # With a distance table covering the stops only the legs of the trip are searched for, not the whole matrix
+        matrix = self.distance_table.matrix(node_ids) if self.distance_table is not None else None
+        trees = None
+        if matrix is None:
+            matrix, trees = self.travel_matrix(node_ids)
+
+        order = order_stops(matrix) if optimize else list(range(0, len(node_ids)))
+        for a, b in zip(order, order[1:]):
+            if matrix[a, b] == INFINITY:
+                raise nx.NetworkXNoPath("No path between {0} and {1}".format(node_ids[a], node_ids[b]))
+
+        if trees is not None:
+            nodes = [t.source for t in trees]
+            legs = [trees[a].path_to(nodes[b]) for a, b in zip(order, order[1:])]
+            settled = sum(t.settled for t in trees)
+        else:
+            nodes = [view.index_of(node_id) for node_id in node_ids]
+            engine = self.search_engine()
+            results = [engine.search(view, nodes[a], nodes[b]) for a, b in zip(order, order[1:])]
+            legs = [r.path for r in results]
+            settled = sum(r.settled for r in results)
+
+        path = [nodes[order[0]]]
+        for leg in legs:
+            # Every leg starts where the previous one ended
+            path.extend(leg[1:])
+
+        stops = [node_ids[i] for i in order]
+        route = RoadGraph.__build_route(view, path, " to ".join(
+            RoadGraph.node_name(node_id, view.node_data(nodes[i])) for node_id, i in zip(stops, order)))
+        route.stops = stops
+        route.settled_nodes = settled
+        return route
+
+
+# The ellipsoid gis.user_routes lengths have always been measured on (ST_Length(geom, true) uses the spheroid)
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+
+def geodesic_length_meters(geom):
+    """
+    Length of a line measured on the ellipsoid, the same value ST_Length(geom, true) gives for it.
+
+    Each segment is measured with Lambert's formula, vectorized over the whole line.  For the short segments roads
+    are made of it agrees with an exact geodesic to within a few parts per million, at a tiny fraction of the cost
+    of solving the inverse problem once per segment.
+    :param geom: a LineString or MultiLineString in lon/lat
+    :return: the length in meters
+    """
+    if geom is None or geom.is_empty:
+        return 0.0
+    if hasattr(geom, 'geoms'):
+        return sum(geodesic_length_meters(g) for g in geom.geoms)
+
+    coords = np.asarray(geom.coords)
+    if len(coords) < 2:
+        return 0.0
+
+    # Reduced latitudes
+    b = np.arctan((1 - WGS84_F) * np.tan(np.radians(coords[:, 1])))
+    b1, b2 = b[:-1], b[1:]
+    dl = np.radians(np.diff(coords[:, 0]))
+    h = np.sin((b2 - b1) / 2) ** 2 + np.cos(b1) * np.cos(b2) * np.sin(dl / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+    p = np.sin((b1 + b2) / 2) ** 2
+    q = np.sin((b2 - b1) / 2) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - np.sin(sigma)) * p * (1 - q) / np.cos(sigma / 2) ** 2
+        y = (sigma + np.sin(sigma)) * (1 - p) * q / np.sin(sigma / 2) ** 2
+        lengths = WGS84_A * (sigma - WGS84_F / 2 * (x + y))
+    return float(np.sum(np.where(sigma > 0, lengths, 0.0)))
+
 
 class AbstractRoute:
     __metaclass__ = abc.ABCMeta
@@ -94,6 +480,30 @@ class Route(AbstractRoute):
     def __init__(self, rid, start_lat, start_lon, r_name):
         AbstractRoute.__init__(self, rid, start_lat, start_lon, r_name, None)
         self.steps = []
+        self.settled_nodes = None
+
+    def decorate(self):
+        """
+        Fills in the values that used to be calculated by the database when the route was inserted: the length,
+        centroid and bounding box of every step, and for the route itself the total length, the centroid and
+        bounding box of all of the steps and the steps merged into a single line.
+        """
+        geoms = []
+        for step in self.steps:
+            if step.geom is None:
+                continue
+            step.distance_meters = geodesic_length_meters(step.geom)
+            step.geom_centroid = step.geom.centroid
+            step.geom_bbox = step.geom.envelope
+            geoms.append(step.geom)
+
+        self.distance_meters = sum(s.distance_meters for s in self.steps)
+        if len(geoms) > 0:
+            union = shapely.ops.unary_union(geoms)
+            self.geom_centroid = union.centroid
+            self.geom_bbox = union.envelope
+            self.geom = shapely.ops.linemerge([g for g in geoms if g.geom_type == 'LineString'])
+        return self
 
     def __str__(self):
         return str(self.__dict__)
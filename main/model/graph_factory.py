@@ -1,158 +1,206 @@
+import hashlib
 import pickle
 import os
 import uuid
-import math
-import shapely.wkt
 import multiprocessing
-import time
-from shapely.geometry import Point, LineString
+import numpy as np
+from shapely.geometry import Point
 from collections import defaultdict
 from main import DEFAULT_LOGGER
-from main.model import get_connection, get_node_name_from_location
+from main.model import get_node_name_from_location
 from main.model.graph import RoadGraph
-from main.model.roads_dao import RoadsDAO
+from main.model.contraction import ContractionHierarchy
+from main.model.compact_graph import CompactGraphBuilder
+from main.model.linear_ref import RoadGeometry
+from main.model.roads_dao import RoadsDAO, STATE_ROADS_SQL
+from main.model.places_dao import PlacesDAO
+from main.model.tiger_files import read_roads, read_places, find_road_intersections, find_place_intersections
 from main.config.config import graph_factory_config
 
 
-def calc_geom(work_array, percent_complete, result_queue):
-    """
-    This function is used to calculate the geometry between a position and destination, given that they are both on
-    an edge.  It is used by the Graph Creation process, its outside the GraphFactory class so it can be serialized and
-    run in parallel.
-
-    it takes an array of work (since its run in a process we want to limit the amount of serialization), each entry of
-    the work array is a hash map, something like:
-        work_unit = {
-            "id": id,
-            "p1": Point(n1['lon'], n1['lat']),
-            "road": road,
-            "p2": Point(n2['lon'], n2['lat']),
-            "geom": roads_tbl[str(road)]["geom"]
-        }
-    :param work_array:
-    :param percent_complete:
-    :param result_queue:
-    :return:
-    """
+# Set by GraphFactory.construct_graph before the worker pool is started, forked workers inherit them so only road ids
+# have to be sent to them.  road id -> road geometry and road id -> [(edge id, (lon, lat), (lon, lat))]
+_road_geoms = {}
+_road_edges = {}
 
-    results_map = {}
 
-    def get_line_index(line, position, index):
-        if index[0] == index[1]:
-            return index[0]
+def _init_worker(road_geoms, road_edges):
+    """Pool initializer for platforms that can't fork, where the road data has to be sent to each worker once"""
+    global _road_geoms, _road_edges
+    _road_geoms, _road_edges = road_geoms, road_edges
 
-        if index[1] - index[0] == 1:
-            p = index[0] if Point(line.coords[index[0]]).distance(position) < Point(line.coords[index[1]]).distance(position) else index[1]
-            return p
 
-        pivot_point = math.floor((index[1] - index[0])/2) + index[0]
-        i1 = (index[0], pivot_point)
-        i2 = (pivot_point+1, index[1])
-
-        if i1[0] != i1[1] and LineString(line.coords[i1[0]:i1[1]+1]).intersects(position):
-            return get_line_index(line, position, i1)
-        else:
-            return get_line_index(line, position, i2)
+def calc_geom(roads):
+    """
+    This function is used to calculate the geometry of the edges between nodes on the same road.  It is used by the
+    Graph Creation process, its outside the GraphFactory class so it can be run in a worker process.
 
+    All of a road's nodes are projected onto it at once and the edges cut out of it (see main/model/linear_ref.py).
+    :param roads: a chunk of road ids, their geometries and edges are looked up in _road_geoms and _road_edges
+    :return: (number of edges processed, [(edge id, geometry)]), edges whose nodes aren't on the same line of the road
+             are left out
+    """
+    tolerance = graph_factory_config["snap_tolerance_degrees"]
+    results = []
     processed = 0
-    for w in work_array:
+    for road in roads:
+        edges = _road_edges[road]
+        processed += len(edges)
         try:
-            wid, position, edge_id, destination, geom = [w["id"], w["p1"], w["road"], w["p2"], w["geom"]]
+            point_index = {}
+            pairs = []
+            for _, p1, p2 in edges:
+                pairs.append((point_index.setdefault(p1, len(point_index)),
+                              point_index.setdefault(p2, len(point_index))))
 
-            for i in range(0, len(geom)):
-                line = geom[i]
-                if line.intersects(position) and line.intersects(destination):
-                    op = get_line_index(line, position, (0, len(line.coords)-1))
-                    dp = get_line_index(line, destination, (0, len(line.coords)-1))
+            cuts = RoadGeometry(_road_geoms[road]).cut(pairs, list(point_index), tolerance)
+            for (edge_id, _, _), pair in zip(edges, pairs):
+                if pair in cuts:
+                    results.append((edge_id, cuts[pair]))
 
-                    begin, end = (op, dp) if op < dp else (dp, op)
+        except Exception as e:
+            print("There was a problem ", e)
 
-                    if begin == end:
-                        results_map[wid] = None
-                        break
+    return processed, results
 
-                    results_map[wid] = LineString(line.coords[begin:end+1])
-            processed += 1
-            percent_complete.value = processed / len(work_array) * 100.0
 
-        except Exception as e:
-            print("There was a problem ", e)
-            continue
+def chunk_roads(road_edges, chunk_edges):
+    """
+    Groups roads into chunks of about chunk_edges edges, so every task sent to a worker is about the same amount of
+    work however the edges are spread over the roads.
+    """
+    chunk, size = [], 0
+    for road, edges in road_edges.items():
+        chunk.append(road)
+        size += len(edges)
+        if size >= chunk_edges:
+            yield chunk
+            chunk, size = [], 0
+    if len(chunk) > 0:
+        yield chunk
+
+
+def node_name(node):
+    """The name a node from GraphFactory.__gather_road_data gets in the graph"""
+    return str(node['lat']) + "," + str(node['lon']) if "city_name" not in node else node["id"]
+
 
-    result_queue.put(results_map)
-    percent_complete.value = 100
-    return None
+def order_nodes_along_road(geom, nodes, tolerance=1e-9):
+    """
+    Sorts the nodes on a road by how far along the road they are (linear referencing).
+    :param geom: the road, a LineString or MultiLineString
+    :param nodes: the nodes on the road, dicts with lat and lon
+    :param tolerance: how far (in degrees) a node can be from a line and still count as being on it
+    :return: for each line of the road, the distinct nodes on it in order, only nodes next to each other in a list
+             need an edge between them
+    """
+    distinct = {}
+    for n in nodes:
+        distinct.setdefault(node_name(n), n)
+    distinct = list(distinct.values())
+
+    if geom is None:
+        # Nothing to order them by, keep the order they were found in
+        return [distinct]
+
+    measures = RoadGeometry(geom).project([(n['lon'], n['lat']) for n in distinct], tolerance)
+    runs = []
+    for line in range(0, measures.shape[1]):
+        on_line = np.nonzero(~np.isnan(measures[:, line]))[0]
+        if len(on_line) > 1:
+            order = on_line[np.argsort(measures[on_line, line], kind='stable')]
+            runs.append([distinct[i] for i in order])
+    return runs
 
 
 class GraphFactory:
+    # Part of every shard's input hash, bump it whenever a change to the factory changes the graphs it builds
+    SHARD_FORMAT_VERSION = 1
+
     @staticmethod
-    def __gather_road_data():
-        if os.path.exists("roads_info.pickle") and os.path.exists("roads_to_nodes.pickle"):
+    def __gather_road_data(statefp=None):
+        """
+        :param statefp: only gather the roads of one state (the intersections on them, including the ones with roads
+                        of neighbouring states, and the places on them).  The full data set is cached in
+                        roads_info.pickle and roads_to_nodes.pickle, a state's data isn't.
+        :return: (road id -> {"id", "name"}, road id -> the nodes on the road)
+        """
+        if statefp is None and os.path.exists("roads_info.pickle") and os.path.exists("roads_to_nodes.pickle"):
             DEFAULT_LOGGER.info("roads_to_nodes.pickle and roads_info.pickle were found, "
                                 "loading data from these two files")
             return RoadGraph.load_graph("roads_info.pickle"), RoadGraph.load_graph("roads_to_nodes.pickle")
 
+        fetch_size = graph_factory_config["fetch_size"]
+        # An intersection with a road of another state is a node of both states' shards, but only the roads of the
+        # state being built get it
+        state_roads = {int(r) for r in RoadsDAO.get_state_road_ids(statefp)} if statefp is not None else None
+
+        # Both tables are streamed through server side cursors, so only fetch_size rows are held at once
+        places = PlacesDAO.iter_place_intersections(fetch_size) if statefp is None else \
+            PlacesDAO.iter_place_intersections(fetch_size, STATE_ROADS_SQL, (statefp,))
+        roads_info, roads_to_nodes = GraphFactory.__collect_road_data(
+            RoadsDAO.iter_road_intersections(fetch_size, statefp), places, state_roads)
+
+        if statefp is None:
+            # Write out these results to disk
+            for ftuple in (("roads_info.pickle", roads_info), ("roads_to_nodes.pickle", roads_to_nodes)):
+                with open(ftuple[0], 'wb') as pfile:
+                    pickle.dump(ftuple[1], pfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return roads_info, roads_to_nodes
+
+    @staticmethod
+    def __collect_road_data(road_intersections, place_intersections, roads=None):
+        """
+        :param road_intersections: (r1id, r1name, r2id, r2name, lat, lon) rows, see RoadsDAO.iter_road_intersections
+        :param place_intersections: (gid, name, linearid, lat, lon) rows, see PlacesDAO.iter_place_intersections
+        :param roads: only these road ids get nodes, None for all of them
+        :return: see __gather_road_data
+        """
         roads_info = {}
         roads_to_nodes = defaultdict(list)
-        conn = get_connection()
-        c = conn.cursor()
-
-        for i in range(0, 100000000, 100000):
-            DEFAULT_LOGGER.info("Gathering road information OFFSET {0}".format(str(i)))
-            c.execute("SELECT * FROM gis.roads_intersection ORDER BY r1id, r2id LIMIT 100000 OFFSET {0}".format(str(i)))
-            results = c.fetchall()
-            have_results = False
-            for row in results:
-                have_results = True
-                r1id, r1name, r2id, r2name, intersection_point, r1len, r2len, geom = row
-                r1id = int(r1id)
-                r2id = int(r2id)
-
-                roads_info[r1id] = {"id": r1id, "name": r1name}
-                roads_info[r2id] = {"id": r2id, "name": r2name}
-
-                p = shapely.wkt.loads(intersection_point)
-
-                node = {"id": get_node_name_from_location(p),
-                        "lat": p.y,
-                        "lon": p.x}
-                roads_to_nodes[r1id].append(node)
-                roads_to_nodes[r2id].append(node)
-
-            if not have_results:
-                break
-
-        DEFAULT_LOGGER.info("Gathering places information".format(str(i)))
-        c.execute("SELECT * FROM gis.places_intersection".format(str(i)))
-        results = c.fetchall()
-        for row in results:
-            gid, name, rid, location = row
-
-            p = shapely.wkt.loads(location)
+
+        DEFAULT_LOGGER.info("Gathering road information")
+        rows = 0
+        for r1id, r1name, r2id, r2name, lat, lon in road_intersections:
+            r1id = int(r1id)
+            r2id = int(r2id)
+
+            node = {"id": get_node_name_from_location(Point(lon, lat)),
+                    "lat": lat,
+                    "lon": lon}
+            for rid, rname in ((r1id, r1name), (r2id, r2name)):
+                if roads is None or rid in roads:
+                    roads_info[rid] = {"id": rid, "name": rname}
+                    roads_to_nodes[rid].append(node)
+
+            rows += 1
+            if rows % 100000 == 0:
+                DEFAULT_LOGGER.info("Gathered {0} road intersections".format(rows))
+
+        DEFAULT_LOGGER.info("Gathering places information")
+        for gid, name, rid, lat, lon in place_intersections:
             # Create a city node, similar to an intersection node, but with different tags (namely a "city_name")
             roads_to_nodes[int(rid)].append({"id": gid,
                                              "city_name": name,
-                                             "lat": p.y,
-                                             "lon": p.x})
-
-        # Write out these results to disk
-        for ftuple in (("roads_info.pickle", roads_info), ("roads_to_nodes.pickle", roads_to_nodes)):
-            with open(ftuple[0], 'wb') as pfile:
-                pickle.dump(ftuple[1], pfile, protocol=pickle.HIGHEST_PROTOCOL)
+                                             "lat": lat,
+                                             "lon": lon})
 
         return roads_info, roads_to_nodes
 
     @staticmethod
-    def construct_graph(pickle_file_name):
-        roads_info, roads_to_nodes = GraphFactory.__gather_road_data()
+    def __add_roads(graph, roads_info, roads_to_nodes, roads_tbl):
+        """
+        Adds the nodes on every road, and the edges between them, to graph
+        :param graph: a networkx graph or a CompactGraphBuilder
+        :param roads_info: see __gather_road_data
+        :param roads_to_nodes: see __gather_road_data
+        :param roads_tbl: see RoadsDAO.get_road_hashmap
+        """
         # Now we start actually building the graph.  If a road has multiple nodes attached to it,
         # that means those nodes are connected.  We will use the road's length as the weight of that connection.
         # This isn't always strictly correct, but it should be close enough.
 
-        r = RoadGraph()
-        graph = r.graph
-        roads_tbl = RoadsDAO.get_road_hashmap()
-
         def calculate_weight(road_edge, geom_subset):
             if geom_subset is None:
                 return None
@@ -161,116 +209,248 @@ class GraphFactory:
             weight_modifier = 1 if roads_tbl[str(road_edge)]["type"] != "I" else 5
             return geom_subset.length * weight_modifier
 
-        graph_edges = []
-        worker_count = graph_factory_config["number_of_processors"]
-        work_buckets = []
-        worker_status = []
-        for i in range(0, worker_count):
-            work_buckets.append([])
-            worker_status.append(multiprocessing.Value('d', 0.0))
-        id_to_geom = {}
+        # edge id -> what's needed to add the edge once its geometry is known
+        graph_edges = {}
+        road_edges = defaultdict(list)
 
         nodes_processed = 0
+        all_pairs_edges = 0
         for road in roads_to_nodes:
-            for i in range(0, len(roads_to_nodes[road])-1):
-                for j in range(i+1, len(roads_to_nodes[road])):
+            runs = order_nodes_along_road(roads_tbl[str(road)]["geom"], roads_to_nodes[road],
+                                          graph_factory_config["snap_tolerance_degrees"])
+            k = len({node_name(n) for n in roads_to_nodes[road]})
+            all_pairs_edges += k * (k - 1) // 2
+
+            # Only nodes next to each other along the road are connected, the edges between nodes further apart
+            # would just be the sum of the edges in between them
+            for run in runs:
+                for i in range(0, len(run)-1):
                     id = str(uuid.uuid4())
-                    assigned_worker = nodes_processed % worker_count
-
-                    n1 = roads_to_nodes[road][i]
-                    n2 = roads_to_nodes[road][j]
-                    n1_name = str(n1['lat']) + "," + str(n1['lon']) if "city_name" not in n1 else n1["id"]
-                    n2_name = str(n2['lat']) + "," + str(n2['lon']) if "city_name" not in n2 else n2["id"]
 
-                    if n1_name == n2_name:
-                        continue
+                    n1 = run[i]
+                    n2 = run[i+1]
+                    n1_name = node_name(n1)
+                    n2_name = node_name(n2)
 
                     if n1_name not in graph:
-                        graph.add_node(n1_name, attr_dict=n1)
+                        graph.add_node(n1_name, **n1)
                     if n2_name not in graph:
-                        graph.add_node(n2_name, attr_dict=n2)
-
-                    work_unit = {
-                        "id": id,
-                        "p1": Point(n1['lon'], n1['lat']),
-                        "road": road,
-                        "p2": Point(n2['lon'], n2['lat']),
-                        "geom": roads_tbl[str(road)]["geom"]
-                    }
-                    work_buckets[assigned_worker].append(work_unit)
+                        graph.add_node(n2_name, **n2)
 
-                    graph_edges.append({
+                    road_edges[road].append((id, (n1['lon'], n1['lat']), (n2['lon'], n2['lat'])))
+                    graph_edges[id] = {
                         "n1_name": n1_name,
                         "n2_name": n2_name,
-                        "id": id,
                         "db_id": road,
                         "name": roads_info[road]["name"]
-                    })
+                    }
 
             print('\rConstructing Graph (Creating work units): {0:.2f}%'
                   .format(nodes_processed/len(roads_to_nodes) * 100), end="")
             nodes_processed += 1
 
         print("")
-        for i in range(0, len(work_buckets)):
-            print("Work bucket " + str(i) + " Size " + str(len(work_buckets[i])))
-
-        print("Total Graph Edges to be calculated: " + str(len(graph_edges)))
+        DEFAULT_LOGGER.info("Edges between consecutive nodes: {0}, edges between all pairs of nodes on a road would "
+                            "have been {1} ({2:.1f}x)".format(len(graph_edges), all_pairs_edges,
+                                                           all_pairs_edges / max(1, len(graph_edges))))
+        total_edges = len(graph_edges)
+
+        # The workers only get chunks of road ids.  With fork they share the road geometries and edges with this
+        # process, otherwise they're sent to each worker once, when it starts.
+        global _road_geoms, _road_edges
+        _road_geoms = {road: roads_tbl[str(road)]["geom"] for road in road_edges}
+        _road_edges = road_edges
+        if "fork" in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context("fork").Pool(graph_factory_config["number_of_processors"])
+        else:
+            pool = multiprocessing.Pool(graph_factory_config["number_of_processors"],
+                                        initializer=_init_worker, initargs=(_road_geoms, _road_edges))
 
-        # Lets start the work processors
-        answer_queues = [multiprocessing.SimpleQueue() for i in range(0, worker_count)]
-        processors = [multiprocessing.Process(target=calc_geom,
-                                              args=(work_buckets[i], worker_status[i], answer_queues[i],))
-                      for i in range(0, worker_count)]
+        # Edges are added as their geometries come back, in the same order every time (imap rather than
+        # imap_unordered) so building the same data always gives the same graph file
+        processed = 0
+        added = 0
+        try:
+            for chunk_processed, results in pool.imap(calc_geom, chunk_roads(road_edges,
+                                                                             graph_factory_config["chunk_edges"])):
+                processed += chunk_processed
+                for id, geom in results:
+                    g = graph_edges.pop(id)
+                    graph.add_edge(
+                            g["n1_name"],
+                            g["n2_name"],
+                            id=id,
+                            db_id=g["db_id"],
+                            name=g["name"],
+                            weight=calculate_weight(g["db_id"], geom),
+                            geom=geom)
+                    added += 1
+
+                print('\rComputing Geometries: {0:.2f}%'.format(processed / max(1, total_edges) * 100), end="")
+        finally:
+            pool.close()
+            pool.join()
+            _road_geoms, _road_edges = {}, {}
 
-        for p in processors:
-            p.start()
+        print("")
+        print("Missing " + str(total_edges - added))
 
-        while any(s.value != 100 for s in worker_status):
-            time.sleep(10)
-            output_str = '\rComputing Geometries '
-            for i in range(0, len(worker_status)):
-                output_str += 'p' + str(i) + " {0:.2f}%\t".format(worker_status[i].value)
-            print(output_str, end="")
+    @staticmethod
+    def __save(r, graph_file_name, contraction_hierarchy):
+        if contraction_hierarchy:
+            # Written before the graph, so anything watching the graph file picks up both
+            r.build_contraction_hierarchy().save(graph_file_name + ContractionHierarchy.FILE_SUFFIX)
+        RoadGraph.save_graph(r, graph_file_name)
 
-        for aq in answer_queues:
-            while not aq.empty():
-                id_to_geom.update(aq.get())
+    @staticmethod
+    def construct_graph(graph_file_name, contraction_hierarchy=False, compact=False):
+        """
+        Builds the road graph and saves it to graph_file_name
+        :param graph_file_name:
+        :param contraction_hierarchy: also build a contraction hierarchy, saved next to the graph
+        :param compact: fill a CompactGraphBuilder directly instead of building a networkx graph first
+        :return: the RoadGraph
+        """
+        roads_info, roads_to_nodes = GraphFactory.__gather_road_data()
 
-        for p in processors:
-            p.join()
+        r = RoadGraph()
+        # The builder takes the same add_node/add_edge calls as networkx
+        graph = CompactGraphBuilder() if compact else r.graph
+        # Only the roads with nodes on them are needed
+        roads_tbl = RoadsDAO.get_road_hashmap({str(road) for road in roads_to_nodes},
+                                              graph_factory_config["fetch_size"])
+        GraphFactory.__add_roads(graph, roads_info, roads_to_nodes, roads_tbl)
+
+        if compact:
+            r.compact = graph.build()
+            r.graph = None
+        else:
+            r.freeze()
 
-        # input("Connect your debugger now!")
+        GraphFactory.__save(r, graph_file_name, contraction_hierarchy)
+        return r
 
-        print("")
-        nodes_processed = 0
-        missing_ids = 0
-        for g in graph_edges:
-            if g["id"] not in id_to_geom:
-                missing_ids += 1
-                continue
-
-            geom = id_to_geom[g["id"]]
-            r.graph.add_edge(
-                    g["n1_name"],
-                    g["n2_name"],
-                    id=g["id"],
-                    db_id=g["db_id"],
-                    name=g["name"],
-                    weight=calculate_weight(g["db_id"], geom),
-                    geom=geom)
-
-            if nodes_processed % 1000 == 0:
-                print('\rConstructing Graph (Adding Edges): {0:.2f}%'
-                      .format(nodes_processed/len(graph_edges) * 100), end="")
+    @staticmethod
+    def construct_graph_from_shapefiles(graph_file_name, roads_files, places_files, contraction_hierarchy=False,
+                                        compact=False):
+        """
+        Builds the road graph straight from the TIGER shape files, without the database (see
+        main/model/tiger_files.py), and saves it to graph_file_name.  Places are keyed on their GEOIDs, the gids
+        manage.py import gives them in gis.places.
+        :param graph_file_name:
+        :param roads_files: PRISECROADS shape files
+        :param places_files: PLACE shape files
+        :param contraction_hierarchy: also build a contraction hierarchy, saved next to the graph
+        :param compact: fill a CompactGraphBuilder directly instead of building a networkx graph first
+        :return: the RoadGraph
+        """
+        DEFAULT_LOGGER.info("Reading {0} road files".format(len(roads_files)))
+        linearids, geoms, types, names = read_roads(roads_files)
+        DEFAULT_LOGGER.info("Finding the intersections of {0} roads".format(len(linearids)))
+        r1, r2, lat, lon = find_road_intersections(geoms, linearids, graph_factory_config["number_of_processors"])
+        r1, r2, lat, lon = r1.tolist(), r2.tolist(), lat.tolist(), lon.tolist()
+
+        DEFAULT_LOGGER.info("Reading {0} place files".format(len(places_files)))
+        places = read_places(places_files)
+        place_intersections = find_place_intersections(places, np.array(lat), np.array(lon),
+                                                       [(linearids[a], linearids[b]) for a, b in zip(r1, r2)])
+
+        road_intersections = ((linearids[a], names[a], linearids[b], names[b], y, x)
+                              for a, b, y, x in zip(r1, r2, lat, lon))
+        roads_info, roads_to_nodes = GraphFactory.__collect_road_data(road_intersections, place_intersections)
+
+        # Shaped like RoadsDAO.get_road_hashmap
+        roads_tbl = {}
+        for linearid, geom, rttyp in zip(linearids, geoms, types):
+            if int(linearid) in roads_to_nodes:
+                roads_tbl[linearid] = {'geom': geom, 'type': rttyp}
 
-            nodes_processed += 1
+        r = RoadGraph()
+        graph = CompactGraphBuilder() if compact else r.graph
+        GraphFactory.__add_roads(graph, roads_info, roads_to_nodes, roads_tbl)
 
-        print("Missing " + str(missing_ids))
-        with open(pickle_file_name, 'wb') as pfile:
-            pickle.dump(r, pfile, protocol=pickle.HIGHEST_PROTOCOL)
+        if compact:
+            r.compact = graph.build()
+            r.graph = None
+        else:
+            r.freeze()
 
+        GraphFactory.__save(r, graph_file_name, contraction_hierarchy)
         return r
 
+    @staticmethod
+    def shard_hash(statefp):
+        """
+        :return: a hash of everything the state's shard is built from, the shard is rebuilt when it changes
+        """
+        h = hashlib.md5()
+        h.update(str(GraphFactory.SHARD_FORMAT_VERSION).encode())
+        h.update(repr(graph_factory_config["snap_tolerance_degrees"]).encode())
+        h.update(str(RoadsDAO.get_state_input_hash(statefp)).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def construct_state_shard(statefp, shard_file_name):
+        """
+        Builds the graph of one state's roads (see __gather_road_data) and saves it to shard_file_name
+        :return: the shard's CompactGraph
+        """
+        roads_info, roads_to_nodes = GraphFactory.__gather_road_data(statefp)
+        builder = CompactGraphBuilder()
+        roads_tbl = RoadsDAO.get_road_hashmap({str(road) for road in roads_to_nodes},
+                                              graph_factory_config["fetch_size"], statefp)
+        GraphFactory.__add_roads(builder, roads_info, roads_to_nodes, roads_tbl)
+
+        shard = RoadGraph()
+        shard.graph = None
+        shard.compact = builder.build()
+        RoadGraph.save_graph(shard, shard_file_name)
+        return shard.compact
+
+    @staticmethod
+    def construct_graph_incremental(graph_file_name, contraction_hierarchy=False, shard_dir=None):
+        """
+        Builds the road graph out of one shard per state (see gis.road_states).  A shard is saved in shard_dir under
+        the hash of its input data (see shard_hash), so only the shards of states whose roads, intersections or
+        places changed since the last build are built again, the rest are read back from disk.  The shards are then
+        merged into one graph: intersections on state borders are nodes of both shards and join them.
+        :param graph_file_name:
+        :param contraction_hierarchy: also build a contraction hierarchy of the merged graph
+        :param shard_dir: where the shards are kept, graph_factory_config["shard_dir"] by default
+        :return: (the RoadGraph, {"reused": [statefp, ...], "built": [statefp, ...]})
+        """
+        shard_dir = shard_dir if shard_dir is not None else graph_factory_config["shard_dir"]
+        os.makedirs(shard_dir, exist_ok=True)
+
+        report = {"reused": [], "built": []}
+        merged = CompactGraphBuilder()
+        for statefp in RoadsDAO.get_road_states():
+            shard_file_name = os.path.join(shard_dir, "{0}-{1}.bin".format(statefp, GraphFactory.shard_hash(statefp)))
+            if os.path.exists(shard_file_name):
+                DEFAULT_LOGGER.info("Reusing the graph shard of state {0} ({1})".format(statefp, shard_file_name))
+                shard = RoadGraph.load_graph(shard_file_name).compact
+                report["reused"].append(statefp)
+            else:
+                DEFAULT_LOGGER.info("Building the graph shard of state {0} ({1})".format(statefp, shard_file_name))
+                shard = GraphFactory.construct_state_shard(statefp, shard_file_name)
+                report["built"].append(statefp)
+                # The state's older shards (and the files next to them) were built from data that's gone
+                for f in os.listdir(shard_dir):
+                    if f.startswith(statefp + "-") and not f.startswith(os.path.basename(shard_file_name)):
+                        os.remove(os.path.join(shard_dir, f))
+
+            merged.add_graph(shard)
+
+        r = RoadGraph()
+        r.graph = None
+        r.compact = merged.build()
+        DEFAULT_LOGGER.info("Merged {0} graph shards ({1} reused, {2} built) into {3} nodes and {4} edges"
+                            .format(len(report["reused"]) + len(report["built"]), len(report["reused"]),
+                                    len(report["built"]), r.compact.number_of_nodes(),
+                                    r.compact.number_of_edges()))
+
+        GraphFactory.__save(r, graph_file_name, contraction_hierarchy)
+        return r, report
+
 if __name__ == "__main__":
-    GraphFactory.construct_graph("graph2.pickle")
\ No newline at end of file
+    GraphFactory.construct_graph("graph2.bin")
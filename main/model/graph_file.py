@@ -0,0 +1,190 @@
+"""
+Binary, memory mappable graph file.
+
+    header   magic (8 bytes), format version (uint32), section count (uint32)
+    sections one entry per section: name (16 bytes), numpy dtype (8 bytes), byte offset (uint64), item count (uint64)
+    data     each section's array, 8 byte aligned, little endian
+
+The sections are the arrays of a CompactGraph: the node table (lat, lon, place_gid, city_name), the adjacency arrays
+(offsets, targets, weights, edge_index), the edge table (edge_*) and the string table shared by road and city names,
+plus the graph's digest (see CompactGraph.signature).  Reading the file just maps it and points numpy arrays at it, so
+start up costs next to nothing and worker processes mapping the same file share its pages through the OS page cache.
+
+Edge geometries are kept in a separate file next to this one, see GeometryStore, which records the digest too so
+the two can't be mixed up.  Version 1 files had them inline (geom_offsets and geom_blob sections), those can still
+be read.
+"""
+import json
+import mmap
+import os
+import struct
+import numpy as np
+import shapely.wkb
+from main.model.compact_graph import CompactGraph, StringTable
+from main.model.geometry_store import GeometryStore
+
+MAGIC = b"OTBPGRPH"
+FORMAT_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<16s8sQQ")
+ALIGNMENT = 8
+
+
+class WkbGeometryList:
+    """The inline geometries of a version 1 file, each one is only parsed when it's asked for."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        a, b = self.offsets[i], self.offsets[i + 1]
+        return shapely.wkb.loads(bytes(self.blob[a:b])) if b > a else None
+
+
+def is_graph_file(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def allocate_sections(file_name, magic, version, sections):
+    """
+    Creates a file laid out like a graph file (see the top of this module), for the sections to be filled in
+    :param file_name:
+    :param magic: the file type, 8 bytes
+    :param version: the format version
+    :param sections: (name, numpy dtype, item count) for each section
+    :return: (the file mapped into memory, {name: writable array over the section}), flush the map once they're
+             filled in
+    """
+    position = _aligned(HEADER.size + SECTION.size * len(sections))
+    table = []
+    for name, dtype, count in sections:
+        dtype = np.dtype(dtype).newbyteorder('<')
+        table.append((name, dtype, count, position))
+        position = _aligned(position + dtype.itemsize * count)
+
+    with open(file_name, 'wb+') as f:
+        f.write(HEADER.pack(magic, version, len(sections)))
+        for name, dtype, count, offset in table:
+            f.write(SECTION.pack(name.encode('ascii'), dtype.str.encode('ascii'), offset, count))
+        f.truncate(position)
+        mm = mmap.mmap(f.fileno(), 0)
+    return mm, {name: np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+                for name, dtype, count, offset in table}
+
+
+def map_sections(file_name, magic, readable_versions, kind):
+    """
+    Maps a file written through allocate_sections into memory
+    :param file_name:
+    :param magic: the file type it has to be
+    :param readable_versions: the format versions that can be read, the last one is the current one
+    :param kind: what the file is, for error messages
+    :return: (format version, {name: read only array over the section})
+    """
+    with open(file_name, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic_read, version, section_count = HEADER.unpack_from(mm, 0)
+    if magic_read != magic:
+        raise ValueError("{0} is not a {1} file".format(file_name, kind))
+    if version not in readable_versions:
+        raise ValueError("{0} is {1} format version {2}, expected {3}"
+                         .format(file_name, kind, version, readable_versions[-1]))
+
+    arrays = {}
+    for i in range(0, section_count):
+        name, dtype, offset, count = SECTION.unpack_from(mm, HEADER.size + i * SECTION.size)
+        dtype = np.dtype(dtype.rstrip(b"\0").decode('ascii'))
+        # The arrays keep a reference to the map, so it stays open as long as they're around
+        arrays[name.rstrip(b"\0").decode('ascii')] = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+    return version, arrays
+
+
+def write_graph(compact, file_name):
+    """
+    Writes a CompactGraph, through a temporary file so a reader never sees a partial graph.  The edge geometries
+    are written first, to file_name + GeometryStore.FILE_SUFFIX.
+    :param compact:
+    :param file_name:
+    """
+    for key in compact.custom_keys.values():
+        if not isinstance(key, str):
+            raise ValueError("Only string node names can be stored, found {0}".format(repr(key)))
+
+    digest = compact.signature()[2]
+    GeometryStore.write(compact.edge_geoms, file_name + GeometryStore.FILE_SUFFIX, digest)
+    custom_keys = json.dumps(sorted(compact.custom_keys.items())).encode('utf-8')
+
+    sections = [
+        ("lat", compact.lat),
+        ("lon", compact.lon),
+        ("place_gid", compact.place_gid),
+        ("city_name", compact.city_name),
+        ("offsets", compact.offsets),
+        ("targets", compact.targets),
+        ("weights", compact.weights),
+        ("edge_index", compact.edge_index),
+        ("edge_u", compact.edge_u),
+        ("edge_v", compact.edge_v),
+        ("edge_weight", compact.edge_weight),
+        ("edge_db_id", compact.edge_db_id),
+        ("edge_name", compact.edge_name),
+        ("names_offsets", compact.names.offsets),
+        ("names_blob", compact.names.blob),
+        ("custom_keys", np.frombuffer(custom_keys, dtype=np.uint8)),
+        ("digest", np.frombuffer(digest.encode('ascii'), dtype=np.uint8)),
+    ]
+
+    tmp_file_name = file_name + ".tmp"
+    mm, arrays = allocate_sections(tmp_file_name, MAGIC, FORMAT_VERSION,
+                                   [(name, np.asarray(array).dtype, len(array)) for name, array in sections])
+    for name, array in sections:
+        arrays[name][:] = array
+    mm.flush()
+    os.replace(tmp_file_name, file_name)
+
+
+def read_graph(file_name, geometry_cache_size=0):
+    """
+    Maps a graph file (and its geometry file) into memory
+    :param file_name:
+    :param geometry_cache_size: how many parsed edge geometries to keep around, see GeometryStore
+    :return: a CompactGraph whose arrays point straight into the mapped file
+    """
+    _, arrays = map_sections(file_name, MAGIC, READABLE_VERSIONS, "graph")
+    custom_keys = {int(i): k for i, k in json.loads(bytes(arrays["custom_keys"]).decode('utf-8'))}
+    digest = bytes(arrays["digest"]).decode('ascii') if "digest" in arrays else None
+    if "geom_offsets" in arrays:
+        edge_geoms = WkbGeometryList(arrays["geom_offsets"], arrays["geom_blob"])
+    else:
+        # Refuses geometries written for some other graph, the offsets would point at the wrong roads
+        edge_geoms = GeometryStore(file_name + GeometryStore.FILE_SUFFIX, geometry_cache_size, digest)
+
+    return CompactGraph(
+        lat=arrays["lat"],
+        lon=arrays["lon"],
+        place_gid=arrays["place_gid"],
+        city_name=arrays["city_name"],
+        offsets=arrays["offsets"],
+        targets=arrays["targets"],
+        weights=arrays["weights"],
+        edge_index=arrays["edge_index"],
+        edge_u=arrays["edge_u"],
+        edge_v=arrays["edge_v"],
+        edge_weight=arrays["edge_weight"],
+        edge_db_id=arrays["edge_db_id"],
+        edge_name=arrays["edge_name"],
+        names=StringTable(arrays["names_offsets"], arrays["names_blob"]),
+        edge_geoms=edge_geoms,
+        custom_keys=custom_keys,
+        digest=digest)
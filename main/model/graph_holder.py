@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from main import DEFAULT_LOGGER
+from main.model.graph import RoadGraph
+from main.model.contraction import ContractionHierarchy
+from main.model.distance_table import DistanceTable
+from main.model.geometry_store import GeometryStore
+
+# Files loaded along with the graph (graph_file + suffix), replacing any of them is a new version too
+SIDECAR_SUFFIXES = (GeometryStore.FILE_SUFFIX, ContractionHierarchy.FILE_SUFFIX, DistanceTable.FILE_SUFFIX)
+
+
+class GraphHolder:
+    """
+    Keeps a single RoadGraph resident for the whole process so requests don't pay to deserialize the graph file.
+
+    The graph file and the files loaded with it (geometries, contraction hierarchy, distance table) are checked (at most
+    once every check_interval seconds) for a new modification time.  When one of them changes, the new graph is loaded
+    on a background thread while requests keep being served from the old one, once loading is finished the reference is
+    swapped.  Readers never take a lock, they just get whatever graph is current.
+    """
+
+    def __init__(self, graph_file, check_interval=30, compact=False):
+        self.graph_file = graph_file
+        self.check_interval = check_interval
+        # Freeze loaded graphs into CompactGraphs (see RoadGraph.freeze)
+        self.compact = compact
+
+        # (graph, version) is kept in a single tuple so a reader always sees a matching pair,
+        # assigning it is atomic so no lock is needed to read it.
+        self._current = (None, None)
+        self._load_lock = threading.Lock()
+        self._reload_thread = None
+        self._last_check = 0
+        self._swap_listeners = []
+
+        self.startup_seconds = None
+        self.last_reload_seconds = None
+        self.loaded_at = None
+        self.reload_count = 0
+        self.last_error = None
+
+    @property
+    def version(self):
+        return self._current[1]
+
+    def add_swap_listener(self, listener):
+        """
+        Registers a function that is called with (old_version, new_version) every time a new graph is swapped in
+        :param listener:
+        """
+        self._swap_listeners.append(listener)
+
+    def __file_version(self):
+        """
+        :return: the modification times of the graph file and its sidecar files, None for a sidecar that isn't there
+        """
+        version = [os.stat(self.graph_file).st_mtime_ns]
+        for suffix in SIDECAR_SUFFIXES:
+            try:
+                version.append(os.stat(self.graph_file + suffix).st_mtime_ns)
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def load(self):
+        """
+        Loads the graph synchronously, this is meant to be called once when the application starts.
+        :return: the loaded graph
+        """
+        with self._load_lock:
+            return self.__load_locked()
+
+    def __load_locked(self):
+        start = time.time()
+        version = self.__file_version()
+        graph = self.__read_graph()
+        self.startup_seconds = time.time() - start
+        self.__swap(graph, version)
+        self._last_check = time.time()
+        DEFAULT_LOGGER.info("Loaded graph {0} in {1:.2f} seconds".format(self.graph_file, self.startup_seconds))
+        return graph
+
+    def get(self):
+        """
+        Returns the current graph, kicking off a background reload if the graph file has changed on disk.
+        Callers should hold on to the returned graph for the duration of a query rather than calling get() again,
+        a swap may happen in between.
+        """
+        graph, version = self._current
+        if graph is None:
+            # Nobody called load() at startup, the first request(s) will have to wait for it.
+            with self._load_lock:
+                graph = self._current[0]
+                return graph if graph is not None else self.__load_locked()
+
+        now = time.time()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            self.__check_for_new_version(version)
+
+        return graph
+
+    def __check_for_new_version(self, version):
+        try:
+            file_version = self.__file_version()
+        except OSError as e:
+            DEFAULT_LOGGER.error("Could not stat graph file {0}: {1}".format(self.graph_file, str(e)))
+            return
+
+        if file_version == version:
+            return
+
+        if self._reload_thread is not None and self._reload_thread.is_alive():
+            return
+
+        self._reload_thread = threading.Thread(target=self.__reload, args=(file_version,), daemon=True)
+        self._reload_thread.start()
+
+    def __reload(self, file_version):
+        with self._load_lock:
+            if file_version == self.version:
+                return
+
+            start = time.time()
+            try:
+                graph = self.__read_graph()
+            except Exception as e:
+                # Most likely the file is still being written, we'll try again on the next check.
+                self.last_error = str(e)
+                DEFAULT_LOGGER.error("Could not reload graph {0}: {1}".format(self.graph_file, str(e)))
+                return
+
+            self.last_reload_seconds = time.time() - start
+            self.reload_count += 1
+            self.last_error = None
+            self.__swap(graph, file_version)
+            DEFAULT_LOGGER.info("Reloaded graph {0} in {1:.2f} seconds"
+                                .format(self.graph_file, self.last_reload_seconds))
+
+    def __read_graph(self):
+        graph = RoadGraph.load_graph(self.graph_file)
+        if self.compact:
+            graph.freeze()
+        return graph
+
+    def __swap(self, graph, version):
+        old_version = self.version
+        self._current = (graph, version)
+        self.loaded_at = time.time()
+
+        for listener in self._swap_listeners:
+            try:
+                listener(old_version, version)
+            except Exception as e:
+                DEFAULT_LOGGER.error("Graph swap listener failed: " + str(e))
+
+    def status(self):
+        return {
+            "graph_file": self.graph_file,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "startup_seconds": self.startup_seconds,
+            "last_reload_seconds": self.last_reload_seconds,
+            "reload_count": self.reload_count,
+            "reloading": self._reload_thread is not None and self._reload_thread.is_alive(),
+            "last_error": self.last_error
+        }
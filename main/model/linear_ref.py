@@ -0,0 +1,125 @@
+"""
+Linear referencing on road geometries with numpy.
+
+A road is cut into the edges between its nodes: every node is projected onto the road (its measure is how far along
+the road it is) and each edge's geometry is the part of the road between the measures of its two nodes.  All of a
+road's nodes are projected at once, against all of its segments, instead of searching the road's coordinates for
+each node separately.
+"""
+import numpy as np
+from shapely.geometry import LineString
+
+# Upper bound on points x segments handled in one go by RoadLine.project, keeps the temporary arrays small
+PROJECT_CHUNK = 1000000
+
+
+class RoadLine:
+    """One LineString of a road, as a coordinate array with the cumulative length at every vertex"""
+
+    def __init__(self, line):
+        self.coords = np.asarray(line.coords, dtype=np.float64)[:, :2]
+        self.starts = self.coords[:-1]
+        self.deltas = self.coords[1:] - self.starts
+        self.segment_lengths = np.sqrt((self.deltas ** 2).sum(axis=1))
+        self.measures = np.concatenate(([0.0], np.cumsum(self.segment_lengths)))
+        self.length = float(self.measures[-1])
+
+    def project(self, xy):
+        """
+        :param xy: (m, 2) array of points (lon, lat)
+        :return: (measures, distances) arrays, how far along the line the closest point to each point is and how far
+                 away from the line each point is
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        measures = np.empty(len(xy))
+        distances = np.empty(len(xy))
+        if len(self.starts) == 0:
+            measures.fill(0.0)
+            distances[:] = np.sqrt(((xy - self.coords[0]) ** 2).sum(axis=1)) if len(self.coords) > 0 else np.inf
+            return measures, distances
+
+        sx, sy = self.starts[:, 0], self.starts[:, 1]
+        dx, dy = self.deltas[:, 0], self.deltas[:, 1]
+        squared_lengths = self.segment_lengths ** 2
+        nonzero = squared_lengths > 0
+        chunk = max(1, PROJECT_CHUNK // len(self.starts))
+        for a in range(0, len(xy), chunk):
+            p = xy[a:a + chunk]
+            rx = p[:, 0:1] - sx
+            ry = p[:, 1:2] - sy
+            # Position of the closest point on each segment, 0 at its start and 1 at its end
+            t = np.zeros(rx.shape)
+            np.divide(rx * dx + ry * dy, squared_lengths, out=t, where=nonzero)
+            np.clip(t, 0.0, 1.0, out=t)
+            rx -= t * dx
+            ry -= t * dy
+            d2 = rx * rx + ry * ry
+
+            k = np.argmin(d2, axis=1)
+            rows = np.arange(len(p))
+            measures[a:a + chunk] = self.measures[k] + t[rows, k] * self.segment_lengths[k]
+            distances[a:a + chunk] = np.sqrt(d2[rows, k])
+        return measures, distances
+
+    def point_at(self, measure):
+        if len(self.starts) == 0:
+            return self.coords[0]
+        k = min(max(int(np.searchsorted(self.measures, measure, side='right')) - 1, 0), len(self.starts) - 1)
+        if self.segment_lengths[k] == 0:
+            return self.coords[k]
+        return self.starts[k] + (measure - self.measures[k]) / self.segment_lengths[k] * self.deltas[k]
+
+    def substring(self, m1, m2, tolerance=0.0):
+        """
+        :return: the part of the line between two measures (in the line's direction), None if they're within
+                 tolerance of each other
+        """
+        if m1 > m2:
+            m1, m2 = m2, m1
+        if m2 - m1 <= tolerance:
+            return None
+
+        a, b = np.searchsorted(self.measures, (m1, m2), side='right')
+        # The vertices strictly between the two cuts
+        inner = self.coords[a:b]
+        if len(inner) > 0 and self.measures[b - 1] >= m2:
+            inner = inner[:-1]
+        return LineString(np.vstack((self.point_at(m1), inner, self.point_at(m2))))
+
+
+class RoadGeometry:
+    """All of the lines of a (possibly multi part) road"""
+
+    def __init__(self, geom):
+        self.lines = [RoadLine(g) for g in (geom.geoms if hasattr(geom, 'geoms') else [geom]) if not g.is_empty]
+
+    def project(self, xy, tolerance):
+        """
+        :param xy: (m, 2) array of points (lon, lat)
+        :param tolerance: how far (in degrees) a point can be from a line and still be on it
+        :return: (m, number of lines) array of each point's measure along each line, NaN where it isn't on the line
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        result = np.full((len(xy), len(self.lines)), np.nan)
+        for i, line in enumerate(self.lines):
+            measures, distances = line.project(xy)
+            on_line = distances <= tolerance
+            result[on_line, i] = measures[on_line]
+        return result
+
+    def cut(self, pairs, xy, tolerance):
+        """
+        :param pairs: (i, j) indexes into xy, one per edge
+        :param xy: the nodes on the road (lon, lat)
+        :param tolerance:
+        :return: for each pair, the road between the two nodes (taken from the first line they're both on), None if
+                 they're at the same place, or missing if they don't share a line
+        """
+        measures = self.project(xy, tolerance)
+        cuts = {}
+        for i, j in pairs:
+            both = np.nonzero(~np.isnan(measures[i]) & ~np.isnan(measures[j]))[0]
+            if len(both) > 0:
+                k = both[0]
+                cuts[(i, j)] = self.lines[k].substring(measures[i, k], measures[j, k], tolerance)
+        return cuts
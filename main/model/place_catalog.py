@@ -0,0 +1,164 @@
+import bisect
+import heapq
+import threading
+import time
+import us
+from main import DEFAULT_LOGGER
+from main.config.config import place_catalog_config
+from main.model.places_dao import PlacesDAO
+
+
+class PlaceCatalogError(Exception):
+    pass
+
+
+class PlaceIndex:
+    """
+    An immutable snapshot of gis.places: gid -> (name, state name), and every place sorted by its lower cased name so
+    the places starting with a prefix are one contiguous slice, found with two binary searches.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: (gid, name, statefp, aland) tuples, see PlacesDAO.get_all_places
+        """
+        state_names = {}
+        self.places = {}
+        entries = []
+        for gid, name, statefp, aland in rows:
+            if name is None:
+                continue
+            if statefp not in state_names:
+                state = us.states.lookup(statefp)
+                state_names[statefp] = state.name if state is not None else None
+            self.places[gid] = (name, state_names[statefp])
+            entries.append((name.lower(), -(aland or 0.0), name, gid))
+
+        entries.sort()
+        self.keys = [e[0] for e in entries]
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.places)
+
+    def search(self, partial_name, limit):
+        prefix = partial_name.lower().strip()
+        start = bisect.bisect_left(self.keys, prefix)
+        # Every key starting with prefix sorts before prefix followed by the highest code point
+        end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start)
+
+        # Exact matches first, then the bigger places (by land area), then alphabetically
+        best = heapq.nsmallest(limit, range(start, end),
+                               key=lambda i: (self.keys[i] != prefix, self.entries[i][1], self.entries[i][2]))
+        return [self.entries[i][3] for i in best]
+
+
+class PlaceCatalog:
+    """
+    Keeps the names of all places in memory, so autocomplete and place name lookups don't go to the database.
+
+    The catalog is loaded the first time it's used (or by load() at startup).  At most once every check_interval
+    seconds a background thread compares a cheap signature of gis.places (see PlacesDAO.get_places_signature) with
+    the one the catalog was built from, and rebuilds the catalog if the table was reimported.  Like GraphHolder,
+    readers never take a lock, the whole index is swapped in a single assignment.
+    """
+
+    def __init__(self, load_rows=PlacesDAO.get_all_places, load_signature=PlacesDAO.get_places_signature,
+                 check_interval=300):
+        self.load_rows = load_rows
+        self.load_signature = load_signature
+        self.check_interval = check_interval
+
+        # (PlaceIndex, signature)
+        self._current = (None, None)
+        self._load_lock = threading.Lock()
+        self._reload_thread = None
+        self._last_check = 0
+        self.loaded_at = None
+        self.load_seconds = None
+        self.reload_count = 0
+        self.last_error = None
+
+    def load(self):
+        with self._load_lock:
+            return self.__load_locked(self.load_signature())
+
+    def __load_locked(self, signature):
+        start = time.time()
+        rows = self.load_rows()
+        if rows is None:
+            # The DAO logs the error and returns None when the database can't be reached
+            raise PlaceCatalogError("Could not load the places from the database")
+        index = PlaceIndex(rows)
+        self._current = (index, signature)
+        self._last_check = time.time()
+        self.loaded_at = self._last_check
+        self.load_seconds = self._last_check - start
+        DEFAULT_LOGGER.info("Loaded {0} places in {1:.2f} seconds".format(len(index), self.load_seconds))
+        return index
+
+    def __index(self):
+        index, signature = self._current
+        if index is None:
+            with self._load_lock:
+                index = self._current[0]
+                return index if index is not None else self.__load_locked(self.load_signature())
+
+        now = time.time()
+        if now - self._last_check >= self.check_interval and \
+                (self._reload_thread is None or not self._reload_thread.is_alive()):
+            self._last_check = now
+            self._reload_thread = threading.Thread(target=self.__reload, args=(signature,), daemon=True)
+            self._reload_thread.start()
+        return index
+
+    def __reload(self, signature):
+        try:
+            with self._load_lock:
+                new_signature = self.load_signature()
+                if new_signature != signature:
+                    self.__load_locked(new_signature)
+                    self.reload_count += 1
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            DEFAULT_LOGGER.error("Could not reload the place catalog: " + str(e))
+
+    def search(self, partial_name, limit=None):
+        """
+        :param partial_name: the beginning of a place name, case doesn't matter
+        :param limit: the most results to return
+        :return: a list of {"gid", "city_name", "state_name"} dicts, best matches first
+        :raises PlaceCatalogError: if the catalog isn't loaded yet and can't be
+        """
+        index = self.__index()
+        limit = limit if limit is not None else place_catalog_config["max_results"]
+        results = []
+        for gid in index.search(partial_name, limit):
+            name, state_name = index.places[gid]
+            results.append({"gid": gid, "city_name": name, "state_name": state_name})
+        return results
+
+    def get_place_name_by_id(self, gid):
+        """
+        :return: "name, state" like PlacesDAO.get_place_name_by_id
+        :raises PlaceCatalogError: see search
+        """
+        place = self.__index().places.get(gid)
+        if place is None:
+            # Not in the catalog (yet), the table may have been reimported since it was loaded
+            return PlacesDAO.get_place_name_by_id(gid)
+        return str(place[0]) + ", " + str(place[1])
+
+    def status(self):
+        index = self._current[0]
+        return {
+            "places": len(index) if index is not None else None,
+            "loaded_at": self.loaded_at,
+            "load_seconds": self.load_seconds,
+            "reload_count": self.reload_count,
+            "last_error": self.last_error
+        }
+
+
+place_catalog = PlaceCatalog(check_interval=place_catalog_config["reload_check_interval_seconds"])
@@ -1,7 +1,15 @@
 from main.model import with_pg_connection
+from main.model.db_util import stream_query
+import shapely.wkb
 import shapely.wkt
 
 
+# linearids of the roads imported from one state's file, see gis.road_states
+STATE_ROADS_SQL = """
+    SELECT r.linearid FROM gis.roads r INNER JOIN gis.road_states s ON s.gid = r.gid WHERE s.statefp = %s
+"""
+
+
 class RoadsDAO:
     @staticmethod
     @with_pg_connection
@@ -13,19 +21,99 @@ class RoadsDAO:
         return shapely.wkt.loads(results[0]) if results is not None else None
 
     @staticmethod
-    @with_pg_connection
-    def get_road_hashmap(**kwargs):
+    def iter_roads(fetch_size=10000, statefp=None):
         """
-        Gets all road geoms from database.... this returns a pretty huge hashmap
-        :return:
+        Streams every road, or the roads of one state
+        :return: a generator of (linearid, shapely geometry, rttyp)
+        """
+        sql, params = "SELECT linearid, ST_AsBinary(geom), rttyp FROM gis.roads", ()
+        if statefp is not None:
+            sql += " WHERE gid IN (SELECT gid FROM gis.road_states WHERE statefp = %s)"
+            params = (statefp,)
+        for linearid, wkb, rttyp in stream_query(sql, params, fetch_size):
+            yield linearid, shapely.wkb.loads(bytes(wkb)) if wkb is not None else None, rttyp
+
+    @staticmethod
+    def get_road_hashmap(road_ids=None, fetch_size=10000, statefp=None):
+        """
+        Gets road geoms from database.... this returns a pretty huge hashmap
+        :param road_ids: only keep these roads (linearids as strings), None keeps all of them
+        :param fetch_size: rows fetched per round trip
+        :param statefp: only the roads imported from this state's file
+        :return: linearid -> {'geom': ..., 'type': rttyp}
         """
-        c = kwargs['cursor']
-        sql_string = "SELECT linearid, ST_AsText(geom), rttyp FROM gis.roads"
-        c.execute(sql_string)
-        results = c.fetchall()
         r = {}
-        for row in results:
-            id, geom, rttyp = row
-            r[id] = {'geom': shapely.wkt.loads(geom), 'type': rttyp}
+        for linearid, geom, rttyp in RoadsDAO.iter_roads(fetch_size, statefp):
+            if road_ids is None or linearid in road_ids:
+                r[linearid] = {'geom': geom, 'type': rttyp}
 
         return r
+
+    @staticmethod
+    def iter_road_intersections(fetch_size=10000, statefp=None):
+        """
+        Streams gis.roads_intersection (see sql/metadata_setup.sql), with the intersection as raw coordinates
+        :param statefp: only the intersections on a road of this state
+        :return: a generator of (r1id, r1name, r2id, r2name, lat, lon)
+        """
+        sql, params = "SELECT r1id, r1name, r2id, r2name, ST_Y(geom), ST_X(geom) FROM gis.roads_intersection", ()
+        if statefp is not None:
+            sql += " WHERE r1id IN ({0}) OR r2id IN ({0})".format(STATE_ROADS_SQL)
+            params = (statefp, statefp)
+        return stream_query(sql, params, fetch_size)
+
+    @staticmethod
+    @with_pg_connection
+    def get_state_road_ids(statefp, **kwargs):
+        """
+        :return: the set of linearids of a state's roads
+        """
+        c = kwargs['cursor']
+        c.execute(STATE_ROADS_SQL, (statefp,))
+        return {row[0] for row in c.fetchall()}
+
+    @staticmethod
+    @with_pg_connection
+    def get_road_states(**kwargs):
+        """
+        :return: the state fips codes roads were imported for, sorted
+        """
+        c = kwargs['cursor']
+        c.execute("SELECT DISTINCT statefp FROM gis.road_states ORDER BY statefp")
+        return [row[0] for row in c.fetchall()]
+
+    @staticmethod
+    @with_pg_connection
+    def get_state_input_hash(statefp, **kwargs):
+        """
+        Hashes everything a state's graph shard is built from: the state's roads and the intersections and places on
+        them.  Reimporting the state (or rebuilding the intersection tables in a way that touches it) changes it.
+        :return: an md5 hex digest
+        """
+        c = kwargs['cursor']
+        c.execute("""
+            WITH state_roads AS ({0}),
+            hashes AS (
+                SELECT md5(r.linearid || coalesce(r.fullname, '') || coalesce(r.rttyp, '') ||
+                           md5(ST_AsEWKB(r.geom))) AS h
+                FROM gis.roads r
+                INNER JOIN gis.road_states s ON s.gid = r.gid
+                WHERE s.statefp = %s
+
+                UNION ALL
+
+                SELECT md5(ri.r1id || ri.r2id || coalesce(ri.r1name, '') || coalesce(ri.r2name, '') ||
+                           ST_AsText(ri.geom))
+                FROM gis.roads_intersection ri
+                WHERE ri.r1id IN (SELECT linearid FROM state_roads) OR ri.r2id IN (SELECT linearid FROM state_roads)
+
+                UNION ALL
+
+                SELECT md5(pi.gid::text || coalesce(pi.name, '') || pi.linearid || pi.location)
+                FROM gis.places_intersection pi
+                WHERE pi.linearid IN (SELECT linearid FROM state_roads)
+            )
+            SELECT md5(string_agg(h, '' ORDER BY h)) FROM hashes
+        """.format(STATE_ROADS_SQL), (statefp, statefp))
+        row = c.fetchone()
+        return row[0] if row is not None else None
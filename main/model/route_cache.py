@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedRoute:
+    def __init__(self, route, response, route_id):
+        # The Route as read back from the database and the JSON response built from it
+        self.route = route
+        self.response = response
+        # Id of the rows already written to gis.user_routes for this route
+        self.route_id = route_id
+        self.created = time.time()
+
+
+class RouteCache:
+    """
+    Remembers the routes that have been calculated, so a popular origin/destination pair is only searched for and
+    written to gis.user_routes once.
+
+    Entries are keyed on (first_id, second_id, graph version), the least recently used entry is dropped once there
+    are more than max_size of them and entries older than ttl_seconds are never returned.  Passing the graph version
+    in the key means a stale route can't be served while a new graph is being swapped in, clear() (registered as a
+    GraphHolder swap listener) then frees the old entries.
+
+    Entries can also be found by their route_id, for /graph/route/<route_id>.  A route never changes once it's
+    calculated, so that lookup ignores the TTL.
+    """
+
+    def __init__(self, max_size=1000, ttl_seconds=3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        # route_id -> key
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(first_id, second_id, version):
+        return first_id, second_id, version
+
+    def get(self, key):
+        """
+        :param key: see RouteCache.key
+        :return: the CachedRoute, or None if there isn't a fresh one
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.created > self.ttl_seconds:
+                self.__remove(key)
+                self.expired += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, route, response, route_id):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.__remove(key)
+            self._entries[key] = CachedRoute(route, response, route_id)
+            self._keys[route_id] = key
+            while len(self._entries) > self.max_size:
+                self.__remove(next(iter(self._entries)))
+                self.evicted += 1
+
+    def get_by_route_id(self, route_id):
+        """
+        :return: the CachedRoute of the route, or None if it isn't in the cache (any more)
+        """
+        with self._lock:
+            key = self._keys.get(route_id)
+            if key is None:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __remove(self, key):
+        entry = self._entries.pop(key)
+        if self._keys.get(entry.route_id) == key:
+            del self._keys[entry.route_id]
+
+    def clear(self, *args):
+        """Drops every entry, takes (and ignores) the arguments of a GraphHolder swap listener"""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups > 0 else None,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
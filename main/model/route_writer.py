@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from main import DEFAULT_LOGGER
+
+
+class RouteWriter:
+    """
+    Write-behind queue for gis.user_routes.
+
+    Requests hand their (decorated, see Route.decorate) routes to submit() and answer straight away, a background
+    thread writes them in batches of up to batch_size routes, waiting at most max_delay_seconds for a batch to fill.
+    Anything that needs a route to be in the database (GeoServer draws routes from gis.user_routes) calls
+    flush(route_id) first, which moves the route to the front of the line and waits for it to be written.
+    """
+
+    def __init__(self, write_batch, batch_size=50, max_delay_seconds=0.5, retries=3, max_dropped=1000):
+        """
+        :param write_batch: function writing a list of routes, e.g. UserRoutesDAO.insert_routes
+        :param batch_size:
+        :param max_delay_seconds:
+        :param retries: how many times a failed batch is tried again before its routes are dropped
+        :param max_dropped: how many of the most recently dropped route ids are remembered, so flush() can tell they
+                            weren't written (dropped_routes counts all of them)
+        """
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.max_delay_seconds = max_delay_seconds
+        self.retries = retries
+        self.max_dropped = max_dropped
+
+        self._lock = threading.Lock()
+        # _cond wakes up the writer thread, _written the threads waiting in flush()
+        self._cond = threading.Condition(self._lock)
+        self._written = threading.Condition(self._lock)
+        self._queue = deque()
+        # route id -> (route, time it was submitted) for every route that isn't written yet
+        self._pending = {}
+        self._urgent = set()
+        # ids of the routes that couldn't be written, the oldest are forgotten past max_dropped
+        self._dropped = OrderedDict()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+        self.batches = 0
+        self.routes_written = 0
+        self.failed_batches = 0
+        self.dropped_routes = 0
+        self.last_batch_size = 0
+        self.last_flush_seconds = None
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def __ensure_thread(self):
+        # A forked child doesn't get the parent's thread (or its queue), it starts its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue.clear()
+            self._pending.clear()
+            self._urgent.clear()
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.__run, daemon=True)
+            self._thread.start()
+
+    def submit(self, route):
+        with self._cond:
+            self.__ensure_thread()
+            self._pending[route.id] = (route, time.time())
+            self._queue.append(route.id)
+            self._cond.notify_all()
+
+    def is_pending(self, route_id):
+        return route_id in self._pending
+
+    def flush(self, route_id=None, timeout=None):
+        """
+        Waits until a route has been written, or until every queued route has been written if route_id is None.
+        :param route_id:
+        :param timeout: seconds, None waits for as long as it takes
+        :return: True if the route(s) made it to the database
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            def done():
+                return route_id not in self._pending if route_id is not None else len(self._pending) == 0
+
+            if not done():
+                self._urgent.add(route_id)
+                self._cond.notify_all()
+            while not done():
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._written.wait(remaining)
+            return route_id not in self._dropped
+
+    def close(self, timeout=None):
+        """Writes whatever is still queued, meant to be called when the process exits"""
+        self.flush(timeout=timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __next_batch(self):
+        with self._cond:
+            while len(self._queue) == 0 and not self._closed:
+                self._cond.wait()
+            if len(self._queue) == 0:
+                return None
+
+            # Give the batch a chance to fill up, unless someone is waiting on it
+            oldest = self._pending[self._queue[0]][1] if self._queue[0] in self._pending else time.time()
+            while len(self._queue) < self.batch_size and len(self._urgent) == 0 and not self._closed:
+                remaining = oldest + self.max_delay_seconds - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            # Routes somebody is waiting on go first
+            batch = [r for r in self._queue if r in self._urgent][:self.batch_size]
+            for r in self._queue:
+                if len(batch) >= self.batch_size:
+                    break
+                if r not in self._urgent:
+                    batch.append(r)
+            for r in batch:
+                self._queue.remove(r)
+            self._urgent.difference_update(batch)
+            self._urgent.discard(None)
+            return [self._pending[r] for r in batch if r in self._pending]
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                return
+            if len(batch) == 0:
+                continue
+
+            routes = [route for route, _ in batch]
+            written = False
+            for attempt in range(0, self.retries + 1):
+                try:
+                    self.write_batch(routes)
+                    written = True
+                    break
+                except Exception as e:
+                    DEFAULT_LOGGER.error("Writing {0} routes failed (attempt {1}): {2}"
+                                         .format(len(routes), attempt + 1, str(e)))
+                    time.sleep(min(2 ** attempt * 0.1, 5))
+
+            now = time.time()
+            with self._cond:
+                self.batches += 1
+                self.last_batch_size = len(routes)
+                if written:
+                    self.routes_written += len(routes)
+                    for _, submitted in batch:
+                        latency = now - submitted
+                        self.last_flush_seconds = latency
+                        self.total_flush_seconds += latency
+                        self.max_flush_seconds = max(self.max_flush_seconds, latency)
+                else:
+                    self.failed_batches += 1
+                    self.dropped_routes += len(routes)
+                    for route in routes:
+                        self._dropped[route.id] = None
+                    while len(self._dropped) > self.max_dropped:
+                        self._dropped.popitem(last=False)
+                for route in routes:
+                    self._pending.pop(route.id, None)
+                self._written.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "batch_size": self.batch_size,
+                "max_delay_seconds": self.max_delay_seconds,
+                "batches": self.batches,
+                "routes_written": self.routes_written,
+                "last_batch_size": self.last_batch_size,
+                "average_batch_size": (self.routes_written + self.dropped_routes) / self.batches
+                if self.batches > 0 else None,
+                "last_flush_seconds": self.last_flush_seconds,
+                "average_flush_seconds": self.total_flush_seconds / self.routes_written
+                if self.routes_written > 0 else None,
+                "max_flush_seconds": self.max_flush_seconds,
+                "failed_batches": self.failed_batches,
+                "dropped_routes": self.dropped_routes
+            }
@@ -0,0 +1,330 @@
+import abc
+import heapq
+import itertools
+import math
+import networkx as nx
+from main.model.compact_graph import graph_digest
+
+INFINITY = float("inf")
+
+
+def haversine_degrees(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance between two points, expressed in degrees of arc rather than meters.
+
+    Edge weights in the road graph are planar lengths measured in degrees (see GraphFactory.construct_graph), a road
+    drawn in lat/lon space is never shorter than the great circle between its ends, so this is an admissible lower
+    bound on the weight of any path between the two points.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return math.degrees(2 * math.asin(min(1.0, math.sqrt(a))))
+
+
+class NetworkXView:
+    """
+    Adapts a networkx graph to the small interface the search engines use:
+        neighbors(node) -> iterable of (neighbor, weight)
+        position(node) -> (lat, lon)
+        node in view
+        nodes(), number_of_nodes(), number_of_edges()
+    and, so routes can be built from a search result regardless of the underlying graph:
+        index_of(name) / key(node) to translate between node names and what the search works with
+        node_data(node) / edge_data(u, v) returning the node/edge attribute dicts
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __contains__(self, node):
+        return node in self.graph
+
+    def nodes(self):
+        return iter(self.graph.nodes)
+
+    def number_of_nodes(self):
+        return self.graph.number_of_nodes()
+
+    def number_of_edges(self):
+        return self.graph.number_of_edges()
+
+    def neighbors(self, node):
+        for v, data in self.graph[node].items():
+            w = data.get('weight')
+            # Edges whose end points snap to the same vertex have no geometry, and so no weight
+            yield v, w if w is not None else 0.0
+
+    def position(self, node):
+        n = self.graph.nodes[node]
+        return n['lat'], n['lon']
+
+    def index_of(self, key):
+        return key if key in self.graph else None
+
+    def key(self, node):
+        return node
+
+    def node_data(self, node):
+        return self.graph.nodes[node]
+
+    def edge_data(self, u, v):
+        return self.graph.get_edge_data(u, v)
+
+    def signature(self):
+        """
+        :return: the same signature CompactGraph.signature gives the graph frozen from this one
+        """
+        nodes = list(self.graph.nodes(data=True))
+        index = {n: i for i, (n, _) in enumerate(nodes)}
+        edges = list(self.graph.edges(data='weight'))
+        return (len(nodes), len(edges), graph_digest(
+            [data.get('lat') for _, data in nodes],
+            [data.get('lon') for _, data in nodes],
+            [n if isinstance(n, int) and not isinstance(n, bool) else -1 for n, _ in nodes],
+            [index[u] for u, _, _ in edges],
+            [index[v] for _, v, _ in edges],
+            [w if w is not None else 0.0 for _, _, w in edges]))
+
+
+class SearchResult:
+    def __init__(self, path, distance, settled):
+        self.path = path
+        self.distance = distance
+        # The number of nodes whose shortest distance was finalized during the search
+        self.settled = settled
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
+class SearchEngine:
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+
+    @abc.abstractmethod
+    def search(self, view, source, target):
+        """
+        Finds the shortest weighted path between source and target
+        :param view: the graph to search, see NetworkXView for the expected interface
+        :param source:
+        :param target:
+        :return: a SearchResult
+        """
+        pass
+
+    @staticmethod
+    def _check_nodes(view, *nodes):
+        for n in nodes:
+            if n not in view:
+                raise nx.NodeNotFound("Node {0} is not in the graph".format(n))
+
+    @staticmethod
+    def _walk_back(pred, node):
+        path = []
+        while node is not None:
+            path.append(node)
+            node = pred[node]
+        path.reverse()
+        return path
+
+
+class DijkstraEngine(SearchEngine):
+    """Plain Dijkstra, stops as soon as the target is settled."""
+    name = "dijkstra"
+
+    def search(self, view, source, target):
+        self._check_nodes(view, source, target)
+        counter = itertools.count()
+        dist = {source: 0.0}
+        pred = {source: None}
+        settled = set()
+        heap = [(0.0, next(counter), source)]
+
+        while heap:
+            du, _, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+
+            if u == target:
+                return SearchResult(self._walk_back(pred, target), du, len(settled))
+
+            for v, w in view.neighbors(u):
+                nd = du + w
+                if nd < dist.get(v, INFINITY):
+                    dist[v] = nd
+                    pred[v] = u
+                    heapq.heappush(heap, (nd, next(counter), v))
+
+        raise nx.NetworkXNoPath("No path between {0} and {1}".format(source, target))
+
+
+class BidirectionalDijkstraEngine(SearchEngine):
+    """
+    Runs Dijkstra from both ends at once (the road graph is undirected, so the backward search uses the same edges),
+    always growing whichever side has the smaller frontier distance.  The search stops once the two frontiers can no
+    longer improve on the best meeting point found so far.
+    """
+    name = "bidirectional_dijkstra"
+
+    def search(self, view, source, target):
+        self._check_nodes(view, source, target)
+        if source == target:
+            return SearchResult([source], 0.0, 1)
+
+        counter = itertools.count()
+        dist = ({source: 0.0}, {target: 0.0})
+        pred = ({source: None}, {target: None})
+        settled = (set(), set())
+        heaps = ([(0.0, next(counter), source)], [(0.0, next(counter), target)])
+        best = INFINITY
+        meeting_node = None
+
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+
+            d = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            other = 1 - d
+            du, _, u = heapq.heappop(heaps[d])
+            if u in settled[d]:
+                continue
+            settled[d].add(u)
+
+            for v, w in view.neighbors(u):
+                nd = du + w
+                if nd < dist[d].get(v, INFINITY):
+                    dist[d][v] = nd
+                    pred[d][v] = u
+                    heapq.heappush(heaps[d], (nd, next(counter), v))
+
+                if v in dist[other]:
+                    total = dist[d][v] + dist[other][v]
+                    if total < best:
+                        best = total
+                        meeting_node = v
+
+        if meeting_node is None:
+            raise nx.NetworkXNoPath("No path between {0} and {1}".format(source, target))
+
+        path = self._walk_back(pred[0], meeting_node)
+        node = pred[1][meeting_node]
+        while node is not None:
+            path.append(node)
+            node = pred[1][node]
+
+        return SearchResult(path, best, len(settled[0]) + len(settled[1]))
+
+
+class AStarEngine(SearchEngine):
+    """A* using the great circle distance to the target (see haversine_degrees) as the heuristic."""
+    name = "astar"
+
+    def search(self, view, source, target):
+        self._check_nodes(view, source, target)
+        target_lat, target_lon = view.position(target)
+        heuristic_cache = {}
+
+        def h(node):
+            if node not in heuristic_cache:
+                lat, lon = view.position(node)
+                heuristic_cache[node] = haversine_degrees(lat, lon, target_lat, target_lon)
+            return heuristic_cache[node]
+
+        counter = itertools.count()
+        dist = {source: 0.0}
+        pred = {source: None}
+        settled = set()
+        heap = [(h(source), next(counter), source)]
+
+        while heap:
+            _, _, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+
+            if u == target:
+                return SearchResult(self._walk_back(pred, target), dist[u], len(settled))
+
+            du = dist[u]
+            for v, w in view.neighbors(u):
+                nd = du + w
+                if nd < dist.get(v, INFINITY):
+                    dist[v] = nd
+                    pred[v] = u
+                    heapq.heappush(heap, (nd + h(v), next(counter), v))
+
+        raise nx.NetworkXNoPath("No path between {0} and {1}".format(source, target))
+
+
+class ShortestPathTree:
+    """The result of a one to many search: the distance to, and predecessor of, every node it settled"""
+
+    def __init__(self, source, dist, pred, settled):
+        self.source = source
+        self.dist = dist
+        self.pred = pred
+        self.settled = settled
+
+    def distance_to(self, node):
+        return self.dist.get(node, INFINITY)
+
+    def path_to(self, node):
+        if node not in self.pred:
+            raise nx.NetworkXNoPath("No path between {0} and {1}".format(self.source, node))
+        return SearchEngine._walk_back(self.pred, node)
+
+
+def dijkstra_to_many(view, source, targets, max_distance=None):
+    """
+    One Dijkstra sweep from source that stops once every target is settled (or the rest of the graph is out of
+    reach), instead of one search per target.
+    :param view: the graph to search, see NetworkXView
+    :param source:
+    :param targets: the nodes the sweep has to reach, None settles every node (within max_distance, if it's given)
+    :param max_distance: nodes further away than this aren't settled, when it's given the sweep settles everything
+                         up to it even after the targets are settled
+    :return: a ShortestPathTree, only settled nodes are in it
+    """
+    sweep_all = targets is None or max_distance is not None
+    targets = targets if targets is not None else []
+    SearchEngine._check_nodes(view, source, *targets)
+    counter = itertools.count()
+    dist = {source: 0.0}
+    pred = {source: None}
+    tree_pred = {}
+    remaining = set(targets)
+    remaining.discard(source)
+    settled = 0
+    heap = [(0.0, next(counter), source)]
+
+    while heap and (remaining or sweep_all):
+        du, _, u = heapq.heappop(heap)
+        if u in tree_pred:
+            continue
+        if max_distance is not None and du > max_distance:
+            break
+        tree_pred[u] = pred[u]
+        settled += 1
+        remaining.discard(u)
+
+        for v, w in view.neighbors(u):
+            nd = du + w
+            if nd < dist.get(v, INFINITY):
+                dist[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd, next(counter), v))
+
+    if source not in tree_pred:
+        tree_pred[source] = None
+    return ShortestPathTree(source, {n: dist[n] for n in tree_pred}, tree_pred, settled)
+
+
+SEARCH_ENGINES = {e.name: e for e in (DijkstraEngine, BidirectionalDijkstraEngine, AStarEngine)}
+
+
+def get_search_engine(name):
+    if name not in SEARCH_ENGINES:
+        raise ValueError("Unknown search engine {0}, expected one of {1}".format(name, ", ".join(SEARCH_ENGINES)))
+    return SEARCH_ENGINES[name]()
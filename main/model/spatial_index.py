@@ -0,0 +1,117 @@
+import math
+import numpy as np
+from main.model.search import INFINITY
+
+# Meters in a degree of great circle arc (mean earth radius)
+METERS_PER_DEGREE = 6371008.8 * math.pi / 180
+
+
+def haversine_degrees_array(lat, lon, lats, lons):
+    """Vectorized search.haversine_degrees, from one point to many (or between two arrays of points)"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))))
+
+
+class NodeIndex:
+    """
+    Finds the graph node nearest to a point.
+
+    The nodes are bucketed in a grid of cell_degrees square cells, stored like the CompactGraph adjacency: node
+    indexes sorted by cell, with the non empty cell ids and where each cell's nodes start.  A query looks at the
+    rings of cells around the point's cell, nearest first, measuring great circle distances to every node it finds,
+    and stops once no node outside the rings searched so far could be closer than the best one found.
+    """
+
+    def __init__(self, nodes, lat, lon, cell_degrees=0.05):
+        """
+        :param nodes: the node (in whatever the graph's view uses) for each position
+        :param lat: array of node latitudes
+        :param lon: array of node longitudes
+        :param cell_degrees:
+        """
+        self.nodes = nodes
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_degrees = cell_degrees
+
+        if len(self.lat) == 0:
+            self.lat0 = self.lon0 = 0.0
+            self.rows = self.cols = 1
+        else:
+            self.lat0, self.lon0 = float(self.lat.min()), float(self.lon.min())
+            # Through __cell_row/__cell_col like the nodes themselves, // rounds differently (30.0 // 0.05 is 599)
+            self.rows = int(self.__cell_row(self.lat.max())) + 1
+            self.cols = int(self.__cell_col(self.lon.max())) + 1
+
+        cells = self.__cell_row(self.lat) * self.cols + self.__cell_col(self.lon)
+        self.order = np.argsort(cells, kind='stable')
+        self.cell_ids, self.cell_starts = np.unique(cells[self.order], return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(self.order))
+
+    @staticmethod
+    def from_view(view, cell_degrees=0.05):
+        """
+        :param view: a CompactGraph or NetworkXView
+        """
+        if hasattr(view, 'lat') and hasattr(view, 'lon'):
+            return NodeIndex(range(0, len(view.lat)), view.lat, view.lon, cell_degrees)
+
+        nodes = list(view.nodes())
+        positions = np.array([view.position(n) for n in nodes], dtype=np.float64).reshape(-1, 2)
+        return NodeIndex(nodes, positions[:, 0], positions[:, 1], cell_degrees)
+
+    def __cell_row(self, lat):
+        return np.floor((np.asarray(lat) - self.lat0) / self.cell_degrees).astype(np.int64)
+
+    def __cell_col(self, lon):
+        return np.floor((np.asarray(lon) - self.lon0) / self.cell_degrees).astype(np.int64)
+
+    def __ring(self, qi, qj, r):
+        """Node positions (indexes into lat/lon) in the cells exactly r cells away from (qi, qj)"""
+        if r == 0:
+            i, j = np.array([qi]), np.array([qj])
+        else:
+            span = np.arange(-r, r + 1)
+            inner = np.arange(-r + 1, r)
+            i = np.concatenate((np.full(len(span), qi - r), np.full(len(span), qi + r), qi + inner, qi + inner))
+            j = np.concatenate((qj + span, qj + span, np.full(len(inner), qj - r), np.full(len(inner), qj + r)))
+
+        inside = (i >= 0) & (i < self.rows) & (j >= 0) & (j < self.cols)
+        ids = i[inside] * self.cols + j[inside]
+        at = np.searchsorted(self.cell_ids, ids)
+        at = at[at < len(self.cell_ids)]
+        at = at[np.isin(self.cell_ids[at], ids)]
+        if len(at) == 0:
+            return None
+        return np.concatenate([self.order[self.cell_starts[a]:self.cell_ends[a]] for a in at])
+
+    def nearest(self, lat, lon):
+        """
+        :return: (node, distance in meters) of the node nearest to the point, (None, None) if there are no nodes
+        """
+        if len(self.lat) == 0:
+            return None, None
+
+        qi, qj = int(self.__cell_row(lat)), int(self.__cell_col(lon))
+        last_ring = max(abs(qi), abs(self.rows - 1 - qi), abs(qj), abs(self.cols - 1 - qj))
+        best, best_distance = None, INFINITY
+        for r in range(0, last_ring + 1):
+            candidates = self.__ring(qi, qj, r)
+            if candidates is not None:
+                distances = haversine_degrees_array(lat, lon, self.lat[candidates], self.lon[candidates])
+                k = int(np.argmin(distances))
+                if distances[k] < best_distance:
+                    best, best_distance = int(candidates[k]), float(distances[k])
+
+            # Anything outside rings 0..r is at least r cells away in latitude or longitude.  A node closer than the
+            # best one is within best_distance degrees of latitude, where a degree of longitude is at its shortest
+            # at the highest latitude in that band.
+            if best_distance < INFINITY:
+                lon_scale = math.cos(math.radians(min(90.0, abs(lat) + best_distance)))
+                gap = math.radians(r * self.cell_degrees)
+                if best_distance <= math.degrees(2 * math.asin(lon_scale * math.sin(gap / 2))):
+                    break
+
+        return self.nodes[best], best_distance * METERS_PER_DEGREE
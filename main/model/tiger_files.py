@@ -0,0 +1,169 @@
+"""
+Reads the graph's input straight from the TIGER shape files, without PostGIS.
+
+This does what manage.py import and sql/metadata_setup.sql do in the database: the roads are read from the
+PRISECROADS files and the places from the PLACE files, gis.roads_intersection becomes a search of an in memory
+spatial index (shapely's STRtree) for roads that cross at a single point, and gis.places_intersection picks, for each
+place, the intersection within 1000 meters of the place closest to its centroid.  The results come back shaped like
+the RoadsDAO/PlacesDAO rows GraphFactory builds the graph from.
+"""
+import multiprocessing
+import numpy as np
+import shapely
+from shapely.geometry import shape, MultiLineString
+from main.model.spatial_index import haversine_degrees_array, METERS_PER_DEGREE
+
+# How close (in meters) an intersection has to be to a place to be the place's node, as in metadata_setup.sql
+PLACE_SEARCH_METERS = 1000
+
+# Set before the worker pool is started so forked workers share them, see find_road_intersections
+_road_geoms = None
+_road_tree = None
+_road_ids = None
+
+
+def _init_worker(road_geoms, road_ids):
+    global _road_geoms, _road_tree, _road_ids
+    _road_geoms, _road_tree, _road_ids = road_geoms, shapely.STRtree(road_geoms), road_ids
+
+
+def read_shapefile(file_name):
+    """
+    :return: a generator of (record as a dict, shapely geometry) for every shape in the file
+    """
+    # pyshp is only needed for building the graph from shape files, the rest of the app never imports it
+    import shapefile
+
+    with shapefile.Reader(file_name, encoding="latin1") as reader:
+        for shape_record in reader.iterShapeRecords():
+            geom = shape(shape_record.shape.__geo_interface__) if shape_record.shape.points else None
+            yield shape_record.record.as_dict(), geom
+
+
+def read_roads(file_names):
+    """
+    :param file_names: PRISECROADS shape files
+    :return: (linearids, MultiLineStrings, rttyps, fullnames), one entry per shape, like the rows of gis.roads
+    """
+    linearids, geoms, types, names = [], [], [], []
+    for file_name in file_names:
+        for record, geom in read_shapefile(file_name):
+            if geom is None:
+                continue
+            linearids.append(record["LINEARID"])
+            # shp2pgsql imports every line as a MULTILINESTRING
+            geoms.append(geom if geom.geom_type == "MultiLineString" else MultiLineString([geom]))
+            types.append(record["RTTYP"])
+            names.append(record["FULLNAME"])
+    return linearids, geoms, types, names
+
+
+def read_places(file_names):
+    """
+    :param file_names: PLACE shape files
+    :return: a list of (gid, name, geom), the gid is the place's GEOID (state and place fips codes) as an integer,
+             which is also its gid in gis.places (see copy_state_rows)
+    """
+    places = []
+    for file_name in file_names:
+        for record, geom in read_shapefile(file_name):
+            if geom is not None:
+                places.append((int(record["GEOID"]), record["NAME"], geom))
+    return places
+
+
+def intersections_of_chunk(chunk):
+    """
+    Finds the roads crossing the roads of a chunk at a single point, outside of find_road_intersections so it can be
+    run in a worker process
+    :param chunk: (first, last) indexes of the chunk's roads
+    :return: (road index, road index, lat, lon) arrays, every pair of roads only once (the lower index first)
+    """
+    first, last = chunk
+    left, right = _road_tree.query(_road_geoms[first:last], predicate="intersects")
+    left = left + first
+    keep = (left < right) & (_road_ids[left] != _road_ids[right])
+    left, right = left[keep], right[keep]
+
+    points = shapely.intersection(_road_geoms[left], _road_geoms[right])
+    keep = (shapely.get_type_id(points) == 0) & ~shapely.equals(_road_geoms[left], _road_geoms[right])
+    left, right, points = left[keep], right[keep], points[keep]
+    return left, right, shapely.get_y(points), shapely.get_x(points)
+
+
+def find_road_intersections(road_geoms, road_ids, processes=1, chunk_size=2000):
+    """
+    The in memory gis.roads_intersection: every two roads with different linearids that cross (or touch) at exactly
+    one point.
+    :param road_geoms: see read_roads
+    :param road_ids: see read_roads
+    :param processes: the chunks of roads are spread over this many worker processes
+    :param chunk_size: roads per chunk
+    :return: (road index, road index, lat, lon) arrays
+    """
+    global _road_geoms, _road_tree, _road_ids
+    road_geoms = np.asarray(road_geoms, dtype=object)
+    road_ids = np.asarray(road_ids, dtype=object)
+    chunks = [(i, min(i + chunk_size, len(road_geoms))) for i in range(0, len(road_geoms), chunk_size)]
+
+    _init_worker(road_geoms, road_ids)
+    try:
+        if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                results = pool.map(intersections_of_chunk, chunks)
+        elif processes > 1:
+            with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(road_geoms, road_ids)) as pool:
+                results = pool.map(intersections_of_chunk, chunks)
+        else:
+            results = [intersections_of_chunk(c) for c in chunks]
+    finally:
+        _road_geoms = _road_tree = _road_ids = None
+
+    if len(results) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([]), np.array([])
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
+def find_place_intersections(places, lat, lon, roads_at):
+    """
+    The in memory gis.places_intersection.  A place's node is the intersection within PLACE_SEARCH_METERS of the
+    place that is closest to the place's centroid, attached to the lowest linearid of the roads through it.  Like
+    metadata_setup.sql a place gets several nodes when intersections tie.
+    :param places: see read_places
+    :param lat: intersection latitudes
+    :param lon: intersection longitudes
+    :param roads_at: intersection index -> the linearids of the roads through it
+    :return: a list of (gid, name, linearid, lat, lon), like PlacesDAO.iter_place_intersections
+    """
+    points = shapely.points(lon, lat)
+    tree = shapely.STRtree(points)
+    # With a little slack, the search below is on a sphere and ST_DWithin on the spheroid
+    search_degrees = PLACE_SEARCH_METERS / METERS_PER_DEGREE * 1.01
+    results = []
+    for gid, name, geom in places:
+        min_lon, min_lat, max_lon, max_lat = geom.bounds
+        # A degree of longitude is shortest at the latitude furthest from the equator
+        lon_scale = np.cos(np.radians(min(89.0, max(abs(min_lat), abs(max_lat)) + search_degrees)))
+        candidates = tree.query(shapely.box(min_lon - search_degrees / lon_scale, min_lat - search_degrees,
+                                            max_lon + search_degrees / lon_scale, max_lat + search_degrees))
+        if len(candidates) == 0:
+            continue
+
+        # Great circle distance from each intersection to the nearest point of the place (0 inside it)
+        nearest = shapely.get_point(shapely.shortest_line(points[candidates], geom), 1)
+        meters = haversine_degrees_array(lat[candidates], lon[candidates], shapely.get_y(nearest),
+                                         shapely.get_x(nearest)) * METERS_PER_DEGREE
+        candidates = candidates[meters <= PLACE_SEARCH_METERS]
+        if len(candidates) == 0:
+            continue
+
+        distances = shapely.distance(geom.centroid, points[candidates])
+        closest = candidates[distances == distances.min()]
+        for location in sorted({(lat[c], lon[c]) for c in closest}):
+            linearids = set()
+            for c in closest:
+                if (lat[c], lon[c]) == location:
+                    linearids.update(roads_at[c])
+            results.append((gid, name, str(min(int(r) for r in linearids)), location[0], location[1]))
+    return results
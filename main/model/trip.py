@@ -0,0 +1,67 @@
+"""
+Orders the stops of a trip so the whole trip is as short as possible, given the travel matrix between them (see
+RoadGraph.travel_matrix).  This is the traveling salesman problem, so rather than the best order it finds a good one:
+a nearest neighbour tour improved with 2-opt moves (reversing a stretch of the tour) until none of them helps.
+"""
+import numpy as np
+
+
+def trip_length(matrix, order):
+    return sum(matrix[a, b] for a, b in zip(order, order[1:]))
+
+
+def nearest_neighbour_order(matrix, keep_last=True):
+    """
+    :param matrix: n x n travel costs
+    :param keep_last: the last stop stays the last one (a trip from the first stop to the last through the rest)
+    :return: the stop indexes, starting with 0, each next one the closest stop not visited yet
+    """
+    n = len(matrix)
+    order = [0]
+    left = set(range(1, n - 1 if keep_last and n > 1 else n))
+    while left:
+        here = order[-1]
+        nearest = min(left, key=lambda s: (matrix[here, s], s))
+        order.append(nearest)
+        left.remove(nearest)
+    if keep_last and n > 1:
+        order.append(n - 1)
+    return order
+
+
+def two_opt(matrix, order, keep_last=True):
+    """
+    Reverses stretches of the order while that makes the trip shorter, the first stop (and the last one if
+    keep_last) never move
+    :return: the improved order
+    """
+    order = list(order)
+    n = len(order)
+    last = n - 2 if keep_last else n - 1
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, last):
+            for j in range(i + 1, last + 1):
+                a, b = order[i - 1], order[i]
+                c = order[j]
+                # The edge after the stretch, if there is one
+                d = order[j + 1] if j + 1 < n else None
+                before = matrix[a, b] + (matrix[c, d] if d is not None else 0.0)
+                after = matrix[a, c] + (matrix[b, d] if d is not None else 0.0)
+                if after < before - 1e-12:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+    return order
+
+
+def order_stops(matrix, keep_last=True):
+    """
+    :param matrix: n x n travel costs, symmetric (the road graph is undirected)
+    :param keep_last: see nearest_neighbour_order
+    :return: the stop indexes in the order to visit them, starting with 0
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if len(matrix) <= 2:
+        return list(range(0, len(matrix)))
+    return two_opt(matrix, nearest_neighbour_order(matrix, keep_last), keep_last)
@@ -1,126 +1,89 @@
+import datetime
+import io
 import time
+import shapely.wkb
 import shapely.wkt
+from shapely.geometry import Point
 from main.model.graph import Route
 from main.model.graph import Step
-from main.model import with_pg_connection
+from main.model import with_pg_connection, with_pg_connection_raising
 
 
 class UserRoutesDAO:
     @staticmethod
-    @with_pg_connection
-    def insert_and_decorate_route(route, **kwargs):
-        """
-        Takes a route object and inserts it into the database.  The process of insertion adds some additional vaulues
-        to the route.  The GEOM is not returned for steps though.
+    def _copy_value(value):
+        """Formats a value for COPY's text format"""
+        if value is None:
+            return "\\N"
+        return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
 
-        :param route:
-        :param kwargs:
-        """
-        c = kwargs['cursor']
-        conn = kwargs['connection']
-        epoch_time = int(time.time())
-        route_id = route.id
+    @staticmethod
+    def _ewkb(geom):
+        return shapely.wkb.dumps(geom, hex=True, srid=4269) if geom is not None and not geom.is_empty else None
 
+    @staticmethod
+    def _route_rows(route, last_accessed):
+        ewkb = UserRoutesDAO._ewkb
+        rows = []
         for i in range(0, len(route.steps)):
             step = route.steps[i]
+            rows.append((route.id, i, step.name, 'STEP', ewkb(Point(step.start_lon, step.start_lat)),
+                         step.distance_meters if step.geom is not None else None,
+                         ewkb(step.geom_centroid), ewkb(step.geom_bbox), ewkb(step.geom), last_accessed))
 
-            if step.geom is not None:
-                insert_sql = """
-                    INSERT INTO gis.user_routes VALUES(
-                        %s,
-                        %s,
-                        %s,
-                        'STEP',
-                        ST_GeomFromText('POINT({0} {1})', 4269),
-                        ST_Length(ST_GeomFromText('{2}', 4269), true),
-                        ST_Centroid(ST_GeomFromText('{2}', 4269)),
-                        ST_Envelope(ST_GeomFromText('{2}', 4269)),
-                        ST_GeomFromText('{2}', 4269),
-                        TIMESTAMP WITH TIME ZONE 'epoch' + %s * INTERVAL '1 second'
-                    )
-                """.format(step.start_lon, step.start_lat, step.geom.wkt)
+        # gis.user_routes.geom only takes a LineString, a route that can't be merged into one keeps a NULL geom
+        route_geom = route.geom if route.geom is not None and route.geom.geom_type == 'LineString' else None
+        rows.append((route.id, None, route.name, 'ROUTE', ewkb(Point(route.start_lon, route.start_lat)),
+                     route.distance_meters, ewkb(route.geom_centroid), ewkb(route.geom_bbox), ewkb(route_geom),
+                     last_accessed))
+        return rows
 
-            else:
-                insert_sql = """
-                    INSERT INTO gis.user_routes VALUES(
-                        %s,
-                        %s,
-                        %s,
-                        'STEP',
-                        ST_GeomFromText('POINT({0} {1})', 4269),
-                        NULL,
-                        NULL,
-                        NULL,
-                        NULL,
-                        TIMESTAMP WITH TIME ZONE 'epoch' + %s * INTERVAL '1 second'
-                    )
-                """.format(step.start_lon, step.start_lat)
-
-            c.execute(insert_sql, (route_id, i, step.name, epoch_time))
-            i += 1
-
-        # Now that the steps are inserted, we need to insert the Route itself.
-        insert_route_sql = """
-                    INSERT INTO gis.user_routes VALUES(
-                        %s,
-                        NULL,
-                        %s,
-                        'ROUTE',
-                        ST_GeomFromText('POINT({0} {1})', 4269),
-                        NULL,
-                        NULL,
-                        NULL,
-                        NULL,
-                        TIMESTAMP WITH TIME ZONE 'epoch' + %s * INTERVAL '1 second'
-                    )
-                """.format(route.start_lon, route.start_lat)
-
-        c.execute(insert_route_sql, (route_id, route.name, epoch_time))
-        conn.commit()
-
-        # Now we need to update the inserted route with some aggregrate values from the steps
-        c.execute("""
-            UPDATE gis.user_routes
-            SET geom_length_meters = agg_steps.length_meters,
-                geom_centroid = agg_steps.centroid,
-                geom_extent = agg_steps.envelope,
-                geom = agg_steps.geom,
-                last_accessed = agg_steps.last_accessed
-
-            FROM (
-                SELECT SUM(geom_length_meters) AS length_meters, ST_Centroid(ST_Union(geom)) AS centroid, ST_Envelope(ST_Union(geom)) AS envelope, ST_Linemerge(ST_Collect(geom)) AS geom, MIN(last_accessed) AS last_accessed
-                FROM gis.user_routes
-                WHERE route_id='{0}'
-                AND entry_type = 'STEP'
-                GROUP BY route_id
-            ) AS agg_steps
-            WHERE route_id = '{0}'
-            AND entry_type = 'ROUTE'
-        """.format(route_id))
-        conn.commit()
-
-        return route_id
+    @staticmethod
+    def insert_and_decorate_route(route):
+        """
+        Takes a route object and inserts it into the database.  The per step and route wide values (lengths,
+        centroids, extents and the merged route geometry) are calculated in Python (see Route.decorate).
+
+        :param route:
+        :return: the route id
+        """
+        UserRoutesDAO.insert_routes([route.decorate()])
+        return route.id
 
     @staticmethod
-    @with_pg_connection
+    @with_pg_connection_raising
+    def insert_routes(routes, **kwargs):
+        """
+        Inserts already decorated routes (see Route.decorate).  Every row of every route, steps and routes, goes to
+        the database in a single COPY followed by a single commit, so this costs the same couple of round trips
+        however many routes and steps there are.  A failed insert raises, so the RouteWriter can retry it.
+
+        :param routes: a list of Routes
+        :param kwargs:
+        """
+        # UTC, like the rows written before from the epoch, the column has no time zone
+        last_accessed = datetime.datetime.fromtimestamp(int(time.time()), datetime.timezone.utc) \
+            .replace(tzinfo=None).isoformat()
+        data = "".join("\t".join(UserRoutesDAO._copy_value(v) for v in row) + "\n"
+                       for route in routes
+                       for row in UserRoutesDAO._route_rows(route, last_accessed))
+
+        kwargs['cursor'].execute("""
+            COPY gis.user_routes (route_id, step_id, step_name, entry_type, starting_point, geom_length_meters,
+                                  geom_centroid, geom_extent, geom, last_accessed)
+            FROM STDIN
+        """, stream=io.BytesIO(data.encode('utf-8')))
+        kwargs['connection'].commit()
+
+    @staticmethod
+    @with_pg_connection_raising
     def get_route_from_db(route_id, **kwargs):
-        c = kwargs['cursor']
+        """
+        :return: the Route as it was written, None if there's no such route.  Raises if the database can't be read.
+        """
         return_geom = kwargs['return_geom']
 
-        if return_geom:
-            c.execute("""SELECT route_id,
-                            step_id,
-                            step_name,
-                            entry_type,
-                            ST_AsText(starting_point),
-                            geom_length_meters,
-                            ST_AsText(geom_centroid),
-                            ST_AsText(geom_extent),
-                            ST_AsText(geom),
-                       FROM gis.user_routes WHERE route_id = '{0}'
-                       ORDER BY entry_type, step_id ASC""".format(str(route_id)))
-        else:
-            c.execute("""SELECT route_id,
+        rows = kwargs['connection'].prepare("""SELECT route_id,
                             step_id,
                             step_name,
                             entry_type,
@@ -128,13 +91,14 @@ class UserRoutesDAO:
                             geom_length_meters,
                             ST_AsText(geom_centroid),
                             ST_AsText(geom_extent),
-                            NULL
-                       FROM gis.user_routes WHERE route_id = '{0}'
-                       ORDER BY entry_type, step_id ASC""".format(str(route_id)))
+                            {0}
+                       FROM gis.user_routes WHERE route_id = :route_id
+                       ORDER BY entry_type, step_id ASC""".format("ST_AsText(geom)" if return_geom else "NULL"))\
+            .run(route_id=str(route_id))
 
         steps = []
         route = None
-        for row in c.fetchall():
+        for row in rows:
             (route_id, step_id, step_name, entry_type, starting_point_str, geom_length_meters, geom_centroid_str, geom_extent_str, geom_str) = row
             sp = shapely.wkt.loads(starting_point_str)
             gc = shapely.wkt.loads(geom_centroid_str) if geom_centroid_str is not None else None
@@ -1,20 +1,60 @@
+import atexit
 import json
+import uuid
 import networkx.exception
-from flask import Blueprint, Response
+from flask import Blueprint, Response, request, redirect, url_for
 import shapely.ops
 from main.util.nocache import nocache
+from main.util.cacheable import cacheable_response
 from main import DEFAULT_LOGGER
-from main.model.places_dao import PlacesDAO
+from main.config.config import graph_config, route_cache_config, route_writer_config, trip_config, batch_config
+from main.model import connection_pool
+from main.model.place_catalog import place_catalog, PlaceCatalogError
+from main.model.batch_routes import BatchPool, result_json
 from main.model.graph import RoadGraph, Step
+from main.model.graph_holder import GraphHolder
+from main.model.geometry_store import GeometryStore
+from main.model.route_cache import RouteCache
+from main.model.route_writer import RouteWriter
 from main.model.user_routes_dao import UserRoutesDAO
 
 graph_endpoints = Blueprint('graph', __name__)
+graph_holder = GraphHolder(graph_config["graph_file"],
+                           graph_config["reload_check_interval_seconds"],
+                           compact=graph_config["compact_graph"])
+route_cache = RouteCache(route_cache_config["max_size"], route_cache_config["ttl_seconds"])
+# Routes calculated on the old graph aren't served once a new one is swapped in
+graph_holder.add_swap_listener(route_cache.clear)
+route_writer = RouteWriter(UserRoutesDAO.insert_routes,
+                           route_writer_config["batch_size"],
+                           route_writer_config["max_delay_seconds"])
+atexit.register(route_writer.close, route_writer_config["flush_timeout_seconds"])
+# Started by init_graph, before the app runs any threads, and restarted with every new graph
+batch_pool = BatchPool(batch_config["processes"], batch_config["chunk_size"], compact=graph_config["compact_graph"])
+graph_holder.add_swap_listener(batch_pool.restart)
+atexit.register(batch_pool.close)
+
+
+def init_graph(graph_file=None):
+    """
+    Loads the graph and the place catalog into memory, this should be called once before the web app starts taking
+    requests.
+    :param graph_file: overrides the graph file from the config
+    """
+    if graph_file is not None:
+        graph_holder.graph_file = graph_file
+    graph_holder.load()
+    batch_pool.start(graph_holder.graph_file)
+    try:
+        place_catalog.load()
+    except Exception as e:
+        # Not fatal, the catalog is loaded again by the first request that needs it
+        DEFAULT_LOGGER.error("Could not load the place catalog: " + str(e))
 
 
 def get_graph():
     try:
-        g = RoadGraph.load_graph("graph.pickle")
-        return g
+        return graph_holder.get()
     except:
         DEFAULT_LOGGER.error("Could not load graph")
 
@@ -42,7 +82,7 @@ def convert_steps_to_json_response(steps):
             distance_meters += s.distance_meters
 
         try:
-            (minx, miny, maxx, maxy) = shapely.ops.cascaded_union(
+            (minx, miny, maxx, maxy) = shapely.ops.unary_union(
                     [x.geom_bbox for x in cg if x.geom_bbox is not None]).bounds
         except ValueError:
             (minx, miny, maxx, maxy) = (None, None, None, None)
@@ -80,28 +120,143 @@ def convert_steps_to_json_response(steps):
     return dds
 
 
+@graph_endpoints.route("/status", methods=["GET"])
+@nocache
+def get_status():
+    status = {
+        'graph': graph_holder.status(),
+        'db_pool': connection_pool.stats(),
+        'route_cache': route_cache.stats(),
+        'route_writer': route_writer.stats(),
+        'place_catalog': place_catalog.status()
+    }
+    graph = get_graph()
+    if graph is not None and graph.compact is not None and isinstance(graph.compact.edge_geoms, GeometryStore):
+        status['geometries'] = graph.compact.edge_geoms.stats()
+    if graph is not None and graph.distance_table is not None:
+        status['distance_table'] = {'places': len(graph.distance_table),
+                                    'radius_meters': graph.distance_table.radius_meters}
+    return Response(json.dumps(status, indent=4), mimetype='application/json')
+
+
 @graph_endpoints.route("/places/<name>", methods=["GET"])
 @nocache
 def get_places_from_partial_name(name):
     print(name)
-    rl = PlacesDAO.get_city_and_state_from_partial(name)
+    try:
+        rl = place_catalog.search(name)
+    except PlaceCatalogError as e:
+        return str(e), 503
     return Response(json.dumps(rl, indent=4), mimetype='application/json')
 
 
-@graph_endpoints.route("/calc_route/from/<int:first_id>/to/<int:second_id>")
+@graph_endpoints.route("/route/<route_id>/flush")
 @nocache
-def calculate_route(first_id, second_id):
+def flush_route(route_id):
+    """
+    Makes sure a route is in gis.user_routes, the client calls this before asking GeoServer to draw the route.
+    """
+    persisted = route_writer.flush(route_id, route_writer_config["flush_timeout_seconds"])
+    rsp = json.dumps({'route_id': route_id, 'persisted': persisted}, indent=4)
+    return Response(rsp, status=200 if persisted else 503, mimetype='application/json')
+
+
+@graph_endpoints.route("/route/<route_id>")
+def get_route(route_id):
+    """
+    A calculated route, the route endpoints redirect here.  Routes still in the route cache are served as the exact
+    response that was cached, which never changes, so browsers and proxies can keep it for good (see
+    main/util/cacheable.py).  Older ones are rebuilt from gis.user_routes, which doesn't keep everything the original
+    response had (e.g. a trip's stops) and has its coordinates rounded, so those have to be revalidated.
+    """
     try:
-        route = get_graph().shortest_route(first_id, second_id)
-    except networkx.exception.NetworkXError as e:
+        uuid.UUID(route_id)
+    except ValueError:
+        return "No route " + route_id, 404
+
+    cached = route_cache.get_by_route_id(route_id)
+    if cached is not None:
+        return cacheable_response(cached.response, immutable=True)
+
+    route_writer.flush(route_id, route_writer_config["flush_timeout_seconds"])
+    try:
+        route = UserRoutesDAO.get_route_from_db(route_id, return_geom=False)
+    except Exception as e:
+        DEFAULT_LOGGER.error("Could not read route {0}: {1}".format(route_id, str(e)))
+        return "Could not read the route", 503
+    if route is None:
+        return "No route " + route_id, 404
+    return cacheable_response(compact_json(route_body(route)), immutable=False)
+
+
+def compact_json(rsp):
+    """Route responses are sent without any whitespace, they're big and only read by the client"""
+    return json.dumps(rsp, separators=(',', ':'))
+
+
+def route_redirect(route_id):
+    """
+    :return: a 303 to /graph/route/<route_id>, which the client follows with a GET it (and any proxy) can cache
+    """
+    return redirect(url_for('graph.get_route', route_id=route_id), code=303)
+
+
+def route_response(graph, version, source_id, target_id):
+    """
+    Calculates (or finds in the route cache) the route between two graph nodes
+    :param graph: the graph, as returned by get_graph()
+    :param version: the graph's version, read before the graph itself
+    :param source_id:
+    :param target_id:
+    :return: the Flask response
+    """
+    cache_key = RouteCache.key(source_id, target_id, version)
+    cached = route_cache.get(cache_key)
+    if cached is not None:
+        return route_redirect(cached.route_id)
+
+    try:
+        route = graph.shortest_route(source_id, target_id)
+    except networkx.exception.NetworkXException as e:
         return "Graph error: " + str(e), 400
 
-    route_id = UserRoutesDAO.insert_and_decorate_route(route)
-    route = UserRoutesDAO.get_route_from_db(route_id, return_geom=False)
+    return respond_with_route(route, cache_key)
+
+
+def respond_with_route(route, cache_key, **extra):
+    """
+    Hands a newly calculated route to the route writer and caches the response, the client is redirected to it
+    :param route: a Route
+    :param cache_key: see RouteCache.key
+    :param extra: added to the response's JSON
+    :return: the Flask response
+    """
+    rsp = route_json(route)
+    rsp.update(extra)
+    route_cache.put(cache_key, route, compact_json(rsp), route.id)
+    return route_redirect(route.id)
+
+
+def route_json(route):
+    """
+    Decorates a newly calculated route and hands it to the route writer
+    :return: the route's part of the response, as a dict
+    """
+    # The response only needs the in memory route, writing it to gis.user_routes happens in the background
+    route.decorate()
+    route_writer.submit(route)
+    return route_body(route)
+
+
+def route_body(route):
+    """
+    :param route: a decorated Route
+    :return: the route's part of the response, as a dict
+    """
     steps_rsp = convert_steps_to_json_response(route.steps)
 
     (minx, miny, maxx, maxy) = route.geom_bbox.bounds
-    rsp = {
+    return {
         'route_id': route.id,
         'steps': steps_rsp,
         'minx': minx,
@@ -116,4 +271,169 @@ def calculate_route(first_id, second_id):
         },
     }
 
+
+@graph_endpoints.route("/calc_route/from/<int:first_id>/to/<int:second_id>")
+@nocache
+def calculate_route(first_id, second_id):
+    # Read the version before the graph, if a swap happens in between the route is cached under the old version
+    version = graph_holder.version
+    return route_response(get_graph(), version, first_id, second_id)
+
+
+@graph_endpoints.route("/calc_route/from/<int:first_id>/to/<int:second_id>/alternatives")
+@nocache
+def calculate_alternative_routes(first_id, second_id):
+    """
+    The shortest route and up to alternatives_config["count"] - 1 reasonably different ones, as a list of the same
+    responses /calc_route answers with
+    """
+    graph = get_graph()
+    try:
+        routes = graph.alternative_routes(first_id, second_id)
+    except networkx.exception.NetworkXException as e:
+        return "Graph error: " + str(e), 400
+
+    return Response(compact_json([route_json(route) for route in routes]), mimetype='application/json')
+
+
+@graph_endpoints.route("/distance/from/<int:first_id>/to/<int:second_id>")
+@nocache
+def get_distance(first_id, second_id):
+    """
+    The length of the route between two places without the route itself, looked up in the precomputed distance table
+    (see manage.py distance_table) when it has the pair.  "via" lists the places the route passes through, it's null
+    when the table doesn't keep them.
+    """
+    graph = get_graph()
+    try:
+        weight, distance_meters, via = graph.place_distance(first_id, second_id)
+    except networkx.exception.NetworkXException as e:
+        return "Graph error: " + str(e), 400
+
+    rsp = {
+        'from': first_id,
+        'to': second_id,
+        'weight': weight,
+        'distance_meters': distance_meters,
+        'via': via
+    }
     return Response(json.dumps(rsp, indent=4), mimetype='application/json')
+
+
+@graph_endpoints.route("/calc_route/from_point/<lat>/<lon>/to/<int:second_id>")
+@nocache
+def calculate_route_from_point(lat, lon, second_id):
+    """
+    Routes from any point (e.g. a click on the map) to a place, starting at the graph node nearest to the point (the
+    first step of the route).  lat and lon are parsed here since Flask's float converter doesn't take negative
+    numbers.
+    """
+    try:
+        lat, lon = float(lat), float(lon)
+    except ValueError:
+        return "lat and lon must be numbers", 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return "lat and lon are out of range", 400
+
+    version = graph_holder.version
+    graph = get_graph()
+    try:
+        node_id, distance_meters = graph.nearest_node(lat, lon)
+    except networkx.exception.NetworkXException as e:
+        return "Graph error: " + str(e), 400
+
+    DEFAULT_LOGGER.debug("Snapped {0}, {1} to node {2}, {3:.0f} meters away".format(lat, lon, node_id, distance_meters))
+    return route_response(graph, version, node_id, second_id)
+
+
+@graph_endpoints.route("/calc_trip")
+@nocache
+def calculate_trip():
+    """
+    Routes through several places, /graph/calc_trip?stops=<gid>,<gid>,...&optimize=true.  The trip starts at the
+    first stop and ends at the last one, with optimize the stops in between are visited in the order that makes the
+    trip shortest (the response's "stops" is the order they're visited in).
+    """
+    try:
+        stops = [int(s) for s in request.args.get("stops", "").split(",") if s.strip() != ""]
+    except ValueError:
+        return "stops must be a comma separated list of place ids", 400
+    if not (2 <= len(stops) <= trip_config["max_stops"]):
+        return "A trip needs between 2 and {0} stops".format(trip_config["max_stops"]), 400
+    optimize = request.args.get("optimize", "false").lower() in ("1", "true", "yes")
+
+    version = graph_holder.version
+    graph = get_graph()
+    cache_key = RouteCache.key(("trip",) + tuple(stops), optimize, version)
+    cached = route_cache.get(cache_key)
+    if cached is not None:
+        return route_redirect(cached.route_id)
+
+    try:
+        route = graph.trip_route(stops, optimize)
+    except networkx.exception.NetworkXException as e:
+        return "Graph error: " + str(e), 400
+
+    return respond_with_route(route, cache_key, stops=route.stops)
+
+
+def batch_node_id(graph, value):
+    """
+    :param value: one end of a /graph/calc_routes pair, a place id or a [lat, lon] point
+    :return: the graph node to route from or to, the node nearest to a point
+    :raises ValueError: if value is neither
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, list) and len(value) == 2 and \
+            all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in value):
+        lat, lon = value
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError("{0} is out of range".format(json.dumps(value)))
+        return graph.nearest_node(lat, lon)[0]
+    raise ValueError("{0} is neither a place id nor a [lat, lon] point".format(json.dumps(value)))
+
+
+@graph_endpoints.route("/calc_routes", methods=["POST"])
+@nocache
+def calculate_routes():
+    """
+    Calculates the routes between many pairs of places at once.  Takes {"pairs": [[from, to], ...], "persist": false}
+    and streams back one JSON line per pair (NDJSON), in the order of the pairs.  Both ends of a pair are place ids or
+    [lat, lon] points (snapped to the nearest node), a pair that's neither gets an error line.  With persist the routes
+    are also written to gis.user_routes (in the background, like single routes) and each line has the route's
+    route_id.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("pairs"), list):
+        return 'Expected a JSON body like {"pairs": [[from, to], ...]}', 400
+    if not all(isinstance(p, list) and len(p) == 2 for p in body["pairs"]):
+        return "Every pair must be a list of two places", 400
+    if len(body["pairs"]) > batch_config["max_pairs"]:
+        return "At most {0} pairs can be calculated at once".format(batch_config["max_pairs"]), 400
+    persist = bool(body.get("persist", False))
+    graph = get_graph()
+
+    # (pair as given, (from node, to node) or None, error), only the pairs without an error go to the workers
+    pairs = []
+    for pair in body["pairs"]:
+        try:
+            pairs.append((tuple(pair), tuple(batch_node_id(graph, x) for x in pair), None))
+        except (ValueError, networkx.exception.NetworkXException) as e:
+            pairs.append((tuple(pair), None, str(e)))
+
+    def generate():
+        results = batch_pool.iter_routes(graph, [nodes for _, nodes, error in pairs if error is None],
+                                         keep_routes=persist)
+        for pair, _, error in pairs:
+            if error is not None:
+                yield result_json(pair, None, error=error)
+                continue
+            _, summary, route, error = next(results)
+            route_id = None
+            if route is not None:
+                route_writer.submit(route)
+                route_id = route.id
+            yield result_json(pair, summary, route_id, error)
+
+    return Response(generate(), mimetype='application/x-ndjson')
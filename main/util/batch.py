@@ -0,0 +1,58 @@
+import sys
+import time
+from main import DEFAULT_LOGGER
+from main.config.config import batch_config, route_writer_config
+from main.model.batch_routes import iter_batch_routes, result_json, parse_pair
+from main.model.graph import RoadGraph
+from main.model.place_catalog import place_catalog
+
+
+def batch_routes(graph_name, pairs_file, results_file="-", persist=False):
+    """
+    Calculates the routes for every pair in pairs_file and writes one JSON line per pair to results_file
+    :param graph_name: the graph file
+    :param pairs_file: one "from,to" pair per line (see parse_pair), blank lines and lines starting with # are skipped
+    :param results_file: where to write the results, - for stdout
+    :param persist: also write the routes to gis.user_routes
+    """
+    graph = RoadGraph.load_graph(graph_name)
+    try:
+        # Loaded before the workers fork, so they all share it
+        place_catalog.load()
+    except Exception as e:
+        DEFAULT_LOGGER.error("Could not load the place catalog: " + str(e))
+
+    writer = None
+    if persist:
+        from main.model.route_writer import RouteWriter
+        from main.model.user_routes_dao import UserRoutesDAO
+        writer = RouteWriter(UserRoutesDAO.insert_routes, route_writer_config["batch_size"],
+                             route_writer_config["max_delay_seconds"])
+
+    def pairs():
+        with open(pairs_file) as ifile:
+            for line in ifile:
+                if line.strip() != "" and not line.startswith("#"):
+                    yield parse_pair(line)
+
+    start = time.time()
+    routes = errors = 0
+    ofile = sys.stdout if results_file == "-" else open(results_file, 'w')
+    try:
+        for pair, summary, route, error in iter_batch_routes(graph, pairs(), batch_config["processes"],
+                                                             batch_config["chunk_size"], keep_routes=persist):
+            route_id = None
+            if route is not None:
+                writer.submit(route)
+                route_id = route.id
+            ofile.write(result_json(pair, summary, route_id, error))
+            routes += 1
+            errors += error is not None
+    finally:
+        if ofile is not sys.stdout:
+            ofile.close()
+        if writer is not None:
+            writer.close()
+
+    DEFAULT_LOGGER.info("Calculated {0} routes ({1} failed) in {2:.1f} seconds"
+                        .format(routes, errors, time.time() - start))
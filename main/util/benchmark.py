@@ -0,0 +1,160 @@
+import math
+import random
+import time
+import tracemalloc
+import networkx as nx
+from shapely.geometry import Point, LineString
+from main import DEFAULT_LOGGER
+from main.model.graph import RoadGraph
+from main.model.search import NetworkXView, get_search_engine
+from main.model.compact_graph import CompactGraph
+from main.model.linear_ref import RoadGeometry
+
+
+def traced_size(build):
+    """
+    :param build: a function creating some object
+    :return: (the object, the number of bytes allocated while building it that are still alive)
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        obj = build()
+        return obj, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def time_queries(view, pairs, engine_name):
+    engine = get_search_engine(engine_name)
+    settled = 0
+    start = time.time()
+    for s, t in pairs:
+        try:
+            settled += engine.search(view, s, t).settled
+        except nx.NetworkXNoPath:
+            pass
+    return (time.time() - start) / len(pairs) * 1000, settled / len(pairs)
+
+
+def benchmark_graph(graph_file, query_count=100, seed=0):
+    """
+    Compares the networkx graph with its CompactGraph: memory used (edge geometries excluded, both refer to the
+    same objects) and the average time of random queries.
+    :param graph_file: a graph written by GraphFactory.construct_graph
+    :param query_count: number of random node pairs to route between
+    :param seed:
+    :return: a dict of the results
+    """
+    r = RoadGraph.load_graph(graph_file)
+    if r.graph is None:
+        r.graph = r.compact.to_networkx()
+
+    def networkx_structure():
+        g = nx.Graph()
+        g.add_nodes_from(r.graph.nodes(data=True))
+        g.add_edges_from((u, v, {k: val for k, val in d.items() if k != 'geom'})
+                         for u, v, d in r.graph.edges(data=True))
+        return g
+
+    _, networkx_bytes = traced_size(networkx_structure)
+    start = time.time()
+    compact = CompactGraph.from_networkx(r.graph)
+    build_seconds = time.time() - start
+
+    rnd = random.Random(seed)
+    keys = list(r.graph.nodes)
+    key_pairs = [(rnd.choice(keys), rnd.choice(keys)) for _ in range(0, query_count)]
+    index_pairs = [(compact.index_of(s), compact.index_of(t)) for s, t in key_pairs]
+
+    results = {
+        "nodes": compact.number_of_nodes(),
+        "edges": compact.number_of_edges(),
+        "networkx_bytes": networkx_bytes,
+        "compact_bytes": compact.nbytes,
+        "compact_build_seconds": build_seconds
+    }
+    for engine_name in ("dijkstra", "astar"):
+        ms, settled = time_queries(NetworkXView(r.graph), key_pairs, engine_name)
+        results["networkx_" + engine_name + "_ms"] = ms
+        results["networkx_" + engine_name + "_settled"] = settled
+        ms, settled = time_queries(compact, index_pairs, engine_name)
+        results["compact_" + engine_name + "_ms"] = ms
+        results["compact_" + engine_name + "_settled"] = settled
+
+    for k in sorted(results):
+        DEFAULT_LOGGER.info("{0}: {1}".format(k, results[k]))
+
+    return results
+
+
+def legacy_substring(line, position, destination):
+    """
+    How graph_factory.calc_geom used to cut an edge out of a road, kept as the baseline for benchmark_substrings:
+    each end is located with a bisection that builds a LineString of half of the remaining coordinates and checks
+    whether the point intersects it.
+    """
+    def get_line_index(point, index):
+        if index[0] == index[1]:
+            return index[0]
+
+        if index[1] - index[0] == 1:
+            return index[0] if Point(line.coords[index[0]]).distance(point) < \
+                Point(line.coords[index[1]]).distance(point) else index[1]
+
+        pivot_point = math.floor((index[1] - index[0])/2) + index[0]
+        i1 = (index[0], pivot_point)
+        i2 = (pivot_point+1, index[1])
+
+        if i1[0] != i1[1] and LineString(line.coords[i1[0]:i1[1]+1]).intersects(point):
+            return get_line_index(point, i1)
+        else:
+            return get_line_index(point, i2)
+
+    if not (line.intersects(position) and line.intersects(destination)):
+        return None
+    op = get_line_index(position, (0, len(line.coords)-1))
+    dp = get_line_index(destination, (0, len(line.coords)-1))
+    begin, end = (op, dp) if op < dp else (dp, op)
+    return LineString(line.coords[begin:end+1]) if begin != end else None
+
+
+def benchmark_substrings(road_count=20, vertices=2000, nodes_per_road=100, seed=0):
+    """
+    Times cutting the edges between consecutive nodes out of synthetic roads, with the old per edge bisection and
+    with the batched linear referencing in RoadGeometry.  Nodes sit on road vertices, like road intersections do.
+    :return: a dict of the results
+    """
+    rnd = random.Random(seed)
+    roads = []
+    for _ in range(0, road_count):
+        lon, lat = rnd.uniform(-100, -80), rnd.uniform(30, 40)
+        coords = []
+        for _ in range(0, vertices):
+            lon, lat = lon + rnd.uniform(0, 0.001), lat + rnd.uniform(-0.001, 0.001)
+            coords.append((lon, lat))
+        node_vertices = sorted(rnd.sample(range(0, vertices), nodes_per_road))
+        roads.append((LineString(coords), [Point(coords[i]) for i in node_vertices]))
+
+    start = time.time()
+    for line, points in roads:
+        for a, b in zip(points, points[1:]):
+            legacy_substring(line, a, b)
+    legacy_seconds = time.time() - start
+
+    start = time.time()
+    for line, points in roads:
+        xy = [(p.x, p.y) for p in points]
+        RoadGeometry(line).cut([(i, i + 1) for i in range(0, len(xy) - 1)], xy, 1e-9)
+    vectorized_seconds = time.time() - start
+
+    results = {
+        "edges": road_count * (nodes_per_road - 1),
+        "legacy_seconds": legacy_seconds,
+        "vectorized_seconds": vectorized_seconds,
+        "speedup": legacy_seconds / vectorized_seconds
+    }
+    for k in sorted(results):
+        DEFAULT_LOGGER.info("{0}: {1}".format(k, results[k]))
+
+    return results
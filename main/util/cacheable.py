@@ -0,0 +1,72 @@
+"""
+Responses browsers and proxies can cache, like a calculated route (see /graph/route/<route_id>), the opposite of
+nocache.
+
+They're sent with a strong ETag, a hash of the bytes actually sent, and a client revalidating with If-None-Match gets
+a 304.  A body that's the same every time the resource is asked for also gets a long, immutable Cache-Control, one
+that may differ (e.g. rebuilt from the database) has to be revalidated before it's reused.  The body is compressed
+with brotli (when the brotli package is installed) or gzip, whichever the client prefers, every encoding has its own
+ETag.
+"""
+import gzip
+import hashlib
+from functools import lru_cache
+from flask import Response, request
+from main.config.config import route_resource_config
+
+try:
+    import brotli
+except ImportError:
+    # Optional, clients get gzip without it
+    brotli = None
+
+
+@lru_cache(maxsize=route_resource_config["compressed_bodies"])
+def encoded_body(body, encoding):
+    """
+    :param body: the response, a str
+    :param encoding: "br", "gzip" or "identity"
+    :return: the body's bytes in that encoding
+    """
+    data = body.encode('utf-8')
+    if encoding == "br":
+        return brotli.compress(data)
+    if encoding == "gzip":
+        # No timestamp in the header, the same body always compresses to the same bytes
+        return gzip.compress(data, mtime=0)
+    return data
+
+
+@lru_cache(maxsize=route_resource_config["compressed_bodies"])
+def body_etag(body):
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def cacheable_response(body, immutable, mimetype='application/json'):
+    """
+    :param body: the response, a str
+    :param immutable: whether body is exactly what this resource answers with every time it's asked for
+    :param mimetype:
+    :return: the Flask response, a 304 if the client already has it
+    """
+    encoding = None
+    if len(body) >= route_resource_config["min_compress_bytes"]:
+        encoding = request.accept_encodings.best_match(["br", "gzip", "identity"] if brotli is not None
+                                                       else ["gzip", "identity"])
+    encoding = encoding or "identity"
+    etag = body_etag(body) + ("-" + encoding if encoding != "identity" else "")
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(encoded_body(body, encoding), mimetype=mimetype)
+        if encoding != "identity":
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age={0}, immutable' \
+            .format(route_resource_config["max_age_seconds"])
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
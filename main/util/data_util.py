@@ -1,50 +1,254 @@
+import json
+import multiprocessing
 import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from ftplib import FTP
 from zipfile import ZipFile
 from main import DEFAULT_LOGGER
-from main.model.db_util import execute_import_statements, vacuum_full
+from main.config.config import import_config, census_config
+from main.model.db_util import vacuum_full, copy_state_rows, drop_import_indexes, create_import_indexes
 
 PLACES_DIR = 'data' + os.path.sep + 'places'
 ROADS_DIR = 'data' + os.path.sep + 'roads'
 
+# Written to every download directory, see load_manifest
+MANIFEST_FILE = ".manifest.json"
 
-def retrieve_data_from_census_ftp(ftp_dir, output_dir):
+# The statement shp2pgsql -D starts its data with, e.g. COPY "gis"."roads" ("linearid",...,geom) FROM stdin;
+COPY_STATEMENT = re.compile(r'^COPY\s+\S+\s+(\(.*\))\s+FROM\s+stdin;', re.IGNORECASE)
+
+
+class FtpSource:
+    """
+    The files in a directory of an FTP server.  Every thread gets its own connection, so files can be downloaded
+    concurrently.
+    """
+
+    def __init__(self, host, ftp_dir, port=21):
+        self.host = host
+        self.port = port
+        self.ftp_dir = ftp_dir
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def __connection(self):
+        f = getattr(self._local, "ftp", None)
+        if f is None:
+            f = FTP()
+            f.connect(self.host, self.port)
+            f.login()
+            f.cwd(self.ftp_dir)
+            # SIZE is only answered in binary mode by some servers
+            f.voidcmd("TYPE I")
+            self._local.ftp = f
+            with self._lock:
+                self._connections.append(f)
+        return f
+
+    def list(self):
+        return self.__connection().nlst()
+
+    def size(self, name):
+        return self.__connection().size(name)
+
+    def fetch(self, name, callback, offset=0):
+        """Calls callback with every block of the file, starting offset bytes in (REST)"""
+        self.__connection().retrbinary('RETR %s' % name, callback, rest=offset if offset > 0 else None)
+
+    def close(self):
+        with self._lock:
+            for f in self._connections:
+                try:
+                    f.quit()
+                except Exception:
+                    f.close()
+            self._connections = []
+
+
+class MirrorSource:
+    """The files in a local copy of the census FTP server's directories, see census_config["mirror_dir"]"""
+
+    def __init__(self, mirror_dir, ftp_dir):
+        self.directory = os.path.join(mirror_dir, ftp_dir.strip("/"))
+
+    def list(self):
+        return sorted(f for f in os.listdir(self.directory) if os.path.isfile(os.path.join(self.directory, f)))
+
+    def size(self, name):
+        return os.path.getsize(os.path.join(self.directory, name))
+
+    def fetch(self, name, callback, offset=0):
+        with open(os.path.join(self.directory, name), 'rb') as ifile:
+            ifile.seek(offset)
+            for block in iter(lambda: ifile.read(65536), b""):
+                callback(block)
+
+    def close(self):
+        pass
+
+
+def census_source(ftp_dir):
+    """
+    :return: where to get the files of a census FTP directory from, the local mirror if there is one
     """
-    Connects to the census FTP server (ftp2.census.gov) and downloads the specified directory to the output directory
+    if census_config["mirror_dir"] is not None:
+        return MirrorSource(census_config["mirror_dir"], ftp_dir)
+    return FtpSource(census_config["host"], ftp_dir, census_config["port"])
+
+
+def file_crc32(file_name):
+    crc = 0
+    with open(file_name, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(1 << 20), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def load_manifest(output_dir):
+    """
+    The manifest records, for every file downloaded to output_dir, its size, crc32 and the files extracted from it
+    """
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as ifile:
+        return json.load(ifile)
+
+
+def save_manifest(output_dir, manifest):
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    with open(manifest_file + ".tmp", 'w') as ofile:
+        json.dump(manifest, ofile, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def is_up_to_date(output_dir, name, size, entry):
+    """
+    :param entry: the file's manifest entry, None if it was never downloaded
+    :return: True if the file (or what was extracted from it) is already in output_dir and the same size as on the
+             server
+    """
+    if entry is None or entry["size"] != size:
+        return False
+
+    path = os.path.join(output_dir, name)
+    if os.path.exists(path):
+        return os.path.getsize(path) == size and file_crc32(path) == entry["crc32"]
+    # The zip file is deleted once it's extracted
+    extracted = entry.get("extracted")
+    return extracted is not None and all(os.path.exists(os.path.join(output_dir, f)) for f in extracted)
+
+
+def download_file(source, name, output_dir, entry):
+    """
+    Downloads one file, unless it's up to date.  The file is written to a .part file and renamed once it's complete,
+    an interrupted download picks up where the .part file ends.
+    :param entry: the file's manifest entry, None if it was never downloaded
+    :return: (name, manifest entry of the file, bytes downloaded, bytes that were already there)
+    """
+    size = source.size(name)
+    if is_up_to_date(output_dir, name, size, entry):
+        return name, entry, 0, size
+
+    path = os.path.join(output_dir, name)
+    # Named after the size of the file on the server, so only a download of the same version of the file is resumed
+    part = "{0}.{1}.part".format(path, size)
+    for f in os.listdir(output_dir):
+        if f.startswith(name + ".") and f.endswith(".part") and os.path.join(output_dir, f) != part:
+            os.remove(os.path.join(output_dir, f))
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+    with open(part, 'ab' if offset > 0 else 'wb') as ofile:
+        ofile.truncate(offset)
+        source.fetch(name, ofile.write, offset)
+
+    if os.path.getsize(part) != size:
+        raise IOError("Downloaded {0} bytes of {1}, expected {2}".format(os.path.getsize(part), name, size))
+    os.replace(part, path)
+    return name, {"size": size, "crc32": file_crc32(path)}, size - offset, offset
+
+
+def extract_zip(zip_file_name, data_dir):
+    """
+    Extracts a zip file into data_dir and deletes it
+    :return: the names of the extracted files
+    """
+    with ZipFile(zip_file_name) as current_zip:
+        members = current_zip.namelist()
+        current_zip.extractall(data_dir)
+
+    os.remove(zip_file_name)
+    return members
+
+
+def retrieve_data_from_census_ftp(ftp_dir, output_dir, source=None):
+    """
+    Downloads a directory of the census FTP server (or its local mirror, see census_config) to the output directory
+    and extracts the zip files in it.  Files are downloaded over several connections at once and each zip file is
+    extracted as soon as it's downloaded (zlib and file writes release the GIL, so threads extract in parallel).
+    Files that haven't changed since the last run are skipped and interrupted downloads are resumed.
     :param ftp_dir: the path to the desired data on the census server
     :param output_dir: the output directory the data will be downloaded to
-    :return:
+    :param source: where to download from, census_source(ftp_dir) by default
+    :return: the manifest of output_dir
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    f = FTP('ftp2.census.gov')
-    f.login()
-    f.cwd(ftp_dir)
-    files = []
-
-    def file_line_handler(line):
-        files.append(line)
-
-    def update_progress(progress):
-        print('\rRetrieving File {0}: {1:.2f}%'.format(file, progress), end="")
-
-    def handle_block(block):
-        nonlocal bytes_read
-        bytes_read += len(block)
-        update_progress((bytes_read / file_size) * 100)
-        ofile.write(block)
+    source = source if source is not None else census_source(ftp_dir)
+    manifest = load_manifest(output_dir)
+    start = time.time()
+    downloaded = skipped = 0
+    try:
+        files = source.list()
+        with ThreadPoolExecutor(census_config["connections"]) as downloads, \
+                ThreadPoolExecutor(census_config["extract_threads"]) as extractions:
+            pending = {downloads.submit(download_file, source, name, output_dir, manifest.get(name))
+                       for name in files}
+            # extraction future -> name of the zip file
+            extracting = {}
+            finished = 0
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in extracting:
+                        name = extracting.pop(future)
+                        manifest[name]["extracted"] = future.result()
+                        DEFAULT_LOGGER.info("Extracted {0}".format(name))
+                    else:
+                        name, entry, fetched, existing = future.result()
+                        manifest[name] = entry
+                        finished += 1
+                        if fetched > 0:
+                            downloaded += fetched
+                            DEFAULT_LOGGER.info("Downloaded {0} ({1} bytes{2}) [{3}/{4}]".format(
+                                name, entry["size"], ", resumed at " + str(existing) if existing > 0 else "",
+                                finished, len(files)))
+                        else:
+                            skipped += 1
+                            DEFAULT_LOGGER.info("{0} is up to date [{1}/{2}]".format(name, finished, len(files)))
 
-    f.retrlines('NLST', file_line_handler)
+                        path = os.path.join(output_dir, name)
+                        if name.endswith(".zip") and os.path.exists(path):
+                            extraction = extractions.submit(extract_zip, path, output_dir)
+                            extracting[extraction] = name
+                            pending.add(extraction)
 
-    for file in files:
-        file_size = f.size(file)
-        bytes_read = 0
-        with open('%s/%s' % (output_dir, file), 'wb') as ofile:
-            f.retrbinary('RETR %s' % file, callback=handle_block)
-            print()
+                    # Saved as it goes, so an interrupted run knows what's done
+                    save_manifest(output_dir, manifest)
+    finally:
+        source.close()
 
-    f.quit()
+    DEFAULT_LOGGER.info("Retrieved {0}: {1} bytes downloaded, {2} files up to date, {3:.1f} seconds"
+                        .format(ftp_dir, downloaded, skipped, time.time() - start))
+    return manifest
 
 
 def extract_all_to_current_dir(data_dir):
@@ -54,14 +258,8 @@ def extract_all_to_current_dir(data_dir):
     :return:
     """
     for file in os.listdir(data_dir):
-        if not file.endswith(".zip"):
-            continue
-
-        full_name = data_dir + os.path.sep + file
-        with ZipFile(full_name) as current_zip:
-            current_zip.extractall(data_dir)
-
-        os.remove(full_name)
+        if file.endswith(".zip"):
+            extract_zip(data_dir + os.path.sep + file, data_dir)
 
 
 def retrieve_all_census_data():
@@ -69,30 +267,133 @@ def retrieve_all_census_data():
                       ('/geo/tiger/TIGER2014/PLACE/', PLACES_DIR)]:
 
         retrieve_data_from_census_ftp(data_sets[0], data_sets[1])
-        extract_all_to_current_dir(data_sets[1])
+
+
+def state_fips_of(file_name):
+    """
+    :param file_name: a census shape file name, e.g. tl_2014_22_prisecroads.shp
+    :return: the state fips code in it, e.g. "22"
+    """
+    return os.path.basename(file_name).split("_")[2]
+
+
+def shp2pgsql_command(file_name, table):
+    # -D dumps the rows in COPY format instead of one INSERT per row
+    return ["shp2pgsql", "-D", "-s", "4269", "-a", "-W", "latin1", file_name, "gis." + table]
+
+
+def copy_chunks(lines, counter, chunk_bytes=65536):
+    """
+    Reads the rows of a COPY block (up to the \\. line that ends it) and groups them into chunks, each chunk is sent
+    to the database as one message.
+    :param lines: the rest of shp2pgsql's output
+    :param counter: a one element list, the number of rows read is added to it
+    """
+    chunk, size = [], 0
+    for line in lines:
+        if line.startswith("\\."):
+            break
+        chunk.append(line)
+        size += len(line)
+        counter[0] += 1
+        if size >= chunk_bytes:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    if len(chunk) > 0:
+        yield "".join(chunk)
+
+
+def import_shapefile(task):
+    """
+    Streams one shape file into the database, shp2pgsql's output goes straight into COPY without ever being held in
+    memory.  It's outside import_data_to_db so it can be run in a worker process.
+    :param task: (path of the .shp file, table name)
+    :return: (path, rows imported, seconds taken)
+    """
+    file_name, table = task
+    start = time.time()
+    rows = [0]
+    # shp2pgsql warns on stderr while it writes the rows, a pipe nobody reads until the end would fill up and stall
+    # it (and with it the COPY), so the messages go to a file instead
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8", errors="replace") as error_file:
+        process = subprocess.Popen(shp2pgsql_command(file_name, table), stdout=subprocess.PIPE,
+                                   stderr=error_file, universal_newlines=True, encoding="utf-8")
+        try:
+            columns = None
+            for line in process.stdout:
+                match = COPY_STATEMENT.match(line)
+                if match is not None:
+                    columns = match.group(1)
+                    break
+
+            if columns is not None:
+                copy_state_rows(table, state_fips_of(file_name), columns, copy_chunks(process.stdout, rows))
+            # Whatever follows the data (COMMIT, ANALYZE) isn't needed, the transaction is ours
+            process.stdout.read()
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+        error_file.seek(0)
+        errors = error_file.read()
+
+    if process.returncode != 0 or columns is None:
+        raise RuntimeError("shp2pgsql failed on {0}: {1}".format(file_name, errors.strip()))
+    return file_name, rows[0], time.time() - start
+
+
+def shapefiles(data_dir, fips=[]):
+    """
+    :param fips: An optional list of state fips codes (integers), only their files are returned
+    :return: the paths of the shape files in data_dir, sorted
+    """
+    files = []
+    for f in sorted(os.listdir(data_dir)):
+        if f.endswith(".shp"):
+            # If we don't have a fips list specified,
+            # OR our file name contains one of the fips codes we care about...
+            if fips == [] or True in ["_" + str(x) + "_" in f for x in fips]:
+                files.append(data_dir + os.path.sep + f)
+    return files
 
 
 def import_data_to_db(fips=[]):
     """
-    Imports shape file data into the database, requires shp2pgsql to be avialable on the path (it is called via os.popen)
+    Imports shape file data into the database, requires shp2pgsql to be avialable on the path.  Several files are
+    imported at once (import_config["number_of_processes"]).  For a bulk import (at least
+    import_config["drop_indexes_min_files"] files) the indexes on the tables are dropped during the import and built
+    once it's done, a smaller one updates them as it goes.  Importing a state again replaces its data.
     :param fips: An optional list of state fips codes (integers) to import.
     :return:
     """
+    tasks = []
     for data_dir in (PLACES_DIR, ROADS_DIR):
-        for f in os.listdir(data_dir):
-            if f.endswith(".shp"):
-                # If we don't have a fips list specified,
-                # OR our file name contains one of the fips codes we care about...
-                if fips == [] or True in ["_" + str(x) + "_" in f for x in fips]:
-                    command = "shp2pgsql -s 4269 -a -W latin1 {0} gis.{1}"\
-                        .format(data_dir + os.path.sep + f,
-                                data_dir.split(os.path.sep)[-1])
-                    DEFAULT_LOGGER.info("Running " + command)
-                    import_lines = os.popen(command).readlines()
-                    DEFAULT_LOGGER.info("Importing {0} values into database".format(str(len(import_lines))))
-                    execute_import_statements(import_lines)
-
-    vacuum_full()
+        for f in shapefiles(data_dir, fips):
+            tasks.append((f, data_dir.split(os.path.sep)[-1]))
+
+    # Biggest files first, so a big file started last doesn't keep the other workers waiting
+    tasks.sort(key=lambda t: os.path.getsize(t[0]), reverse=True)
+
+    start = time.time()
+    total_rows = 0
+    if len(tasks) >= import_config["drop_indexes_min_files"]:
+        drop_import_indexes()
+    try:
+        with multiprocessing.Pool(max(1, min(import_config["number_of_processes"], len(tasks)))) as pool:
+            for i, (file_name, rows, seconds) in enumerate(pool.imap_unordered(import_shapefile, tasks)):
+                total_rows += rows
+                DEFAULT_LOGGER.info("Imported {0} rows from {1} in {2:.1f} seconds ({3}/{4} files)"
+                                    .format(rows, file_name, seconds, i + 1, len(tasks)))
+
+        DEFAULT_LOGGER.info("Imported {0} rows from {1} files in {2:.1f} seconds"
+                            .format(total_rows, len(tasks), time.time() - start))
+        vacuum_full()
+    finally:
+        index_start = time.time()
+        # Also analyzes the tables, the indexes that weren't dropped are left alone
+        create_import_indexes()
+        DEFAULT_LOGGER.info("Created indexes in {0:.1f} seconds".format(time.time() - index_start))
 
 
 if __name__ == "__main__":
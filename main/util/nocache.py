@@ -1,13 +1,14 @@
 from flask import make_response
 from functools import wraps, update_wrapper
-from datetime import datetime
+from datetime import datetime, timezone
 
 
 def nocache(view):
     @wraps(view)
     def no_cache(*args, **kwargs):
         response = make_response(view(*args, **kwargs))
-        response.headers['Last-Modified'] = datetime.now()
+        # Sets the header as an HTTP date, assigning a datetime to the header itself sent Python's str() of it
+        response.last_modified = datetime.now(timezone.utc)
         response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '-1'
@@ -11,37 +11,141 @@ import main.service.graphsvc as graphsvc
 def main():
     parser = argparse.ArgumentParser(description='Main entry point, start up the web server or run utilities')
 
+    def download():
+        if args.mirror_dir is not None:
+            from main.config.config import census_config
+            census_config["mirror_dir"] = args.mirror_dir
+        retrieve_all_census_data()
+
     def import_data_wrapper():
         import_data_to_db([int(x) for x in args.fips])
 
     def create_graph():
-        GraphFactory.construct_graph(args.graph_name)
+        if args.incremental:
+            _, report = GraphFactory.construct_graph_incremental(args.graph_name,
+                                                                 contraction_hierarchy=args.contraction_hierarchy)
+            print("Reused shards: " + (", ".join(report["reused"]) or "none"))
+            print("Rebuilt shards: " + (", ".join(report["built"]) or "none"))
+            return
+
+        GraphFactory.construct_graph(args.graph_name,
+                                     contraction_hierarchy=args.contraction_hierarchy,
+                                     compact=args.compact)
+
+    def create_graph_from_shapefiles():
+        from main.util.data_util import shapefiles, ROADS_DIR, PLACES_DIR
+        fips = [int(x) for x in args.fips] if args.fips is not None else []
+        GraphFactory.construct_graph_from_shapefiles(args.graph_name,
+                                                     shapefiles(ROADS_DIR, fips),
+                                                     shapefiles(PLACES_DIR, fips),
+                                                     contraction_hierarchy=args.contraction_hierarchy,
+                                                     compact=args.compact)
+
+    def convert_graph():
+        from main.model.graph import RoadGraph
+        RoadGraph.convert_graph(args.graph_name, args.output_name)
+
+    def benchmark_graph():
+        from main.util.benchmark import benchmark_graph
+        benchmark_graph(args.graph_name)
+
+    def benchmark_substrings():
+        from main.util.benchmark import benchmark_substrings
+        benchmark_substrings()
+
+    def batch_routes():
+        from main.util.batch import batch_routes
+        batch_routes(args.graph_name, args.pairs_file, args.results_file, args.persist)
+
+    def distance_table():
+        import time
+        from main.config.config import distance_table_config
+        from main.model.graph import RoadGraph
+        from main.model.distance_table import DistanceTable
+        radius_meters = args.radius_meters if args.radius_meters is not None else distance_table_config["radius_meters"]
+        start = time.time()
+        table = RoadGraph.load_graph(args.graph_name).build_distance_table(
+            args.graph_name + DistanceTable.FILE_SUFFIX, radius_meters,
+            args.next_hop or distance_table_config["next_hop"],
+            distance_table_config["processes"], distance_table_config["chunk_size"])
+        DEFAULT_LOGGER.info("Built the distance table of {0} places in {1:.1f} seconds"
+                            .format(len(table), time.time() - start))
 
     def run_webapp():
         from flask import Flask
         flask_app = Flask(__name__, static_url_path='')
         flask_app.register_blueprint(graphsvc.graph_endpoints, url_prefix='/graph')
+        graphsvc.init_graph(args.graph_name)
         DEFAULT_LOGGER.info(flask_app.url_map)
         flask_app.run()
 
     command_help_text = """The desired command:
-    download - retrieves data files from the census FTP server
+    download - retrieves data files from the census FTP server (or a local mirror of it, see mirror_dir), files that
+               were already downloaded and haven't changed are skipped
     import - loads the data into the PostGIS database, uses the optional argument fips
-    create_graph - creates the road graph data structure, uses the optional argument graph_name
-    run - runs the web application, uses the optional argument graph_name
+    create_graph - creates the road graph data structure, uses the optional arguments graph_name,
+                   contraction_hierarchy, compact and incremental
+    create_graph_from_shapefiles - creates the road graph straight from the downloaded shape files, without the
+                                   database, uses the optional arguments fips, graph_name, contraction_hierarchy and
+                                   compact
+    convert_graph - converts a pickled graph (graph_name) to the binary graph file format (output_name)
+    benchmark_graph - compares memory use and query times of the networkx graph and the compact graph,
+                      uses the optional argument graph_name
+    benchmark_substrings - compares the old and the new way of cutting edge geometries out of roads
+    batch_routes - calculates the routes between many pairs of places (pairs_file) across several processes, writing
+                   one JSON line per route to results_file.  Uses the optional arguments graph_name and persist
+    distance_table - precomputes the routes between every pair of places of the graph (graph_name), or only the ones
+                     up to radius_meters long, into a table stored next to the graph.  Uses the optional arguments
+                     graph_name, radius_meters and next_hop
+    run - runs the web application, uses the optional argument graph_name.  The graph is loaded once at startup and
+          reloaded in the background whenever the graph file changes, see /graph/status for load times
     """
 
     # I like this way of doing it, http://stackoverflow.com/questions/27529610/call-function-based-on-argparse
-    function_map = {'download': retrieve_all_census_data,
+    function_map = {'download': download,
                     'import': import_data_wrapper,
                     'create_graph': create_graph,
+                    'create_graph_from_shapefiles': create_graph_from_shapefiles,
+                    'convert_graph': convert_graph,
+                    'benchmark_graph': benchmark_graph,
+                    'benchmark_substrings': benchmark_substrings,
+                    'batch_routes': batch_routes,
+                    'distance_table': distance_table,
                     'run': run_webapp}
 
     parser.add_argument('command', choices=function_map.keys(), help=command_help_text)
     parser.add_argument('--fips', nargs="*",
-                        help='A list of state FIPS codes to import data for, only used with the "import" command')
-    parser.add_argument('--graph_name', nargs=1, default='graph.pickle',
-                        help='File name for the graph data structure, only used with the "import" command')
+                        help='A list of state FIPS codes to import data for, only used with the "import" and '
+                             '"create_graph_from_shapefiles" commands')
+    parser.add_argument('--mirror_dir',
+                        help='A local directory laid out like the census FTP server to download from, only used with '
+                             'the "download" command')
+    parser.add_argument('--graph_name', default='graph.bin',
+                        help='File name for the graph data structure, used with the "create_graph" and "run" commands')
+    parser.add_argument('--output_name', default='graph.bin',
+                        help='File name to write the converted graph to, only used with the "convert_graph" command')
+    parser.add_argument('--contraction_hierarchy', action='store_true',
+                        help='Also preprocess the graph into a contraction hierarchy (stored next to the graph), '
+                             'only used with the "create_graph" command')
+    parser.add_argument('--compact', action='store_true',
+                        help='Build the frozen, array backed graph directly, only used with the "create_graph" command')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Build the graph out of per state shards, only rebuilding the shards of states whose '
+                             'data changed since the last build, only used with the "create_graph" command')
+    parser.add_argument('--pairs_file',
+                        help='A file with one "from,to" pair of place ids per line, only used with the "batch_routes" '
+                             'command')
+    parser.add_argument('--results_file', default='-',
+                        help='Where to write the routes (one JSON object per line, - for stdout), only used with the '
+                             '"batch_routes" command')
+    parser.add_argument('--persist', action='store_true',
+                        help='Also write the routes to gis.user_routes, only used with the "batch_routes" command')
+
+    parser.add_argument('--radius_meters', type=float,
+                        help='Only keep the routes up to this long (defaults to distance_table_config), only used '
+                             'with the "distance_table" command')
+    parser.add_argument('--next_hop', action='store_true',
+                        help='Also keep the next place on every route, only used with the "distance_table" command')
 
     args = parser.parse_args()
     function_map[args.command]()
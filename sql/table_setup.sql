@@ -47,6 +47,13 @@ SELECT AddGeometryColumn('gis','roads','geom','4269','MULTILINESTRING',2);
 CREATE INDEX roads_geom_index ON gis.roads USING GIST (geom);
 CREATE INDEX roads_linearid_index ON gis.roads(linearid);
 
+-- The state each road was imported for (gis.roads has no state column), filled in by manage.py import
+CREATE TABLE gis.road_states(
+  gid integer PRIMARY KEY,
+  statefp varchar(2)
+);
+CREATE INDEX road_states_statefp_index ON gis.road_states(statefp);
+
 CREATE TABLE gis.user_routes(
   route_id text,
   step_id integer,
@@ -69,3 +76,4 @@ WHERE entry_type = 'STEP';
 
 VACUUM FULL gis.places;
 VACUUM FULL gis.roads;
+VACUUM FULL gis.road_states;
@@ -27,6 +27,13 @@
                 .then(function(response){
                     ctrl.currentRoute = response.data;
 
+                    // Zoom to extent
+                    map.fitBounds([[ctrl.currentRoute.miny, ctrl.currentRoute.minx], [ctrl.currentRoute.maxy, ctrl.currentRoute.maxx]]);
+
+                    // The route is written to the database in the background, make sure it's there before GeoServer draws it
+                    return $http.get('/graph/route/' + encodeURIComponent(ctrl.currentRoute.route_id) + '/flush');
+                })
+                .then(function(){
                     var currentRouteLayer = L.tileLayer.wms("http://localhost:8080/geoserver/wms", {
                         layers: 'otbp:user_routes',
                         format: 'image/png',
@@ -44,9 +51,6 @@
 
                     // add the new one
                     map.addLayer(currentRouteLayer);
-
-                    // Zoom to extent
-                    map.fitBounds([[ctrl.currentRoute.miny, ctrl.currentRoute.minx], [ctrl.currentRoute.maxy, ctrl.currentRoute.maxx]]);
                 });
         };
     }]);
@@ -0,0 +1,65 @@
+__author__ = 'pcoleman'
+
+import networkx as nx
+import pytest
+from shapely.geometry import LineString
+from main.model.alternatives import via_node_alternatives
+from main.model.graph import RoadGraph
+from main.model.search import NetworkXView
+from test.graph.search_test import make_grid_graph
+
+
+def path_weight(g, path):
+    return sum(g[u][v]['weight'] for u, v in zip(path, path[1:]))
+
+
+def test_alternatives_are_limited_in_stretch_and_overlap():
+    g = make_grid_graph()
+    paths, settled = via_node_alternatives(NetworkXView(g), (2, 3), (15, 12), count=3, max_stretch=1.3,
+                                           max_overlap=0.5)
+    shortest = nx.dijkstra_path_length(g, (2, 3), (15, 12))
+    assert len(paths) == 3
+    assert path_weight(g, paths[0]) == pytest.approx(shortest)
+    for i, path in enumerate(paths):
+        assert path[0] == (2, 3) and path[-1] == (15, 12)
+        assert len(set(path)) == len(path)
+        assert path_weight(g, path) <= shortest * 1.3 + 1e-9
+        for other in paths[:i]:
+            other_edges = {frozenset(e) for e in zip(other, other[1:])}
+            shared = sum(g[u][v]['weight'] for u, v in zip(path, path[1:]) if frozenset((u, v)) in other_edges)
+            assert shared <= 0.5 * path_weight(g, path) + 1e-9
+
+
+def test_no_alternative_that_is_too_long():
+    # Two roads from s to t, the second one 10% longer
+    g = nx.Graph()
+    for n, lat, lon in (("s", 30.0, -91.0), ("a", 30.1, -90.5), ("b", 29.9, -90.5), ("t", 30.0, -90.0)):
+        g.add_node(n, lat=lat, lon=lon)
+    g.add_edge("s", "a", weight=1.0)
+    g.add_edge("a", "t", weight=1.0)
+    g.add_edge("s", "b", weight=1.1)
+    g.add_edge("b", "t", weight=1.1)
+
+    paths, _ = via_node_alternatives(NetworkXView(g), "s", "t", max_stretch=1.2)
+    assert paths == [["s", "a", "t"], ["s", "b", "t"]]
+    paths, _ = via_node_alternatives(NetworkXView(g), "s", "t", max_stretch=1.05)
+    assert paths == [["s", "a", "t"]]
+
+    g.add_node("island", lat=0, lon=0)
+    assert via_node_alternatives(NetworkXView(g), "s", "island")[0] == []
+
+
+def test_alternative_routes_are_routes(monkeypatch):
+    monkeypatch.setattr(RoadGraph, "node_name", staticmethod(lambda node_id, data: str(node_id)))
+    r = RoadGraph()
+    r.graph = make_grid_graph(8)
+    for u, v, data in r.graph.edges(data=True):
+        a, b = r.graph.nodes[u], r.graph.nodes[v]
+        data.update(db_id=1, name=str(u) + "-" + str(v), geom=LineString([(a['lon'], a['lat']), (b['lon'], b['lat'])]))
+
+    routes = r.alternative_routes((0, 0), (7, 7), count=2)
+    assert [route.name for route in routes] == ["(0, 0) to (7, 7)", "(0, 0) to (7, 7) (alternative 1)"]
+    for route in routes:
+        route.decorate()
+        assert route.distance_meters > 0
+        assert route.steps[-1].name is None
@@ -0,0 +1,99 @@
+__author__ = 'pcoleman'
+
+import json
+from shapely.geometry import LineString
+from main.model.batch_routes import BatchPool, iter_batch_routes, result_json, parse_pair
+from main.model.compact_graph import coordinate_key
+from main.model.graph import RoadGraph
+
+
+def make_road_graph():
+    r = RoadGraph()
+    for gid in range(1, 6):
+        r.graph.add_node(gid, lat=30.0, lon=-91.0 + gid / 10, city_name="Town " + str(gid))
+    for a in range(1, 5):
+        r.graph.add_edge(a, a + 1, weight=0.1, db_id=a, name="Road " + str(a),
+                         geom=LineString([(-91.0 + a / 10, 30.0), (-91.0 + (a + 1) / 10, 30.0)]))
+    r.graph.add_node(9, lat=0.0, lon=0.0, city_name="Island")
+    r.freeze()
+    return r
+
+
+def test_batch_is_spread_over_forked_workers(monkeypatch):
+    monkeypatch.setattr(RoadGraph, "node_name", staticmethod(lambda node_id, data: data["city_name"]))
+    graph = make_road_graph()
+    pairs = [(a, b) for a in range(1, 6) for b in range(1, 6) if a != b] + [(1, 9), (1, 42)]
+
+    serial = list(iter_batch_routes(graph, pairs, processes=1))
+    parallel = list(iter_batch_routes(graph, pairs, processes=3, chunk_size=2))
+    assert [p for p, _, _, _ in parallel] == pairs
+    assert [(p, s, e) for p, s, _, e in parallel] == [(p, s, e) for p, s, _, e in serial]
+    # Only the summaries come back unless the routes are kept for persisting
+    assert all(route is None for _, _, route, _ in parallel)
+
+    lines = [json.loads(result_json(p, s, None, e)) for p, s, _, e in parallel]
+    assert lines[0]["from"] == 1 and lines[0]["to"] == 2 and lines[0]["name"] == "Town 1 to Town 2"
+    assert lines[3]["steps"] == 5 and lines[3]["distance_meters"] > 38000
+    assert "error" in lines[-2] and "error" in lines[-1]
+
+    kept = list(iter_batch_routes(graph, pairs[:3], processes=2, keep_routes=True))
+    assert [route.name for _, _, route, _ in kept] == ["Town 1 to Town 2", "Town 1 to Town 3", "Town 1 to Town 4"]
+    assert kept[1][2].steps[1].geom is not None
+
+
+def test_pairs_are_parsed():
+    assert parse_pair("12,34\n") == (12, 34)
+    assert parse_pair('"30.0,-90.5", 7') == ("30.0,-90.5", 7)
+
+
+def test_batch_pool_workers_load_the_graph_file(tmpdir):
+    # Intersections only, the workers name them by their coordinates without the place catalog
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = RoadGraph()
+    keys = [coordinate_key(30.0, -91.0 + a / 10) for a in range(0, 4)]
+    for a, key in enumerate(keys):
+        r.graph.add_node(key, lat=30.0, lon=-91.0 + a / 10)
+    for a in range(0, 3):
+        r.graph.add_edge(keys[a], keys[a + 1], weight=0.1, db_id=a, name="Road " + str(a),
+                         geom=LineString([(-91.0 + a / 10, 30.0), (-91.0 + (a + 1) / 10, 30.0)]))
+    RoadGraph.save_graph(r, graph_file)
+    graph = RoadGraph.load_graph(graph_file)
+    pairs = [(keys[0], keys[3]), (keys[3], keys[1]), (keys[0], "no such place")]
+
+    pool = BatchPool(processes=2, chunk_size=1)
+    # Not started yet, the routes are calculated on the graph that's passed in
+    serial = list(pool.iter_routes(graph, pairs))
+    try:
+        pool.start(graph_file)
+        pooled = list(pool.iter_routes(graph, pairs))
+        assert [(p, s, e) for p, s, _, e in pooled] == [(p, s, e) for p, s, _, e in serial]
+        assert pooled[0][1]["steps"] == 4 and pooled[2][3] is not None
+
+        # A new graph is only seen by the workers once the pool is restarted
+        r.graph.add_edge(keys[0], keys[3], weight=0.05, db_id=9, name="Shortcut",
+                         geom=LineString([(-91.0, 30.0), (-90.7, 30.0)]))
+        RoadGraph.save_graph(r, graph_file)
+        assert list(pool.iter_routes(graph, pairs[:1]))[0][1]["steps"] == 4
+        pool.restart()
+        assert list(pool.iter_routes(graph, pairs[:1]))[0][1]["steps"] == 2
+    finally:
+        pool.close()
+
+
+def test_calc_routes_answers_bad_pairs_with_an_error_line(monkeypatch):
+    from flask import Flask
+    import main.service.graphsvc as graphsvc
+    monkeypatch.setattr(RoadGraph, "node_name", staticmethod(lambda node_id, data: data["city_name"]))
+    graph = make_road_graph()
+    monkeypatch.setattr(graphsvc, "get_graph", lambda: graph)
+    app = Flask(__name__)
+    app.register_blueprint(graphsvc.graph_endpoints, url_prefix='/graph')
+
+    pairs = [[1, 2], [[1], 2], [[30.0, -90.8], 4], [True, 2], [[95.0, -90.0], 3], [1, 5]]
+    response = app.test_client().post("/graph/calc_routes", json={"pairs": pairs})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [(line["from"], line["to"]) for line in lines] == [tuple(p) for p in pairs]
+    assert [("error" in line) for line in lines] == [False, True, False, True, True, False]
+    # The point is snapped to the node of Town 2
+    assert lines[2]["name"] == "Town 2 to Town 4"
+    assert lines[5]["name"] == "Town 1 to Town 5"
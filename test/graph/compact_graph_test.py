@@ -0,0 +1,76 @@
+__author__ = 'pcoleman'
+
+import pickle
+import random
+import networkx as nx
+import pytest
+from shapely.geometry import LineString
+from main.model.compact_graph import *
+from main.model.graph import RoadGraph
+from main.model.search import NetworkXView, AStarEngine
+from test.graph.search_test import make_grid_graph
+
+
+def make_road_graph(size=10):
+    """The grid graph, named the way GraphFactory names nodes: intersections by coordinates, cities by gid"""
+    g = make_grid_graph(size)
+    names = {}
+    for i, (n, data) in enumerate(g.nodes(data=True)):
+        if i % 7 == 0:
+            names[n] = 1000 + i
+            data['city_name'] = "City " + str(i)
+        else:
+            names[n] = coordinate_key(data['lat'], data['lon'])
+    g = nx.relabel_nodes(g, names)
+    for u, v, data in g.edges(data=True):
+        a, b = g.nodes[u], g.nodes[v]
+        data['name'] = "Road " + str(len(data) % 3)
+        data['db_id'] = 42
+        data['geom'] = LineString([(a['lon'], a['lat']), (b['lon'], b['lat'])])
+    return g
+
+
+def test_compact_graph_matches_networkx():
+    g = make_road_graph()
+    compact = CompactGraph.from_networkx(g)
+    assert compact.number_of_nodes() == g.number_of_nodes()
+    assert compact.number_of_edges() == g.number_of_edges()
+
+    for n, data in g.nodes(data=True):
+        i = compact.index_of(n)
+        assert compact.key(i) == n
+        assert compact.node_data(i) == {k: data[k] for k in ('lat', 'lon', 'city_name') if k in data}
+        expected = sorted((compact.index_of(v), d['weight']) for v, d in g[n].items())
+        assert sorted(compact.neighbors(i)) == expected
+
+    for u, v, data in g.edges(data=True):
+        e = compact.edge_data(compact.index_of(u), compact.index_of(v))
+        assert e['name'] == data['name'] and e['geom'] is data['geom'] and e['weight'] == data['weight']
+
+    assert compact.index_of(999999) is None
+    assert compact.index_of("1.0,2.0") is None
+
+
+def test_searches_agree_and_survive_pickling():
+    g = make_road_graph()
+    compact = pickle.loads(pickle.dumps(CompactGraph.from_networkx(g)))
+    rnd = random.Random(4)
+    nodes = list(g.nodes)
+    for _ in range(20):
+        s, t = rnd.choice(nodes), rnd.choice(nodes)
+        expected = AStarEngine().search(NetworkXView(g), s, t)
+        result = AStarEngine().search(compact, compact.index_of(s), compact.index_of(t))
+        assert result.distance == pytest.approx(expected.distance)
+        assert [compact.key(n) for n in result.path] == expected.path
+
+
+def test_freezing_keeps_the_contraction_hierarchy():
+    r = RoadGraph()
+    r.graph = make_road_graph()
+    s, t = list(r.graph.nodes)[0], list(r.graph.nodes)[-1]
+    expected = nx.dijkstra_path_length(r.graph, s, t)
+    r.build_contraction_hierarchy()
+    compact = r.freeze()
+    assert r.graph is None
+    result = r.search_engine("ch").search(compact, compact.index_of(s), compact.index_of(t))
+    assert result.distance == pytest.approx(expected)
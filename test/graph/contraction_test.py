@@ -0,0 +1,65 @@
+__author__ = 'pcoleman'
+
+import random
+import networkx as nx
+import pytest
+from main.model.graph import RoadGraph
+from main.model.search import NetworkXView
+from main.model.contraction import *
+from test.graph.search_test import make_grid_graph
+from test.graph.compact_graph_test import make_road_graph
+
+
+def test_ch_queries_match_dijkstra():
+    g = make_grid_graph(size=15)
+    ch = ContractionHierarchy.build(NetworkXView(g))
+    engine = ContractionHierarchyEngine(ch)
+    rnd = random.Random(3)
+    nodes = list(g.nodes)
+    for _ in range(50):
+        s, t = rnd.choice(nodes), rnd.choice(nodes)
+        result = engine.search(None, s, t)
+        expected = nx.dijkstra_path_length(g, s, t)
+        assert result.distance == pytest.approx(expected)
+
+        # The unpacked path has to be made of original edges only
+        assert result.path[0] == s and result.path[-1] == t
+        assert sum(g[u][v]['weight'] for u, v in zip(result.path, result.path[1:])) == pytest.approx(expected)
+
+
+def test_hierarchy_is_loaded_next_to_the_graph(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = RoadGraph()
+    r.graph = make_road_graph(size=5)
+    r.freeze()
+    r.build_contraction_hierarchy().save(graph_file + ContractionHierarchy.FILE_SUFFIX)
+    RoadGraph.save_graph(r, graph_file)
+
+    loaded = RoadGraph.load_graph(graph_file)
+    assert loaded.contraction is not None
+    assert loaded.search_engine("ch").name == "ch"
+
+    # A hierarchy for some other graph is ignored
+    other = RoadGraph()
+    other.graph = make_road_graph(size=6)
+    RoadGraph.save_graph(other, graph_file)
+    loaded = RoadGraph.load_graph(graph_file)
+    assert loaded.contraction is None
+    assert loaded.search_engine("ch").name == "astar"
+
+
+def test_hierarchy_of_a_reweighted_graph_is_ignored(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = RoadGraph()
+    r.graph = make_road_graph(size=5)
+    r.build_contraction_hierarchy().save(graph_file + ContractionHierarchy.FILE_SUFFIX)
+    assert ContractionHierarchy.graph_signature_of(NetworkXView(r.graph)) == r.freeze().signature()
+
+    # As many nodes and edges as before, one road got slower
+    g = make_road_graph(size=5)
+    u, v = next(iter(g.edges))
+    g[u][v]['weight'] *= 5
+    other = RoadGraph()
+    other.graph = g
+    RoadGraph.save_graph(other, graph_file)
+    assert RoadGraph.load_graph(graph_file).contraction is None
@@ -0,0 +1,115 @@
+__author__ = 'pcoleman'
+
+import networkx as nx
+import numpy as np
+import pytest
+from shapely.geometry import LineString
+from main.model.compact_graph import coordinate_key
+from main.model.distance_table import DistanceTable
+from main.model.graph import RoadGraph, geodesic_length_meters
+
+
+def make_road_graph():
+    """
+    Towns 1 - 2 - 3 along a road running east with an intersection between 2 and 3, a slow direct road from 1 to 3
+    and towns 4 and 5 on a road of their own
+    """
+    r = RoadGraph()
+    for gid, lon in ((1, 0.0), (2, 0.1), (3, 0.3), (4, 5.0), (5, 5.1)):
+        r.graph.add_node(gid, lat=30.0, lon=-91.0 + lon, city_name="Town " + str(gid))
+    crossing = coordinate_key(30.0, -90.8)
+    r.graph.add_node(crossing, lat=30.0, lon=-90.8)
+
+    def road(a, b, lon_a, lon_b, weight):
+        r.graph.add_edge(a, b, weight=weight, db_id=1, name="Road",
+                         geom=LineString([(-91.0 + lon_a, 30.0), (-91.0 + lon_b, 30.0)]))
+
+    road(1, 2, 0.0, 0.1, 0.1)
+    road(2, crossing, 0.1, 0.2, 0.1)
+    road(crossing, 3, 0.2, 0.3, 0.1)
+    road(1, 3, 0.0, 0.3, 0.5)
+    road(4, 5, 5.0, 5.1, 0.1)
+    return r
+
+
+def test_dense_table_matches_the_searches(tmpdir):
+    r = make_road_graph()
+    table = r.build_distance_table(str(tmpdir.join("graph.bin.distances")), next_hop=True)
+
+    assert list(table.gids) == [1, 2, 3, 4, 5]
+    assert not table.sparse
+    weight, meters = table.lookup(1, 3)
+    assert weight == pytest.approx(0.3)
+    tenth = geodesic_length_meters(LineString([(-91.0, 30.0), (-90.9, 30.0)]))
+    assert meters == pytest.approx(3 * tenth, rel=1e-5)
+    assert table.lookup(3, 1)[0] == pytest.approx(0.3)
+    assert table.lookup(1, 1) == (0.0, 0.0)
+    assert table.lookup(1, 4) == (np.inf, np.inf)
+    assert table.lookup(1, 99) is None
+
+    assert table.via(1, 3) == [2]
+    assert table.via(3, 1) == [2]
+    assert table.via(1, 2) == []
+    assert table.via(1, 4) is None
+
+    # Next hops that go round in a loop (1 -> 2 -> 1 ...) don't hang the lookup
+    looping = DistanceTable(table.gids, table.weights, table.meters, np.array(table.next_hop))
+    looping.next_hop[1 * 5 + 2] = 0
+    with pytest.raises(ValueError):
+        looping.via(1, 3)
+
+    matrix, _ = r.travel_matrix([3, 1, 2])
+    assert np.allclose(table.matrix([3, 1, 2]), matrix)
+    assert table.matrix([1, coordinate_key(30.0, -90.8)]) is None
+
+
+def test_table_with_a_radius_only_keeps_nearby_places(tmpdir):
+    r = make_road_graph()
+    tenth = geodesic_length_meters(LineString([(-91.0, 30.0), (-90.9, 30.0)]))
+    table = r.build_distance_table(str(tmpdir.join("graph.bin.distances")), radius_meters=tenth * 2.5)
+
+    assert table.sparse
+    assert table.lookup(1, 2)[0] == pytest.approx(0.1)
+    assert table.lookup(2, 3)[0] == pytest.approx(0.2)
+    # The route from 1 to 3 is three tenths of a degree long, past the radius
+    assert table.lookup(1, 3) == (np.inf, np.inf)
+    assert table.lookup(4, 5)[0] == pytest.approx(0.1)
+    assert table.via(1, 2) is None
+    assert table.matrix([1, 2]) is not None
+    assert table.matrix([1, 2, 3]) is None
+
+    # Out of the table's reach the graph searches instead
+    weight, meters, via = r.place_distance(1, 3)
+    assert weight == pytest.approx(0.3)
+    assert via == [2]
+    with pytest.raises(nx.NetworkXNoPath):
+        r.place_distance(1, 4)
+
+
+def test_table_is_loaded_with_the_graph(tmpdir, monkeypatch):
+    monkeypatch.setattr(RoadGraph, "node_name", staticmethod(lambda node_id, data: data["city_name"]))
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = make_road_graph()
+    RoadGraph.save_graph(r, graph_file)
+    r = RoadGraph.load_graph(graph_file)
+    assert r.distance_table is None
+
+    r.build_distance_table(graph_file + DistanceTable.FILE_SUFFIX, next_hop=True, processes=2, chunk_size=1)
+    loaded = RoadGraph.load_graph(graph_file)
+    assert loaded.distance_table is not None
+    assert loaded.place_distance(1, 3)[0] == pytest.approx(0.3)
+    assert loaded.place_distance(1, 3)[2] == [2]
+
+    # Trips use the table for the order of the stops and only search for the legs
+    with_table = loaded.trip_route([1, 3, 2], optimize=True)
+    loaded.distance_table = None
+    without_table = loaded.trip_route([1, 3, 2], optimize=True)
+    assert with_table.stops == without_table.stops == [1, 3, 2]
+    assert [s.city_name for s in with_table.steps] == [s.city_name for s in without_table.steps]
+
+    # A table built for another graph is ignored
+    other = make_road_graph()
+    other.graph.add_edge(4, 1, weight=9.0, db_id=2, name="Long road",
+                         geom=LineString([(-86.0, 30.0), (-91.0, 30.0)]))
+    RoadGraph.save_graph(other, graph_file)
+    assert RoadGraph.load_graph(graph_file).distance_table is None
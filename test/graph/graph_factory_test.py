@@ -0,0 +1,100 @@
+__author__ = 'pcoleman'
+
+import os
+from shapely.geometry import LineString, MultiLineString
+from main.model.graph_factory import order_nodes_along_road, node_name
+
+
+def node(lat, lon):
+    return {"id": str(lat) + "," + str(lon), "lat": lat, "lon": lon}
+
+
+def test_nodes_are_ordered_along_the_road():
+    road = MultiLineString([[(-91.0, 30.0), (-91.0, 30.5), (-90.5, 30.5)], [(-90.5, 30.5), (-90.0, 30.5)]])
+    nodes = [node(30.5, -90.0), node(30.2, -91.0), node(30.5, -90.5), node(30.0, -91.0), node(30.2, -91.0),
+             {"id": 7, "city_name": "Town", "lat": 30.5, "lon": -90.8}]
+
+    runs = order_nodes_along_road(road, nodes)
+    assert [[node_name(n) for n in run] for run in runs] == [
+        ["30.0,-91.0", "30.2,-91.0", 7, "30.5,-90.5"],
+        ["30.5,-90.5", "30.5,-90.0"]
+    ]
+
+
+def test_consecutive_edges_replace_all_pairs():
+    nodes = [node(30.0, -91.0 + i / 10) for i in range(9, -1, -1)]
+    runs = order_nodes_along_road(LineString([(-91.0, 30.0), (-90.0, 30.0)]), nodes)
+    # 9 edges instead of the 45 every pair of nodes would need
+    assert sum(len(r) - 1 for r in runs) == 9
+    assert [n["lon"] for n in runs[0]] == sorted(n["lon"] for n in nodes)
+
+
+def test_edge_geometries_are_computed_by_a_pool_sharing_the_roads(monkeypatch):
+    import multiprocessing
+    import main.model.graph_factory as graph_factory
+
+    road_geoms = {1: LineString([(0, 0), (1, 0), (2, 0)]), 2: LineString([(0, 1), (0, 2)])}
+    road_edges = {
+        1: [("a", (0, 0), (0.5, 0)), ("b", (0.5, 0), (2, 0))],
+        2: [("c", (0, 1), (0, 2)), ("d", (0, 1), (5, 5))]
+    }
+    monkeypatch.setattr(graph_factory, "_road_geoms", road_geoms)
+    monkeypatch.setattr(graph_factory, "_road_edges", road_edges)
+
+    chunks = list(graph_factory.chunk_roads(road_edges, 1))
+    assert chunks == [[1], [2]]
+
+    with multiprocessing.get_context("fork").Pool(2) as pool:
+        results = list(pool.imap(graph_factory.calc_geom, chunks))
+
+    assert [processed for processed, _ in results] == [2, 2]
+    geoms = dict(g for _, chunk in results for g in chunk)
+    assert sorted(geoms) == ["a", "b", "c"]
+    assert list(geoms["b"].coords) == [(0.5, 0), (1, 0), (2, 0)]
+
+
+def test_incremental_build_only_rebuilds_changed_shards(monkeypatch, tmpdir):
+    from main.model.compact_graph import CompactGraphBuilder
+    from main.model.graph import RoadGraph
+    from main.model.graph_factory import GraphFactory
+    from main.model.roads_dao import RoadsDAO
+
+    # Two states sharing the node on their border at (30.0, -90.0)
+    roads = {"22": [((30.0, -91.0), (30.0, -90.0), 1)], "28": [((30.0, -90.0), (30.0, -89.0), 2)]}
+    hashes = {"22": "a", "28": "b"}
+    built = []
+
+    def construct_state_shard(statefp, shard_file_name):
+        built.append(statefp)
+        builder = CompactGraphBuilder()
+        for (lat1, lon1), (lat2, lon2), db_id in roads[statefp]:
+            for lat, lon in ((lat1, lon1), (lat2, lon2)):
+                builder.add_node(str(lat) + "," + str(lon), lat=lat, lon=lon)
+            builder.add_edge(str(lat1) + "," + str(lon1), str(lat2) + "," + str(lon2), weight=1.0, db_id=db_id,
+                             name="Road " + str(db_id), geom=LineString([(lon1, lat1), (lon2, lat2)]))
+        shard = RoadGraph()
+        shard.graph = None
+        shard.compact = builder.build()
+        RoadGraph.save_graph(shard, shard_file_name)
+        return shard.compact
+
+    monkeypatch.setattr(RoadsDAO, "get_road_states", staticmethod(lambda: sorted(roads)))
+    monkeypatch.setattr(GraphFactory, "shard_hash", staticmethod(lambda statefp: hashes[statefp]))
+    monkeypatch.setattr(GraphFactory, "construct_state_shard", staticmethod(construct_state_shard))
+    shard_dir = str(tmpdir.join("shards"))
+    graph_file = str(tmpdir.join("graph.bin"))
+
+    r, report = GraphFactory.construct_graph_incremental(graph_file, shard_dir=shard_dir)
+    assert report == {"reused": [], "built": ["22", "28"]}
+    assert r.compact.number_of_nodes() == 3
+    assert r.compact.number_of_edges() == 2
+    route = r.shortest_route("30.0,-91.0", "30.0,-89.0")
+    assert [s.name for s in route.steps] == ["Road 1", "Road 2", None]
+
+    hashes["28"] = "c"
+    r, report = GraphFactory.construct_graph_incremental(graph_file, shard_dir=shard_dir)
+    assert report == {"reused": ["22"], "built": ["28"]}
+    assert built == ["22", "28", "28"]
+    assert sorted(f for f in os.listdir(shard_dir) if f.endswith(".bin")) == ["22-a.bin", "28-c.bin"]
+    assert not any(f.startswith("28-b") for f in os.listdir(shard_dir))
+    assert RoadGraph.load_graph(graph_file).compact.number_of_edges() == 2
@@ -0,0 +1,78 @@
+__author__ = 'pcoleman'
+
+import pickle
+import shutil
+import pytest
+import numpy as np
+from main.model.graph import RoadGraph
+from main.model.graph_file import *
+from main.model.geometry_store import GeometryStore
+from test.graph.compact_graph_test import make_road_graph
+
+
+def test_graph_file_round_trip(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = RoadGraph()
+    r.graph = make_road_graph()
+    expected = r.freeze()
+    RoadGraph.save_graph(r, graph_file)
+
+    assert is_graph_file(graph_file)
+    loaded = RoadGraph.load_graph(graph_file).compact
+    for name in ("lat", "lon", "place_gid", "city_name", "offsets", "targets", "weights", "edge_index",
+                 "edge_u", "edge_v", "edge_weight", "edge_db_id", "edge_name"):
+        assert np.array_equal(getattr(loaded, name), getattr(expected, name))
+        assert not getattr(loaded, name).flags.writeable
+
+    for i in range(0, expected.number_of_nodes()):
+        assert loaded.key(i) == expected.key(i)
+        assert loaded.node_data(i) == expected.node_data(i)
+    for e in range(0, expected.number_of_edges()):
+        assert loaded.edge_geoms[e].wkb == expected.edge_geoms[e].wkb
+
+
+def test_pickled_graphs_are_converted(tmpdir):
+    pickle_file = str(tmpdir.join("graph.pickle"))
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = RoadGraph()
+    r.graph = make_road_graph()
+    with open(pickle_file, 'wb') as pfile:
+        pickle.dump(r, pfile)
+
+    assert not is_graph_file(pickle_file)
+    converted = RoadGraph.convert_graph(pickle_file, graph_file)
+    assert is_graph_file(graph_file)
+    assert converted.compact.to_networkx().number_of_edges() == r.graph.number_of_edges()
+
+
+def test_geometries_are_stored_next_to_the_graph(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    r = RoadGraph()
+    r.graph = make_road_graph()
+    expected = r.freeze()
+    RoadGraph.save_graph(r, graph_file)
+
+    store = GeometryStore(graph_file + GeometryStore.FILE_SUFFIX, cache_size=2)
+    assert len(store) == expected.number_of_edges()
+    for e in (0, 1, 0, 5):
+        assert store[e].wkt == expected.edge_geoms[e].wkt
+    assert store.stats()["hits"] == 1
+    assert store.stats()["cached"] == 2
+
+    # Pickling reopens the file
+    assert pickle.loads(pickle.dumps(store))[3].wkb == expected.edge_geoms[3].wkb
+
+
+def test_geometries_of_another_graph_are_refused(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    other_file = str(tmpdir.join("other.bin"))
+    r = RoadGraph()
+    r.graph = make_road_graph(size=5)
+    RoadGraph.save_graph(r, graph_file)
+    other = RoadGraph()
+    other.graph = make_road_graph(size=6)
+    RoadGraph.save_graph(other, other_file)
+
+    shutil.copy(other_file + GeometryStore.FILE_SUFFIX, graph_file + GeometryStore.FILE_SUFFIX)
+    with pytest.raises(ValueError):
+        RoadGraph.load_graph(graph_file)
@@ -0,0 +1,59 @@
+__author__ = 'pcoleman'
+
+import os
+from main.model.graph import RoadGraph
+from main.model.distance_table import DistanceTable
+from main.model.graph_holder import GraphHolder
+
+
+def test_graph_is_swapped_when_file_changes(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    g = RoadGraph()
+    g.graph.add_node("30.0,-91.0", lat=30.0, lon=-91.0)
+    RoadGraph.save_graph(g, graph_file)
+
+    holder = GraphHolder(graph_file, check_interval=0)
+    first = holder.load()
+    assert holder.get() is first
+    assert holder.startup_seconds is not None
+
+    swaps = []
+    holder.add_swap_listener(lambda old, new: swaps.append((old, new)))
+
+    g.graph.add_node(123, lat=30.5, lon=-91.5, city_name="Baton Rouge")
+    RoadGraph.save_graph(g, graph_file)
+    st = os.stat(graph_file)
+    os.utime(graph_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    # The first get() after the change still serves the old graph while the new one loads
+    assert holder.get() is first
+    holder._reload_thread.join()
+
+    second = holder.get()
+    assert second is not first
+    assert second.compact.index_of(123) is not None
+    assert holder.reload_count == 1
+    assert len(swaps) == 1
+
+
+def test_graph_is_swapped_when_a_sidecar_file_changes(tmpdir):
+    graph_file = str(tmpdir.join("graph.bin"))
+    g = RoadGraph()
+    g.graph.add_node(1, lat=30.0, lon=-91.0, city_name="Town 1")
+    g.graph.add_node(2, lat=30.0, lon=-90.9, city_name="Town 2")
+    g.graph.add_edge(1, 2, weight=0.1, db_id=1, name="Road")
+    RoadGraph.save_graph(g, graph_file)
+
+    holder = GraphHolder(graph_file, check_interval=0)
+    first = holder.load()
+    assert first.distance_table is None
+
+    # Only the distance table is new, the graph file itself is untouched
+    first.build_distance_table(graph_file + DistanceTable.FILE_SUFFIX)
+    assert holder.get() is first
+    holder._reload_thread.join()
+
+    second = holder.get()
+    assert second is not first
+    assert second.distance_table is not None
+    assert holder.reload_count == 1
@@ -8,3 +8,14 @@ def test_create_node_from_db_results():
     assert r.lat == 30
     assert r.lon == 90
     assert r.id == "123_456"
+
+
+def test_unknown_place_is_named_by_its_id(monkeypatch):
+    monkeypatch.setattr(place_catalog, "get_place_name_by_id", lambda gid: None)
+    assert RoadGraph.node_name(123, {"lat": 30.0, "lon": -91.0}) == "123"
+
+    def unavailable(gid):
+        raise PlaceCatalogError("Could not load the places from the database")
+    monkeypatch.setattr(place_catalog, "get_place_name_by_id", unavailable)
+    assert RoadGraph.node_name(123, {"lat": 30.0, "lon": -91.0}) == "123"
+    assert RoadGraph.node_name("30.0,-91.0", {"lat": 30.0, "lon": -91.0}) == "30.00000, -91.00000"
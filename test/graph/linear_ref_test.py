@@ -0,0 +1,51 @@
+__author__ = 'pcoleman'
+
+import random
+import pytest
+import shapely.ops
+from shapely.geometry import LineString, MultiLineString, Point
+from main.model.linear_ref import RoadLine, RoadGeometry
+from main.util.benchmark import legacy_substring
+
+
+def make_line(seed=0, vertices=200):
+    rnd = random.Random(seed)
+    lon, lat, coords = -91.0, 30.0, []
+    for _ in range(0, vertices):
+        lon, lat = lon + rnd.uniform(0, 0.01), lat + rnd.uniform(-0.01, 0.01)
+        coords.append((lon, lat))
+    return LineString(coords)
+
+
+def test_project_and_substring_match_shapely():
+    line = make_line()
+    road = RoadLine(line)
+    rnd = random.Random(1)
+    points = [(rnd.uniform(-91, -90), rnd.uniform(29.5, 30.5)) for _ in range(0, 50)]
+    measures, distances = road.project(points)
+    for (x, y), m, d in zip(points, measures, distances):
+        assert m == pytest.approx(line.project(Point(x, y)), abs=1e-9)
+        assert d == pytest.approx(line.distance(Point(x, y)), abs=1e-9)
+
+    for m1, m2 in ((0.1, 0.5), (0.7, 0.2), (0.0, road.length)):
+        expected = shapely.ops.substring(line, min(m1, m2), max(m1, m2))
+        assert road.substring(m1, m2).equals_exact(expected, 1e-9)
+    assert road.substring(0.3, 0.3) is None
+
+
+def test_cut_matches_the_old_bisection_for_nodes_on_vertices():
+    line = make_line(2)
+    vertices = [0, 17, 18, 90, 199]
+    xy = [line.coords[i] for i in vertices]
+    cuts = RoadGeometry(line).cut([(0, 1), (1, 2), (2, 3), (3, 4)], xy, 1e-9)
+    for (i, j), geom in cuts.items():
+        assert geom.equals_exact(legacy_substring(line, Point(xy[i]), Point(xy[j])), 1e-12)
+
+
+def test_cut_uses_the_line_both_nodes_are_on():
+    road = MultiLineString([[(0, 0), (1, 0)], [(1, 0), (1, 1)]])
+    xy = [(0.5, 0), (1, 0), (1, 0.5), (0.2, 0.3)]
+    cuts = RoadGeometry(road).cut([(0, 1), (1, 2), (0, 2), (0, 3)], xy, 1e-9)
+    assert list(cuts[(0, 1)].coords) == [(0.5, 0), (1, 0)]
+    assert list(cuts[(1, 2)].coords) == [(1, 0), (1, 0.5)]
+    assert (0, 2) not in cuts and (0, 3) not in cuts
@@ -0,0 +1,31 @@
+__author__ = 'pcoleman'
+
+import pytest
+from shapely.geometry import LineString
+from main.model.graph import Route, Step, geodesic_length_meters
+
+
+def test_geodesic_length_matches_the_ellipsoid():
+    # New Orleans to Memphis as the crow flies, the exact geodesic on the WGS84 ellipsoid is 576489.86 m
+    line = LineString([(-90.0715, 29.9511), (-90.0490, 35.1495)])
+    assert geodesic_length_meters(line) == pytest.approx(576489.86, rel=1e-5)
+    # Splitting the line into many short segments doesn't change its length
+    coords = [(-90.0715 + 0.0225 * i / 1000, 29.9511 + 5.1984 * i / 1000) for i in range(0, 1001)]
+    assert geodesic_length_meters(LineString(coords)) == pytest.approx(geodesic_length_meters(line), rel=1e-6)
+    assert geodesic_length_meters(LineString([(-90, 30), (-90, 30)])) == 0
+
+
+def test_decorate_route():
+    r = Route("r", 30.0, -91.0, "Route")
+    r.steps = [
+        Step("r", 0, 30.0, -91.0, "A", LineString([(-91.0, 30.0), (-91.1, 30.1)])),
+        Step("r", 1, 30.1, -91.1, "B", LineString([(-91.1, 30.1), (-91.2, 30.1)])),
+        Step("r", 2, 30.1, -91.2, None, None)
+    ]
+    r.decorate()
+
+    assert r.distance_meters == pytest.approx(r.steps[0].distance_meters + r.steps[1].distance_meters)
+    assert r.steps[2].distance_meters == 0
+    assert r.geom.geom_type == 'LineString' and len(r.geom.coords) == 3
+    assert r.geom_bbox.bounds == (-91.2, 30.0, -91.0, 30.1)
+    assert r.steps[1].geom_centroid.x == pytest.approx(-91.15)
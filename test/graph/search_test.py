@@ -0,0 +1,92 @@
+__author__ = 'pcoleman'
+
+import math
+import random
+import networkx as nx
+import pytest
+from main.model.search import *
+
+
+def make_grid_graph(size=20, seed=1):
+    """A jittered grid of 'intersections', edge weights are planar lengths with some roads 5x as expensive"""
+    rnd = random.Random(seed)
+    g = nx.Graph()
+    for x in range(size):
+        for y in range(size):
+            g.add_node((x, y), lat=30 + y * 0.1 + rnd.uniform(-0.02, 0.02),
+                       lon=-91 + x * 0.1 + rnd.uniform(-0.02, 0.02))
+
+    for x in range(size):
+        for y in range(size):
+            for nx_, ny_ in ((x + 1, y), (x, y + 1)):
+                if nx_ < size and ny_ < size:
+                    a, b = g.nodes[(x, y)], g.nodes[(nx_, ny_)]
+                    length = math.hypot(a['lat'] - b['lat'], a['lon'] - b['lon'])
+                    g.add_edge((x, y), (nx_, ny_), weight=length * (5 if rnd.random() < 0.1 else 1))
+    return g
+
+
+@pytest.mark.parametrize("engine", [DijkstraEngine(), BidirectionalDijkstraEngine(), AStarEngine()])
+def test_engines_find_weighted_shortest_paths(engine):
+    g = make_grid_graph()
+    view = NetworkXView(g)
+    rnd = random.Random(2)
+    nodes = list(g.nodes)
+    for _ in range(20):
+        s, t = rnd.choice(nodes), rnd.choice(nodes)
+        result = engine.search(view, s, t)
+        expected = nx.dijkstra_path_length(g, s, t)
+        assert result.distance == pytest.approx(expected)
+        assert result.path[0] == s and result.path[-1] == t
+        assert sum(g[u][v]['weight'] for u, v in zip(result.path, result.path[1:])) == pytest.approx(expected)
+
+
+def test_astar_settles_fewer_nodes_than_dijkstra():
+    g = make_grid_graph()
+    view = NetworkXView(g)
+    s, t = (2, 2), (6, 7)
+    dijkstra = DijkstraEngine().search(view, s, t)
+    astar = AStarEngine().search(view, s, t)
+    assert astar.settled < dijkstra.settled < g.number_of_nodes()
+
+
+def test_heuristic_is_admissible():
+    g = make_grid_graph()
+    for u, v, data in g.edges(data=True):
+        a, b = g.nodes[u], g.nodes[v]
+        assert haversine_degrees(a['lat'], a['lon'], b['lat'], b['lon']) <= data['weight'] + 1e-12
+
+
+def test_missing_nodes_and_disconnected_graphs():
+    g = make_grid_graph(size=3)
+    g.add_node("island", lat=0, lon=0)
+    view = NetworkXView(g)
+    for engine in SEARCH_ENGINES.values():
+        with pytest.raises(nx.NodeNotFound):
+            engine().search(view, (0, 0), "nowhere")
+        with pytest.raises(nx.NetworkXNoPath):
+            engine().search(view, (0, 0), "island")
+
+
+def test_one_sweep_reaches_every_target():
+    g = make_grid_graph()
+    view = NetworkXView(g)
+    targets = [(3, 4), (19, 19), (10, 0), (0, 0)]
+    tree = dijkstra_to_many(view, (0, 0), targets)
+    for t in targets:
+        assert tree.distance_to(t) == pytest.approx(nx.dijkstra_path_length(g, (0, 0), t))
+        path = tree.path_to(t)
+        assert path[0] == (0, 0) and path[-1] == t
+    # It stops once the farthest target is settled, not after the whole graph
+    assert tree.settled <= g.number_of_nodes()
+
+    g.add_node("island", lat=0, lon=0)
+    tree = dijkstra_to_many(NetworkXView(g), (0, 0), [(1, 1), "island"])
+    assert tree.distance_to("island") == INFINITY
+    with pytest.raises(nx.NetworkXNoPath):
+        tree.path_to("island")
+
+    # Without targets or a radius the sweep covers everything it can reach
+    tree = dijkstra_to_many(NetworkXView(g), (0, 0), None)
+    assert tree.settled == g.number_of_nodes() - 1
+    assert tree.distance_to((19, 19)) == pytest.approx(nx.dijkstra_path_length(g, (0, 0), (19, 19)))
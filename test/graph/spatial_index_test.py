@@ -0,0 +1,43 @@
+__author__ = 'pcoleman'
+
+import random
+import numpy as np
+from main.model.graph import RoadGraph
+from main.model.spatial_index import NodeIndex, haversine_degrees_array
+from test.graph.compact_graph_test import make_road_graph
+
+
+def test_nearest_matches_brute_force():
+    rnd = random.Random(0)
+    lat = np.array([rnd.uniform(29, 36) for _ in range(0, 2000)])
+    lon = np.array([rnd.uniform(-94, -88) for _ in range(0, 2000)])
+    index = NodeIndex(range(0, len(lat)), lat, lon, cell_degrees=0.1)
+
+    for _ in range(0, 200):
+        # Include points well outside the nodes' bounding box
+        p = (rnd.uniform(25, 40), rnd.uniform(-100, -80))
+        node, distance_meters = index.nearest(*p)
+        distances = haversine_degrees_array(p[0], p[1], lat, lon)
+        assert node == int(np.argmin(distances))
+        assert distance_meters > 0
+
+    assert NodeIndex([], [], []).nearest(30, -90) == (None, None)
+
+
+def test_road_graph_snaps_points_to_nodes():
+    g = RoadGraph()
+    g.graph = make_road_graph()
+    n, data = next(iter(g.graph.nodes(data=True)))
+    assert g.nearest_node(data['lat'] + 0.0001, data['lon'])[0] == n
+
+    g.freeze()
+    node_id, distance_meters = g.nearest_node(data['lat'] + 0.0001, data['lon'])
+    assert node_id == n
+    assert 10 < distance_meters < 12
+
+
+def test_nodes_on_the_edge_of_the_grid_are_found():
+    # 30.0 // 0.05 is 599 but the node at 30.0 is in row 600
+    index = NodeIndex(["island", "town"], [0.0, 30.0], [0.0, -90.8], cell_degrees=0.05)
+    node, meters = index.nearest(30.0, -90.8)
+    assert node == "town" and meters == 0.0
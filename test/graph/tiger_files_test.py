@@ -0,0 +1,65 @@
+__author__ = 'pcoleman'
+
+import shapefile
+from shapely.geometry import LineString
+from main.model.graph_factory import GraphFactory
+from main.model.tiger_files import find_road_intersections
+from main.config.config import graph_factory_config
+
+
+def write_roads(file_name, roads):
+    with shapefile.Writer(file_name, shapeType=shapefile.POLYLINE, encoding="latin1") as w:
+        for field in ("LINEARID", "FULLNAME", "RTTYP", "MTFCC"):
+            w.field(field, "C", 22)
+        for linearid, name, rttyp, coords in roads:
+            w.line([coords])
+            w.record(linearid, name, rttyp, "S1200")
+
+
+def write_places(file_name, places):
+    with shapefile.Writer(file_name, shapeType=shapefile.POLYGON, encoding="latin1") as w:
+        w.field("STATEFP", "C", 2)
+        w.field("GEOID", "C", 7)
+        w.field("NAME", "C", 100)
+        for geoid, name, ring in places:
+            w.poly([ring])
+            w.record("22", geoid, name)
+
+
+def test_roads_crossing_at_a_single_point_intersect():
+    geoms = [LineString([(0, 0), (2, 0)]), LineString([(1, -1), (1, 1)]), LineString([(0, 0), (2, 0)]),
+             LineString([(0, 1), (1, 0), (2, 1)]), LineString([(1.5, -1), (1.5, 1)]),
+             # Crosses the first road twice
+             LineString([(0.2, 1), (0.2, -1), (0.4, -1), (0.4, 1)])]
+    r1, r2, lat, lon = find_road_intersections(geoms, ["1", "2", "3", "4", "1", "5"])
+    pairs = sorted(zip(r1.tolist(), r2.tolist(), lat.tolist(), lon.tolist()))
+    # 0 and 2 are the same line, 1 and 3 touch at (1, 0) like 0 and 3, and 0 and 4 share a linearid
+    assert pairs == [(0, 1, 0.0, 1.0), (0, 3, 0.0, 1.0), (1, 2, 0.0, 1.0), (1, 3, 0.0, 1.0), (2, 3, 0.0, 1.0),
+                     (2, 4, 0.0, 1.5), (3, 4, 0.5, 1.5)]
+
+
+def test_graph_is_built_from_shapefiles(tmpdir, monkeypatch):
+    monkeypatch.setitem(graph_factory_config, "number_of_processors", 2)
+    roads_file, places_file = str(tmpdir.join("tl_2014_22_prisecroads")), str(tmpdir.join("tl_2014_22_place"))
+    write_roads(roads_file, [
+        ("110", "Main St", "M", [(-91.0, 30.0), (-90.0, 30.0)]),
+        ("120", "I- 10", "I", [(-90.5, 29.5), (-90.5, 30.5)]),
+        ("130", "LA 1", "S", [(-90.8, 29.5), (-90.8, 30.5), (-90.2, 30.5)])
+    ])
+    write_places(places_file, [
+        ("2205000", "Town", [(-90.52, 29.99), (-90.52, 30.01), (-90.48, 30.01), (-90.48, 29.99), (-90.52, 29.99)]),
+        ("2239475", "Nowhere", [(-80.01, 25.0), (-80.01, 25.01), (-80.0, 25.01), (-80.0, 25.0), (-80.01, 25.0)])
+    ])
+
+    r = GraphFactory.construct_graph_from_shapefiles(str(tmpdir.join("graph.bin")), [roads_file + ".shp"],
+                                                     [places_file + ".shp"], compact=True)
+    view = r.view()
+    # Main St crosses I- 10 and LA 1, I- 10 crosses LA 1 at the top, Town is at the Main St/I- 10 crossing.  Places
+    # are keyed on their GEOIDs, their gids in gis.places
+    assert sorted(str(view.key(i)) for i in view.nodes()) == ["2205000", "30.0,-90.5", "30.0,-90.8", "30.5,-90.5"]
+    assert view.node_data(view.index_of(2205000)) == {"lat": 30.0, "lon": -90.5, "city_name": "Town"}
+    assert view.index_of(2239475) is None
+
+    # Along LA 1 rather than Main St and I- 10, interstates weigh 5 times their length
+    route = r.shortest_route("30.0,-90.8", "30.5,-90.5")
+    assert [s.name for s in route.steps] == ["LA 1", None]
@@ -0,0 +1,70 @@
+__author__ = 'pcoleman'
+
+import itertools
+import random
+import networkx as nx
+import numpy as np
+import pytest
+from shapely.geometry import LineString
+from main.model.graph import RoadGraph
+from main.model.trip import order_stops, trip_length
+
+
+def line_matrix(positions):
+    p = np.array(positions, dtype=np.float64)
+    return np.abs(p[:, None] - p[None, :])
+
+
+def test_stops_in_between_are_reordered():
+    # Stops along a line, given out of order, the first and last stay where they are
+    positions = [0, 7, 2, 9, 4, 10]
+    order = order_stops(line_matrix(positions))
+    assert order[0] == 0 and order[-1] == 5
+    assert [positions[i] for i in order] == [0, 2, 4, 7, 9, 10]
+
+    order = order_stops(line_matrix([5, 0, 10, 1]), keep_last=False)
+    assert order[0] == 0 and sorted(order) == [0, 1, 2, 3]
+    assert trip_length(line_matrix([5, 0, 10, 1]), order) == 15
+
+
+def test_order_is_close_to_the_best_one():
+    rnd = random.Random(3)
+    points = np.array([(rnd.random(), rnd.random()) for _ in range(8)])
+    matrix = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    best = min(trip_length(matrix, [0] + list(p) + [7]) for p in itertools.permutations(range(1, 7)))
+    assert trip_length(matrix, order_stops(matrix)) <= best * 1.1
+
+
+def make_road_graph():
+    # Towns on a road running east, numbered out of order
+    r = RoadGraph()
+    towns = {1: 0.0, 4: 0.1, 2: 0.2, 5: 0.3, 3: 0.4}
+    for gid, lon in towns.items():
+        r.graph.add_node(gid, lat=30.0, lon=-91.0 + lon, city_name="Town " + str(gid))
+    ordered = sorted(towns, key=towns.get)
+    for a, b in zip(ordered, ordered[1:]):
+        r.graph.add_edge(a, b, weight=towns[b] - towns[a], db_id=a, name="Road " + str(a),
+                         geom=LineString([(-91.0 + towns[a], 30.0), (-91.0 + towns[b], 30.0)]))
+    return r
+
+
+def test_trip_route_is_stitched_from_its_legs(monkeypatch):
+    monkeypatch.setattr(RoadGraph, "node_name", staticmethod(lambda node_id, data: data["city_name"]))
+    r = make_road_graph()
+
+    matrix, trees = r.travel_matrix([1, 2, 3])
+    assert np.allclose(matrix, [[0, 0.2, 0.4], [0.2, 0, 0.2], [0.4, 0.2, 0]])
+
+    route = r.trip_route([1, 3, 2])
+    assert route.stops == [1, 3, 2]
+    assert route.name == "Town 1 to Town 3 to Town 2"
+    assert [s.city_name for s in route.steps] == ["Town 1", "Town 4", "Town 2", "Town 5", "Town 3", "Town 5",
+                                                  "Town 2"]
+    assert [s.step_id for s in route.steps] == list(range(0, 7))
+
+    route = r.trip_route([1, 3, 4, 5], optimize=True)
+    assert route.stops == [1, 4, 3, 5]
+
+    r.graph.add_node(9, lat=0.0, lon=0.0, city_name="Island")
+    with pytest.raises(nx.NetworkXNoPath):
+        r.trip_route([1, 9])
@@ -0,0 +1,73 @@
+__author__ = 'pcoleman'
+
+import gzip
+import json
+from flask import Flask
+from main.util.cacheable import cacheable_response
+from main.util.nocache import nocache
+
+
+def make_app(body):
+    app = Flask(__name__)
+
+    @app.route("/resource")
+    def resource():
+        return cacheable_response(body, immutable=True)
+
+    @app.route("/rebuilt")
+    def rebuilt():
+        return cacheable_response(body, immutable=False)
+
+    @app.route("/fresh")
+    @nocache
+    def fresh():
+        return body
+
+    return app.test_client()
+
+
+def test_cacheable_response_is_compressed_and_revalidated():
+    body = json.dumps({"steps": [{"lat": 30.0, "lon": -91.0, "name": "Road"}] * 100}, separators=(',', ':'))
+    client = make_app(body)
+
+    plain = client.get("/resource")
+    assert plain.status_code == 200
+    assert plain.get_data(as_text=True) == body
+    assert "Content-Encoding" not in plain.headers
+    assert "immutable" in plain.headers["Cache-Control"]
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    zipped = client.get("/resource", headers={"Accept-Encoding": "gzip, deflate"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(zipped.get_data()).decode('utf-8') == body
+    assert len(zipped.get_data()) < len(body)
+    # Every encoding is a representation of its own
+    assert zipped.headers["ETag"] != plain.headers["ETag"]
+
+    again = client.get("/resource", headers={"Accept-Encoding": "gzip", "If-None-Match": zipped.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+    assert again.headers["ETag"] == zipped.headers["ETag"]
+    assert client.get("/resource", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_bodies_that_may_change_are_revalidated():
+    client = make_app('{"route_id":"a"}')
+    first = client.get("/rebuilt")
+    assert "immutable" not in first.headers["Cache-Control"]
+    assert "no-cache" in first.headers["Cache-Control"]
+    assert client.get("/rebuilt", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    # The ETag is the body's, it's the same whichever way the body was built
+    assert first.headers["ETag"] == client.get("/resource").headers["ETag"]
+
+
+def test_small_responses_are_not_compressed():
+    client = make_app('{"route_id":"a"}')
+    assert "Content-Encoding" not in client.get("/resource", headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_nocache_sends_an_http_date():
+    response = make_app("{}").get("/fresh")
+    assert response.headers["Last-Modified"].endswith(" GMT")
+    assert response.last_modified is not None
+    assert "no-store" in response.headers["Cache-Control"]
@@ -0,0 +1,71 @@
+__author__ = 'pcoleman'
+
+import os
+import zipfile
+from main.util.data_util import MirrorSource, download_file, retrieve_data_from_census_ftp
+
+FTP_DIR = '/geo/tiger/TIGER2014/PLACE/'
+
+
+class CountingSource(MirrorSource):
+    def __init__(self, mirror_dir, ftp_dir):
+        MirrorSource.__init__(self, mirror_dir, ftp_dir)
+        self.fetched = []
+
+    def fetch(self, name, callback, offset=0):
+        self.fetched.append((name, offset))
+        MirrorSource.fetch(self, name, callback, offset)
+
+
+def make_mirror(tmpdir):
+    directory = tmpdir.mkdir("mirror").join(FTP_DIR.strip("/"))
+    os.makedirs(str(directory))
+    for fips in ("22", "28"):
+        with zipfile.ZipFile(str(directory.join("tl_2014_{0}_place.zip".format(fips))), 'w') as z:
+            z.writestr("tl_2014_{0}_place.shp".format(fips), os.urandom(5000))
+            z.writestr("tl_2014_{0}_place.dbf".format(fips), b"dbf " + fips.encode())
+    return str(tmpdir.join("mirror"))
+
+
+def test_unchanged_files_are_not_downloaded_again(tmpdir):
+    mirror = make_mirror(tmpdir)
+    output_dir = str(tmpdir.join("places"))
+
+    source = CountingSource(mirror, FTP_DIR)
+    manifest = retrieve_data_from_census_ftp(FTP_DIR, output_dir, source)
+    assert sorted(source.fetched) == [("tl_2014_22_place.zip", 0), ("tl_2014_28_place.zip", 0)]
+    assert sorted(f for f in os.listdir(output_dir) if not f.startswith(".")) == [
+        "tl_2014_22_place.dbf", "tl_2014_22_place.shp", "tl_2014_28_place.dbf", "tl_2014_28_place.shp"]
+    assert sorted(manifest["tl_2014_28_place.zip"]["extracted"]) == ["tl_2014_28_place.dbf", "tl_2014_28_place.shp"]
+
+    source = CountingSource(mirror, FTP_DIR)
+    retrieve_data_from_census_ftp(FTP_DIR, output_dir, source)
+    assert source.fetched == []
+
+    # A file that changed on the server, or whose extracted files are gone, is downloaded again
+    with zipfile.ZipFile(os.path.join(mirror, FTP_DIR.strip("/"), "tl_2014_22_place.zip"), 'a') as z:
+        z.writestr("tl_2014_22_place.prj", b"GEOGCS")
+    os.remove(os.path.join(output_dir, "tl_2014_28_place.dbf"))
+    source = CountingSource(mirror, FTP_DIR)
+    retrieve_data_from_census_ftp(FTP_DIR, output_dir, source)
+    assert sorted(source.fetched) == [("tl_2014_22_place.zip", 0), ("tl_2014_28_place.zip", 0)]
+    assert os.path.exists(os.path.join(output_dir, "tl_2014_22_place.prj"))
+
+
+def test_partial_downloads_are_resumed(tmpdir):
+    mirror = make_mirror(tmpdir)
+    output_dir = str(tmpdir.mkdir("places"))
+    source = CountingSource(mirror, FTP_DIR)
+    name = "tl_2014_22_place.zip"
+    with open(os.path.join(mirror, FTP_DIR.strip("/"), name), 'rb') as ifile:
+        data = ifile.read()
+    with open(os.path.join(output_dir, "{0}.{1}.part".format(name, len(data))), 'wb') as ofile:
+        ofile.write(data[:1000])
+
+    _, entry, fetched, existing = download_file(source, name, output_dir, None)
+    assert source.fetched == [(name, 1000)]
+    assert (fetched, existing) == (len(data) - 1000, 1000)
+    with open(os.path.join(output_dir, name), 'rb') as ifile:
+        assert ifile.read() == data
+    assert entry["size"] == len(data)
+    assert os.listdir(output_dir) == [name]
@@ -0,0 +1,99 @@
+__author__ = 'pcoleman'
+
+import threading
+import time
+import pytest
+from main.model import ConnectionPool, PoolTimeout, with_pg_connection
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params=None):
+        if self.connection.broken:
+            raise Exception("connection reset")
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+        self.prepared = 0
+        self._in_transaction = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def prepare(self, sql):
+        self.prepared += 1
+        return sql
+
+    def rollback(self):
+        if self.broken:
+            raise Exception("connection reset")
+
+    def close(self):
+        self.closed = True
+
+
+def test_connections_are_reused_and_bounded():
+    pool = ConnectionPool(FakeConnection, max_size=2, acquire_timeout_seconds=0.2)
+    a = pool.acquire()
+    pool.release(a)
+    assert pool.acquire() is a
+
+    b = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    # A waiting acquire gets the connection as soon as it's released
+    threading.Timer(0.05, pool.release, args=(b,)).start()
+    assert pool.acquire() is b
+    assert pool.stats()["created"] == 2
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_idle_and_unhealthy_connections_are_closed():
+    pool = ConnectionPool(FakeConnection, min_size=0, max_size=2, idle_timeout_seconds=0.05, health_check_seconds=0)
+    a = pool.acquire()
+    pool.release(a)
+    a.connection.broken = True
+    b = pool.acquire()
+    assert b is not a and a.connection.closed
+    assert pool.stats()["health_check_failures"] == 1
+
+    pool.release(b)
+    time.sleep(0.1)
+    c = pool.acquire()
+    assert c is not b and b.connection.closed
+
+
+def test_statements_are_prepared_once_per_connection():
+    pool = ConnectionPool(FakeConnection, max_size=1)
+    p = pool.acquire()
+    p.prepare("SELECT 1")
+    p.prepare("SELECT 1")
+    assert p.connection.prepared == 1
+
+
+def test_with_pg_connection_returns_connections():
+    import main.model
+    pool = ConnectionPool(FakeConnection, max_size=1)
+    original = main.model.connection_pool
+    main.model.connection_pool = pool
+    try:
+        @with_pg_connection
+        def query(**kwargs):
+            return kwargs['connection']
+
+        assert query() is query()
+        assert pool.stats()["in_use"] == 0
+    finally:
+        main.model.connection_pool = original
@@ -0,0 +1,122 @@
+__author__ = 'pcoleman'
+
+import io
+import os
+import subprocess
+import sys
+import pytest
+import main.util.data_util as data_util
+from main.util.data_util import COPY_STATEMENT, copy_chunks, state_fips_of
+
+
+SHP2PGSQL_OUTPUT = """SET CLIENT_ENCODING TO UTF8;
+SET STANDARD_CONFORMING_STRINGS TO ON;
+BEGIN;
+COPY "gis"."roads" ("linearid","fullname","rttyp","mtfcc",geom) FROM stdin;
+1104\tI- 10\tI\tS1100\t0105000020AD10
+1105\tUS Hwy 90\tU\tS1200\t0105000020AD10
+1106\tLA 1\tS\tS1200\t0105000020AD10
+\\.
+COMMIT;
+ANALYZE "gis"."roads";
+"""
+
+
+def test_copy_rows_are_streamed_in_chunks():
+    lines = iter(SHP2PGSQL_OUTPUT.splitlines(keepends=True))
+    columns = None
+    for line in lines:
+        match = COPY_STATEMENT.match(line)
+        if match is not None:
+            columns = match.group(1)
+            break
+    assert columns == '("linearid","fullname","rttyp","mtfcc",geom)'
+
+    counter = [0]
+    chunks = list(copy_chunks(lines, counter, chunk_bytes=60))
+    assert counter == [3]
+    assert len(chunks) == 2
+    assert "".join(chunks).splitlines()[2].startswith("1106\t")
+    # Nothing after the end of the data is read
+    assert next(lines) == "COMMIT;\n"
+
+
+def test_shapefiles_are_imported_per_state(monkeypatch):
+    copied = []
+
+    class FakeProcess:
+        returncode = 0
+
+        def __init__(self, command, **kwargs):
+            assert "-D" in command
+            assert kwargs["stderr"] is not subprocess.PIPE
+            self.stdout = io.StringIO(SHP2PGSQL_OUTPUT)
+
+        def poll(self):
+            return 0
+
+        def wait(self):
+            return 0
+
+    def copy_state_rows(table, statefp, columns, rows):
+        copied.append((table, statefp, columns, "".join(rows).count("\n")))
+
+    monkeypatch.setattr(data_util.subprocess, "Popen", FakeProcess)
+    monkeypatch.setattr(data_util, "copy_state_rows", copy_state_rows)
+
+    file_name, rows, seconds = data_util.import_shapefile(("data/roads/tl_2014_22_prisecroads.shp", "roads"))
+    assert state_fips_of(file_name) == "22"
+    assert rows == 3
+    assert copied == [("roads", "22", '("linearid","fullname","rttyp","mtfcc",geom)', 3)]
+
+
+def test_shp2pgsql_warnings_do_not_stall_the_import(monkeypatch):
+    # More warnings than a pipe holds before the rows, then a failure
+    script = "import sys; sys.stderr.write('Warning: ring not closed\\n' * 20000); sys.stdout.write({0!r}); " \
+             "sys.exit(1)".format(SHP2PGSQL_OUTPUT)
+    copied = []
+    monkeypatch.setattr(data_util, "shp2pgsql_command", lambda file_name, table: [sys.executable, "-c", script])
+    monkeypatch.setattr(data_util, "copy_state_rows",
+                        lambda table, statefp, columns, rows: copied.append("".join(rows).count("\n")))
+
+    with pytest.raises(RuntimeError) as e:
+        data_util.import_shapefile(("data/roads/tl_2014_22_prisecroads.shp", "roads"))
+    assert copied == [3]
+    assert "ring not closed" in str(e.value)
+
+
+def test_indexes_are_only_dropped_for_bulk_imports(monkeypatch, tmpdir):
+    calls = []
+
+    class InlinePool:
+        def __init__(self, processes):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def imap_unordered(self, function, tasks):
+            return map(function, tasks)
+
+    def shapefiles(data_dir, fips=[]):
+        files = [str(tmpdir.join(os.path.basename(data_dir) + "_" + str(x) + ".shp")) for x in fips]
+        for f in files:
+            open(f, "w").close()
+        return files
+
+    monkeypatch.setattr(data_util.multiprocessing, "Pool", InlinePool)
+    monkeypatch.setattr(data_util, "shapefiles", shapefiles)
+    monkeypatch.setattr(data_util, "import_shapefile", lambda task: (task[0], 1, 0.0))
+    for name in ("drop_import_indexes", "create_import_indexes", "vacuum_full"):
+        monkeypatch.setattr(data_util, name, lambda name=name: calls.append(name))
+    monkeypatch.setitem(data_util.import_config, "drop_indexes_min_files", 4)
+
+    data_util.import_data_to_db([22])
+    assert calls == ["vacuum_full", "create_import_indexes"]
+
+    del calls[:]
+    data_util.import_data_to_db([1, 22])
+    assert calls == ["drop_import_indexes", "vacuum_full", "create_import_indexes"]
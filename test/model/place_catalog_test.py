@@ -0,0 +1,50 @@
+__author__ = 'pcoleman'
+
+import pytest
+from main.model.place_catalog import PlaceCatalog, PlaceCatalogError
+
+PLACES = [
+    (1, "Baton Rouge", "22", 199.0),
+    (2, "Baker", "22", 20.0),
+    (3, "Bakersfield", "06", 390.0),
+    (4, "Memphis", "47", 840.0),
+    (5, "Baker", "06", 5.0),
+]
+
+
+def make_catalog(rows, signature):
+    return PlaceCatalog(load_rows=lambda: list(rows), load_signature=lambda: signature[0], check_interval=0)
+
+
+def test_prefix_search_is_ranked_and_limited():
+    catalog = make_catalog(PLACES, [1])
+    assert [p["gid"] for p in catalog.search("bak", 10)] == [3, 2, 5]
+    # An exact match beats a bigger place
+    assert [p["gid"] for p in catalog.search(" Baker", 2)] == [2, 5]
+    assert catalog.search("memphis", 10) == [{"gid": 4, "city_name": "Memphis", "state_name": "Tennessee"}]
+    assert catalog.search("x", 10) == []
+    assert catalog.get_place_name_by_id(1) == "Baton Rouge, Louisiana"
+
+
+def test_catalog_is_rebuilt_after_a_reimport():
+    rows = list(PLACES)
+    signature = [1]
+    catalog = make_catalog(rows, signature)
+    assert len(catalog.search("new", 10)) == 0
+
+    rows.append((6, "New Orleans", "22", 350.0))
+    signature[0] = 2
+    catalog.search("new", 10)
+    catalog._reload_thread.join()
+    assert [p["gid"] for p in catalog.search("new", 10)] == [6]
+    assert catalog.reload_count == 1
+
+
+def test_catalog_fails_clearly_without_the_database():
+    # The DAO returns None when it can't connect
+    catalog = PlaceCatalog(load_rows=lambda: None, load_signature=lambda: None, check_interval=0)
+    with pytest.raises(PlaceCatalogError):
+        catalog.search("bak", 10)
+    with pytest.raises(PlaceCatalogError):
+        catalog.get_place_name_by_id(1)
+    assert catalog.status()["places"] is None
@@ -0,0 +1,55 @@
+__author__ = 'pcoleman'
+
+import time
+from main.model.route_cache import RouteCache
+
+
+def test_least_recently_used_route_is_evicted():
+    cache = RouteCache(max_size=2)
+    cache.put(RouteCache.key(1, 2, 0), "a", "{}", "id-a")
+    cache.put(RouteCache.key(3, 4, 0), "b", "{}", "id-b")
+    assert cache.get(RouteCache.key(1, 2, 0)).route_id == "id-a"
+
+    cache.put(RouteCache.key(5, 6, 0), "c", "{}", "id-c")
+    assert cache.get(RouteCache.key(3, 4, 0)) is None
+    assert cache.get(RouteCache.key(1, 2, 0)).route == "a"
+    assert cache.stats()["evicted"] == 1
+    assert cache.hits == 2 and cache.misses == 1
+
+
+def test_routes_expire_and_are_keyed_on_graph_version():
+    cache = RouteCache(ttl_seconds=0.05)
+    cache.put(RouteCache.key(1, 2, 0), "a", "{}", "id-a")
+    assert cache.get(RouteCache.key(1, 2, 1)) is None
+    assert cache.get(RouteCache.key(1, 2, 0)) is not None
+
+    time.sleep(0.1)
+    assert cache.get(RouteCache.key(1, 2, 0)) is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_clear_on_graph_swap():
+    cache = RouteCache()
+    cache.put(RouteCache.key(1, 2, 0), "a", "{}", "id-a")
+    cache.clear(0, 1)
+    assert len(cache) == 0
+
+
+def test_routes_are_found_by_route_id():
+    cache = RouteCache(max_size=2, ttl_seconds=0.05)
+    cache.put(RouteCache.key(1, 2, 0), "a", "{}", "id-a")
+    cache.put(RouteCache.key(3, 4, 0), "b", "{}", "id-b")
+    assert cache.get_by_route_id("id-a").route == "a"
+
+    # Replacing an entry forgets the old route, evicting one forgets it altogether
+    cache.put(RouteCache.key(1, 2, 0), "c", "{}", "id-c")
+    assert cache.get_by_route_id("id-a") is None
+    cache.put(RouteCache.key(5, 6, 0), "d", "{}", "id-d")
+    assert cache.get_by_route_id("id-b") is None
+    assert cache.get_by_route_id("id-c").route == "c"
+
+    # A route never changes, so it's still served by id after its key expired
+    time.sleep(0.1)
+    assert cache.get_by_route_id("id-d").route == "d"
+    cache.clear(0, 1)
+    assert cache.get_by_route_id("id-d") is None
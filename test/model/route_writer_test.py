@@ -0,0 +1,68 @@
+__author__ = 'pcoleman'
+
+import threading
+import main.model
+from main.model.graph import Route
+from main.model.route_writer import RouteWriter
+from main.model.user_routes_dao import UserRoutesDAO
+
+
+def test_routes_are_written_in_batches():
+    written = []
+    writer = RouteWriter(lambda routes: written.append([r.id for r in routes]), batch_size=3, max_delay_seconds=5)
+    for i in range(0, 3):
+        writer.submit(Route(str(i), 30.0, -91.0, "route"))
+
+    assert writer.flush(timeout=5)
+    assert written == [["0", "1", "2"]]
+    assert writer.stats()["queue_depth"] == 0
+    assert writer.stats()["routes_written"] == 3
+
+
+def test_flush_writes_a_route_without_waiting_for_the_batch():
+    written = []
+    writer = RouteWriter(lambda routes: written.extend(r.id for r in routes), batch_size=100, max_delay_seconds=60)
+    writer.submit(Route("a", 30.0, -91.0, "route"))
+    assert writer.is_pending("a")
+    assert writer.flush("a", timeout=5)
+    assert written == ["a"]
+    assert not writer.is_pending("a")
+
+
+def test_failed_batches_are_retried():
+    attempts = []
+    release = threading.Event()
+
+    def write(routes):
+        attempts.append(len(routes))
+        if len(attempts) < 2:
+            raise Exception("database is down")
+        release.set()
+
+    writer = RouteWriter(write, batch_size=1, max_delay_seconds=0)
+    writer.submit(Route("a", 30.0, -91.0, "route"))
+    assert writer.flush("a", timeout=5)
+    assert release.is_set() and attempts == [1, 1]
+    assert writer.stats()["failed_batches"] == 0
+
+
+def test_routes_the_database_refuses_are_dropped(monkeypatch):
+    attempts = []
+
+    def unreachable():
+        attempts.append(1)
+        raise ConnectionRefusedError("database is down")
+
+    monkeypatch.setattr(main.model.connection_pool, "acquire", unreachable)
+    writer = RouteWriter(UserRoutesDAO.insert_routes, batch_size=1, max_delay_seconds=0, retries=1, max_dropped=1)
+    writer.submit(Route("a", 30.0, -91.0, "route"))
+    assert not writer.flush("a", timeout=5)
+    assert len(attempts) == 2
+    stats = writer.stats()
+    assert stats["failed_batches"] == 1 and stats["dropped_routes"] == 1 and stats["routes_written"] == 0
+
+    # Only the most recently dropped ids are remembered, however long the database is down
+    writer.submit(Route("b", 30.0, -91.0, "route"))
+    assert not writer.flush("b", timeout=5)
+    assert list(writer._dropped) == ["b"]
+    assert writer.stats()["dropped_routes"] == 2
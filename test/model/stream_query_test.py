@@ -0,0 +1,51 @@
+__author__ = 'pcoleman'
+
+import main.model.db_util
+from main.model.db_util import stream_query
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, sql, params=()):
+        self.connection.statements.append(sql)
+        if sql.startswith("FETCH"):
+            n = int(sql.split()[2])
+            self.rows = self.connection.remaining[:n]
+            self.connection.remaining = self.connection.remaining[n:]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.remaining = rows
+        self.statements = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_rows_are_fetched_in_batches(monkeypatch):
+    conn = FakeConnection([(i,) for i in range(0, 25)])
+    monkeypatch.setattr(main.model.db_util, "get_connection", lambda: conn)
+
+    rows = stream_query("SELECT x FROM t", fetch_size=10)
+    assert next(rows) == (0,)
+    # Only the first batch has been fetched so far
+    assert len(conn.remaining) == 15
+
+    assert [r[0] for r in rows] == list(range(1, 25))
+    assert conn.statements[0].startswith("DECLARE") and conn.statements[0].endswith("SELECT x FROM t")
+    assert len([s for s in conn.statements if s.startswith("FETCH")]) == 4
+    assert conn.closed